@@ -0,0 +1,343 @@
+import asyncio
+import math
+import threading
+import time
+from typing import Optional
+from uuid import uuid4
+
+from redis import StrictRedis
+from redis.asyncio import StrictRedis as AsyncStrictRedis
+from redis.exceptions import RedisError, WatchError
+
+from metrics import ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS
+
+
+class AdmissionRejected(Exception):
+
+    def __init__(self, reason: str, retry_after: int) -> None:
+        """
+        :param reason: "queue_full" or "queue_timeout"
+        :param retry_after: suggested delay before retrying, in seconds
+        """
+        super().__init__(f"Request rejected ({reason}), retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """
+    LLM call slot of an admitted request; ``release`` it once the call is over.
+    """
+
+    def __init__(self, controller: "AdmissionController", token: Optional[str]) -> None:
+        self._controller = controller
+        self._token = token
+        self._admitted_at = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        # Streams release from whichever of the response or the background drain ends last
+        if self._released:
+            return
+        self._released = True
+        self._controller.release(self._token, time.monotonic() - self._admitted_at)
+
+
+class AsyncAdmissionTicket(AdmissionTicket):
+
+    async def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        await self._controller.release(self._token, time.monotonic() - self._admitted_at)
+
+
+class AdmissionController:
+    """
+    Caps the LLM calls in flight, per worker process and, with a Redis client, across all workers.
+
+    A request beyond the caps waits in a bounded queue for at most ``max_wait`` seconds. A request
+    arriving at a full queue, or still queued after ``max_wait``, raises ``AdmissionRejected`` with
+    a retry-after hint derived from the mean duration of the recent calls.
+
+    Global slots are leases in a Redis sorted set scored by their expiry time, so the slots of a
+    crashed worker are given back after ``slot_ttl`` seconds.
+    """
+
+    def __init__(
+            self,
+            redis_client: Optional[StrictRedis] = None,
+            max_in_flight: int = 8,
+            max_global_in_flight: Optional[int] = None,
+            max_queue: int = 32,
+            max_wait: float = 10.0,
+            slot_ttl: int = 300,
+            poll_interval: float = 0.05,
+            key: str = "qa:admission:slots"
+    ) -> None:
+        """
+        :param redis_client: Redis client holding the global slots; None for per-worker caps only
+        :param max_in_flight: maximum number of LLM calls in flight in this worker
+        :param max_global_in_flight: maximum number of LLM calls in flight across all workers; None for no global cap
+        :param max_queue: maximum number of requests waiting for a slot in this worker
+        :param max_wait: maximum time a request waits for a slot, in seconds
+        :param slot_ttl: lifetime of a global slot lease, in seconds; longer than the longest LLM call
+        :param poll_interval: interval between two attempts at taking a global slot, in seconds
+        :param key: Redis key of the global slots
+        """
+        self._redis_client = redis_client
+        self._max_in_flight = max_in_flight
+        self._max_global_in_flight = max_global_in_flight if redis_client is not None else None
+        self._max_queue = max_queue
+        self._max_wait = max_wait
+        self._slot_ttl = slot_ttl
+        self._poll_interval = poll_interval
+        self._key = key
+
+        self._lock = threading.Lock()
+        self._slot_released = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._waiting = 0
+        self._mean_hold_seconds: Optional[float] = None
+
+    def retry_after(self) -> int:
+        """
+        Seconds until the queue ahead of a new request has likely drained.
+        """
+        mean_hold_seconds = self._mean_hold_seconds if self._mean_hold_seconds is not None else self._max_wait
+        return max(1, math.ceil(mean_hold_seconds * (self._waiting + 1) / self._max_in_flight))
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        ADMISSION_REJECTED.inc(reason=reason)
+        return AdmissionRejected(reason, self.retry_after())
+
+    def _enqueue(self) -> None:
+        # Called with the lock held
+        if self._waiting >= self._max_queue:
+            raise self._reject("queue_full")
+        self._waiting += 1
+        ADMISSION_QUEUE_DEPTH.inc()
+
+    def _dequeue(self) -> None:
+        self._waiting -= 1
+        ADMISSION_QUEUE_DEPTH.dec()
+
+    def _record_release(self, hold_seconds: float) -> None:
+        # Called with the lock held
+        self._in_flight -= 1
+        ADMISSION_IN_FLIGHT.dec()
+        self._mean_hold_seconds = hold_seconds if self._mean_hold_seconds is None else (
+            0.9 * self._mean_hold_seconds + 0.1 * hold_seconds
+        )
+
+    def _global_slot_commands(self, pipe, token: str, now: float) -> None:
+        pipe.multi()
+        pipe.zremrangebyscore(self._key, "-inf", now)
+        pipe.zadd(self._key, {token: now + self._slot_ttl})
+        pipe.expire(self._key, self._slot_ttl)
+
+    def _try_acquire_global(self, token: str) -> bool:
+        with self._redis_client.pipeline() as pipe:
+            while True:
+                now = time.time()
+                try:
+                    pipe.watch(self._key)
+                    if pipe.zcount(self._key, now, "+inf") >= self._max_global_in_flight:
+                        pipe.unwatch()
+                        return False
+                    self._global_slot_commands(pipe, token, now)
+                    pipe.execute()
+                    return True
+                except WatchError:
+                    # Another request took or gave back a slot meanwhile, count again
+                    continue
+
+    def _acquire_global(self, deadline: float) -> Optional[str]:
+        """
+        :return: lease token, or None if Redis is unavailable
+        """
+        token = uuid4().hex
+        try:
+            if self._try_acquire_global(token):
+                return token
+            with self._lock:
+                self._enqueue()
+            try:
+                while time.monotonic() < deadline:
+                    time.sleep(self._poll_interval)
+                    if self._try_acquire_global(token):
+                        return token
+            finally:
+                with self._lock:
+                    self._dequeue()
+        except RedisError as e:
+            # Fail open: the per-worker cap still holds
+            print(f"Global admission unavailable. Exception: {e}")
+            return None
+        raise self._reject("queue_timeout")
+
+    def acquire(self) -> AdmissionTicket:
+        """
+        Wait for an LLM call slot.
+        :return: ticket to release once the call is over
+        :raise AdmissionRejected: if the queue is full or the wait exceeded ``max_wait``
+        """
+        start_time = time.monotonic()
+        deadline = start_time + self._max_wait
+        with self._lock:
+            if self._in_flight >= self._max_in_flight:
+                self._enqueue()
+                try:
+                    while self._in_flight >= self._max_in_flight:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise self._reject("queue_timeout")
+                        self._slot_released.wait(remaining)
+                finally:
+                    self._dequeue()
+            self._in_flight += 1
+            ADMISSION_IN_FLIGHT.inc()
+
+        token = None
+        if self._max_global_in_flight is not None:
+            try:
+                token = self._acquire_global(deadline)
+            except AdmissionRejected:
+                with self._lock:
+                    self._in_flight -= 1
+                    ADMISSION_IN_FLIGHT.dec()
+                    self._slot_released.notify()
+                raise
+
+        ADMISSION_WAIT_SECONDS.observe(time.monotonic() - start_time)
+        return AdmissionTicket(self, token)
+
+    def release(self, token: Optional[str], hold_seconds: float) -> None:
+        """
+        Give a slot back; use ``AdmissionTicket.release`` instead.
+        """
+        if token is not None:
+            try:
+                self._redis_client.zrem(self._key, token)
+            except RedisError as e:
+                # The lease expires by itself after slot_ttl
+                print(f"Error releasing global admission slot: {e}")
+        with self._lock:
+            self._record_release(hold_seconds)
+            self._slot_released.notify()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "waiting": self._waiting,
+                "max_in_flight": self._max_in_flight,
+                "max_global_in_flight": self._max_global_in_flight,
+                "max_queue": self._max_queue,
+                "mean_hold_seconds": self._mean_hold_seconds,
+            }
+
+
+class AsyncAdmissionController(AdmissionController):
+    """
+    ``AdmissionController`` for one asyncio event loop, on an asyncio Redis client.
+    """
+
+    def __init__(
+            self,
+            redis_client: Optional[AsyncStrictRedis] = None,
+            max_in_flight: int = 8,
+            max_global_in_flight: Optional[int] = None,
+            max_queue: int = 32,
+            max_wait: float = 10.0,
+            slot_ttl: int = 300,
+            poll_interval: float = 0.05,
+            key: str = "qa:admission:slots"
+    ) -> None:
+        super().__init__(
+            redis_client=redis_client,
+            max_in_flight=max_in_flight,
+            max_global_in_flight=max_global_in_flight,
+            max_queue=max_queue,
+            max_wait=max_wait,
+            slot_ttl=slot_ttl,
+            poll_interval=poll_interval,
+            key=key
+        )
+        # The counters are only touched from the event loop; the inherited lock is not used
+        self._async_slot_released = asyncio.Condition()
+
+    async def _try_acquire_global(self, token: str) -> bool:
+        async with self._redis_client.pipeline() as pipe:
+            while True:
+                now = time.time()
+                try:
+                    await pipe.watch(self._key)
+                    if await pipe.zcount(self._key, now, "+inf") >= self._max_global_in_flight:
+                        await pipe.unwatch()
+                        return False
+                    self._global_slot_commands(pipe, token, now)
+                    await pipe.execute()
+                    return True
+                except WatchError:
+                    continue
+
+    async def _acquire_global(self, deadline: float) -> Optional[str]:
+        token = uuid4().hex
+        try:
+            if await self._try_acquire_global(token):
+                return token
+            self._enqueue()
+            try:
+                while time.monotonic() < deadline:
+                    await asyncio.sleep(self._poll_interval)
+                    if await self._try_acquire_global(token):
+                        return token
+            finally:
+                self._dequeue()
+        except RedisError as e:
+            print(f"Global admission unavailable. Exception: {e}")
+            return None
+        raise self._reject("queue_timeout")
+
+    async def acquire(self) -> AsyncAdmissionTicket:
+        start_time = time.monotonic()
+        deadline = start_time + self._max_wait
+        async with self._async_slot_released:
+            if self._in_flight >= self._max_in_flight:
+                self._enqueue()
+                try:
+                    await asyncio.wait_for(
+                        self._async_slot_released.wait_for(lambda: self._in_flight < self._max_in_flight),
+                        timeout=self._max_wait
+                    )
+                except asyncio.TimeoutError:
+                    raise self._reject("queue_timeout")
+                finally:
+                    self._dequeue()
+            self._in_flight += 1
+            ADMISSION_IN_FLIGHT.inc()
+
+        token = None
+        if self._max_global_in_flight is not None:
+            try:
+                token = await self._acquire_global(deadline)
+            except AdmissionRejected:
+                async with self._async_slot_released:
+                    self._in_flight -= 1
+                    ADMISSION_IN_FLIGHT.dec()
+                    self._async_slot_released.notify()
+                raise
+
+        ADMISSION_WAIT_SECONDS.observe(time.monotonic() - start_time)
+        return AsyncAdmissionTicket(self, token)
+
+    async def release(self, token: Optional[str], hold_seconds: float) -> None:
+        if token is not None:
+            try:
+                await self._redis_client.zrem(self._key, token)
+            except RedisError as e:
+                print(f"Error releasing global admission slot: {e}")
+        async with self._async_slot_released:
+            self._record_release(hold_seconds)
+            self._async_slot_released.notify()
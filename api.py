@@ -1,64 +1,62 @@
+"""
+QA API (Flask).
+
+``create_app`` builds the app. The heavy dependencies (openai, qdrant_client, redis) and
+config.yaml are only loaded there, so importing this module is cheap. Serve it with
+``python serve.py``, which forks warmed-up workers and drains them on shutdown.
+"""
+import json
+import os
+import random
 import time
-from typing import Generator
+from typing import Generator, Optional, TYPE_CHECKING
 
-from flask import Flask, request, Response, g
-from dotenv import load_dotenv
-import openai
-import os
-import yaml
-import redis
+from flask import Blueprint, Flask, current_app, request, Response, g
 
-from db import VecDBClient, ChatBotRedisClient
-from utils import get_text_embedding, get_openai_response, formatted_response
+from metrics import CONTENT_TYPE, LLM_TOKENS, STARTUP_SECONDS, Trace, registry
+from responses import formatted_response
+from schema import UserMessage, AssistantMessage
+from sse import SSEEncoder, format_event, iter_openai_tokens
 
-# ------------------------------------ Load config ------------------------------------
-config = yaml.safe_load(open("config.yaml", "r"))
+if TYPE_CHECKING:
+    from admission import AdmissionRejected
+    from services import QAServices
 
-# ------------------------------------ OpenAI config ------------------------------------
-load_dotenv()
-openai.api_key = os.environ.get("OPENAI_API_KEY")
+RESPONSE_CHUNK_SIZE = 100
 
-openai_config = config['openai']
-CHAT_MODEL_NAME = openai_config['chat_model']
-EMBEDDING_MODEL_NAME = openai_config['embedding_model']
-# openai.proxy = "http://127.0.0.1:7890"
+bp = Blueprint("qa", __name__)
 
-# ------------------------------------ Vector DB Client ------------------------------------
-qdrant_config = config['qdrant']
 
+def get_services() -> "QAServices":
+    return current_app.extensions["qa"]
 
-def get_qdrant_client():
-    if "qdrant_client" not in g:
-        g.qdrant_client = VecDBClient(
-            url=qdrant_config["url"],
-            collection_name=qdrant_config["document_collection_name"],
-            embedding_dim=qdrant_config["embedding_dim"]
-        )
-    return g.qdrant_client
 
+def start_trace(endpoint: str) -> Trace:
+    g.trace = Trace(endpoint, request_id=request.headers.get('X-Request-ID'), enabled=current_app.config["TRACE_ENABLED"])
+    return g.trace
 
-# ------------------------------------ Redis ------------------------------------
-redis_config = config['redis']
-CHAT_MEMORY_LEN = 6
 
-
-def get_redis_client():
-    if "redis_client" not in g:
-        g.redis_client = ChatBotRedisClient(
-            host=redis_config["host"],
-            port=redis_config["port"],
-            password=redis_config["password"],
-            db=0,
-        )
-    return g.redis_client
+@bp.after_app_request
+def add_request_id(response):
+    trace = g.get("trace")
+    if trace is not None:
+        response.headers['X-Request-ID'] = trace.request_id
+    return response
 
 
-# ------------------------------------ Flask ------------------------------------
-app = Flask(__name__)
-RESPONSE_CHUNK_SIZE = 100
+def rejected_response(e: "AdmissionRejected"):
+    print(f"请求被限流. Exception: {e}")
+    trace = g.get("trace")
+    if trace is not None:
+        trace.finish("rejected")
+    return (
+        formatted_response(success=False, msg="服务繁忙，请稍后重试", code=429),
+        429,
+        {"Retry-After": str(e.retry_after)}
+    )
 
 
-@app.route('/dummy/qa', methods=['GET', 'POST'])
+@bp.route('/dummy/qa', methods=['GET', 'POST'])
 def dummy_qa_chat():
     try:
         # 获取 JSON 数据
@@ -80,93 +78,320 @@ def dummy_qa_chat():
     return formatted_response(success=True, msg="回复成功", data=data)
 
 
-@app.route('/dummy/mark', methods=['GET', 'POST'])
+@bp.route('/dummy/mark', methods=['GET', 'POST'])
 def dummy_mark_answer():
+    """
+    Marking API: choice answers are marked against the question bank, free-text answers by the LLM.
+    :return: score and reference answer
+    """
+    from admission import AdmissionRejected
+
+    services = get_services()
+    trace = start_trace('/dummy/mark')
     try:
-        # 获取 JSON 数据
-        request_data = request.get_json()
-        # 从 JSON 数据中提取参数
-        user_id = int(request_data.get('userId'))  # 用户id
-        user_type = str(request_data.get('userType'))  # 用户所属部门
-        question_id = int(request_data.get('questionId'))  # 用户消息
-        user_answer = str(request_data.get('userAnswer'))  # 消息id
+        with trace.span("parse"):
+            # 获取 JSON 数据
+            request_data = request.get_json()
+            # 从 JSON 数据中提取参数
+            user_id = int(request_data.get('userId'))  # 用户id
+            user_type = str(request_data.get('userType'))  # 用户所属部门
+            doc_code = request_data.get('docCode')  # 题目所属文件编号
+            question_id = int(request_data.get('questionId'))  # 题目id
+            user_answer = str(request_data.get('userAnswer'))  # 用户回答
     except Exception as e:
-        print(e)
+        print(f"参数解析失败. Exception: {e}")
+        trace.finish("bad_request")
         return formatted_response(success=False, msg="参数解析失败")
 
+    if doc_code is None:
+        # 旧版客户端只传 questionId：题号在所有文件中唯一时仍按题号查找
+        print(f"[deprecated] /dummy/mark 缺少docCode参数: 用户{user_id} 题目{question_id}，请同时提供题目所属的文件编号")
+
+    if services.question_bank is None:
+        trace.finish("unavailable")
+        return formatted_response(success=False, msg="题库未配置")
+
+    try:
+        with trace.span("question_bank"):
+            question = services.question_bank.get(None if doc_code is None else str(doc_code), question_id)
+    except Exception as e:
+        print(f"题库加载失败. Exception: {e}")
+        trace.finish("question_bank_error")
+        return formatted_response(success=False, msg="题库加载失败")
+    if question is None and doc_code is None and len(services.question_bank.doc_codes_of(question_id)) > 1:
+        trace.finish("bad_request")
+        return formatted_response(success=False, msg="题号在多个文件中重复，请同时提供题目所属的文件编号docCode")
+    if question is None:
+        trace.finish("not_found")
+        return formatted_response(success=False, msg="题目不存在")
+
+    try:
+        result = services.mark(question, user_answer, trace)
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        print(f"LLM接口请求失败. Exception: {e}")
+        trace.finish("llm_error")
+        return formatted_response(success=False, msg="语言模型评分失败")
+
+    print(f"用户:{user_id} 部门:{user_type}\n题目:{question.doc_code}/{question_id}\n回答:{user_answer}\n得分:{result.score}")
     data = {
-        "score": 5.0,
-        "reference": f'收到了{user_id}对于问题{question_id}的回答，用户回答内容是<{user_answer}>。我们暂时还没有评分，敬请期待！',
+        "score": result.score,
+        "fullScore": services.question_bank.full_score,
+        "correct": result.correct,
+        "reference": result.reference,
     }
+    trace.finish("ok")
     return formatted_response(success=True, msg="回复成功", data=data)
 
 
-@app.route('/qa', methods=['GET', 'POST'])
+@bp.route('/dummy/mark/batch', methods=['POST'])
+def dummy_mark_sheet():
+    """
+    Marking API for a whole answer sheet of one document.
+    :return: score of each answer and total score
+    """
+    from admission import AdmissionRejected
+
+    services = get_services()
+    trace = start_trace('/dummy/mark/batch')
+    try:
+        with trace.span("parse"):
+            request_data = request.get_json()  # 获取 JSON 数据
+            user_id = int(request_data.get('userId'))  # 用户id
+            doc_code = str(request_data['docCode'])  # 试卷所属文件编号
+            answers = [
+                (int(answer['questionId']), str(answer['userAnswer']))  # 题目id, 用户回答
+                for answer in request_data['answers']
+            ]
+            if not 0 < len(answers) <= services.max_batch_size:
+                raise ValueError(f"Expected 1 to {services.max_batch_size} answers, got {len(answers)}")
+    except Exception as e:
+        print(f"参数解析失败. Exception: {e}")
+        trace.finish("bad_request")
+        return formatted_response(success=False, msg="参数解析失败")
+
+    if services.question_bank is None:
+        trace.finish("unavailable")
+        return formatted_response(success=False, msg="题库未配置")
+
+    try:
+        with trace.span("question_bank"):
+            questions = [services.question_bank.get(doc_code, question_id) for question_id, _ in answers]
+    except Exception as e:
+        print(f"题库加载失败. Exception: {e}")
+        trace.finish("question_bank_error")
+        return formatted_response(success=False, msg="题库加载失败")
+    unknown = [question_id for (question_id, _), question in zip(answers, questions) if question is None]
+    if unknown:
+        print(f"题目不存在: {doc_code} {unknown}")
+        trace.finish("not_found")
+        return formatted_response(success=False, msg="题目不存在")
+
+    results = services.mark_sheet(
+        [(question, user_answer) for question, (_, user_answer) in zip(questions, answers)], trace
+    )
+
+    # Like /qa/batch, a failed or shed LLM call only fails its own answer
+    items = []
+    num_failed = 0
+    for (question_id, _), (result, error) in zip(answers, results):
+        if error is None:
+            items.append({
+                "questionId": result.question_id,
+                "score": result.score,
+                "correct": result.correct,
+                "reference": result.reference,
+            })
+            continue
+        num_failed += 1
+        if isinstance(error, AdmissionRejected):
+            item = formatted_response(success=False, msg="服务繁忙，请稍后重试", code=429)
+            item["retryAfter"] = error.retry_after
+        else:
+            print(f"LLM接口请求失败. Exception: {error}")
+            item = formatted_response(success=False, msg="语言模型评分失败")
+        del item["data"]
+        items.append({"questionId": question_id, **item})
+
+    total_score = sum(result.score for result, error in results if error is None)
+    print(f"用户:{user_id} 试卷:{doc_code} {len(results)}题 得分:{total_score} 评分失败:{num_failed}题")
+    data = {
+        "totalScore": total_score,
+        "fullScore": services.question_bank.full_score * len(results),
+        "failed": num_failed,
+        "results": items,
+    }
+    trace.finish("partial" if num_failed else "ok")
+    return formatted_response(success=True, msg="部分题目评分失败" if num_failed else "回复成功", data=data)
+
+
+@bp.route('/exam/paper', methods=['GET', 'POST'])
+def exam_paper():
+    """
+    Exam paper API: a random paper of one document, or of all the documents of the user's department.
+    The same seed gives the same paper until the questions change.
+    :return: paper, without the correct options
+    """
+    services = get_services()
+    trace = start_trace('/exam/paper')
+    try:
+        with trace.span("parse"):
+            request_data = request.get_json()  # 获取 JSON 数据
+            user_id = int(request_data.get('userId'))  # 用户id
+            user_type = str(request_data.get('userType'))  # 用户所属部门
+            doc_code = request_data.get('docCode')  # 文件编号，省略时从部门的所有文件中出题
+            seed = request_data.get('seed')  # 试卷编号，省略时随机生成
+            seed = int(seed) if seed is not None else random.getrandbits(31)
+    except Exception as e:
+        print(f"参数解析失败. Exception: {e}")
+        trace.finish("bad_request")
+        return formatted_response(success=False, msg="参数解析失败")
+
+    assembler = services.exam_assembler
+    if assembler is None:
+        trace.finish("unavailable")
+        return formatted_response(success=False, msg="题库未配置")
+
+    department_doc_codes = assembler.department_doc_codes(user_type)
+    if doc_code is not None and department_doc_codes is not None and str(doc_code) not in department_doc_codes:
+        trace.finish("forbidden")
+        return formatted_response(success=False, msg="文件不属于该部门")
+
+    try:
+        with trace.span("exam_paper"):
+            if doc_code is not None:
+                paper = assembler.document_paper(str(doc_code), seed)
+            else:
+                paper = assembler.department_paper(user_type, seed)
+    except Exception as e:
+        print(f"试卷生成失败. Exception: {e}")
+        trace.finish("exam_error")
+        return formatted_response(success=False, msg="试卷生成失败")
+    if paper is None:
+        trace.finish("not_found")
+        return formatted_response(success=False, msg="没有可用的题目")
+
+    print(f"用户:{user_id} 部门:{user_type} 试卷:{seed} {len(paper['questions'])}题")
+    trace.finish("ok")
+    return formatted_response(success=True, msg="回复成功", data=paper)
+
+
+@bp.route('/stats/embedding_cache', methods=['GET'])
+def embedding_cache_stats():
+    return formatted_response(success=True, msg="查询成功", data=get_services().embedding_cache.stats())
+
+
+@bp.route('/stats/pools', methods=['GET'])
+def pool_stats():
+    return formatted_response(success=True, msg="查询成功", data=get_services().pools.stats())
+
+
+@bp.route('/stats/answer_cache', methods=['GET'])
+def answer_cache_stats():
+    answer_cache = get_services().answer_cache
+    data = answer_cache.stats() if answer_cache is not None else None
+    return formatted_response(success=True, msg="查询成功", data=data)
+
+
+@bp.route('/stats/admission', methods=['GET'])
+def admission_stats():
+    admission = get_services().admission
+    data = admission.stats() if admission is not None else None
+    return formatted_response(success=True, msg="查询成功", data=data)
+
+
+@bp.route('/stats/retrieval', methods=['GET'])
+def retrieval_stats():
+    retriever = get_services().retriever
+    data = retriever.stats() if retriever is not None else None
+    return formatted_response(success=True, msg="查询成功", data=data)
+
+
+@bp.route('/stats/question_bank', methods=['GET'])
+def question_bank_stats():
+    question_bank = get_services().question_bank
+    data = question_bank.stats() if question_bank is not None else None
+    return formatted_response(success=True, msg="查询成功", data=data)
+
+
+@bp.route('/stats/exam', methods=['GET'])
+def exam_stats():
+    exam_assembler = get_services().exam_assembler
+    data = exam_assembler.stats() if exam_assembler is not None else None
+    return formatted_response(success=True, msg="查询成功", data=data)
+
+
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
+
+@bp.route('/qa', methods=['GET', 'POST'])
 def qa_chat():
     """
     QA chat API.
     :return: Answer
     """
-    time1 = time.time()
+    services = get_services()
+    trace = start_trace('/qa')
     """Get request parameters"""
     try:
-        request_data = request.get_json()  # 获取 JSON 数据
-        user_id = str(request_data['userId'])  # 用户id
-        user_question = str(request_data['userQuestion'])  # 用户消息
-        message_id = str(request_data['messageId'])  # 消息id
+        with trace.span("parse"):
+            request_data = request.get_json()  # 获取 JSON 数据
+            user_id = str(request_data['userId'])  # 用户id
+            user_question = str(request_data['userQuestion'])  # 用户消息
+            message_id = str(request_data['messageId'])  # 消息id
     except Exception as e:
         print(f"参数解析失败. Exception: {e}")
+        trace.finish("bad_request")
         return formatted_response(success=False, msg="参数解析失败")
 
-    time2 = time.time()
-    print(f"1.参数解析耗时: {time2 - time1}")
-
     """Retrieve similar vectors from database"""
     try:
-        embedded_query = get_text_embedding(text=user_question, embedding_model_name=EMBEDDING_MODEL_NAME)
-        points = get_qdrant_client().retrieve_similar_vectors(embedded_query, top_k=1)
-        context_text = " ".join([point['page_content'] for point in points])
+        embedded_query, cached_answer, context_text = services.retrieve_context(user_question, trace)
     except Exception as e:
         print(f"向量数据库检索失败. Exception: {e}")
+        trace.finish("retrieval_error")
         return formatted_response(success=False, msg="向量数据库检索失败")
 
-    ########################################
-    # 向量数据库检索超时处理
-    ########################################
-
-    time3 = time.time()
-    print(f"2.向量数据库检索耗时: {time3 - time2}")
     print(f"\t向量数据库中检索到的文本长度: {len(context_text)}")
 
     """Generate response from LLM"""
-    try:
-        openai_response = get_openai_response(
-            context_text=context_text,
-            user_question=user_question,
-            llm_model_name=CHAT_MODEL_NAME,
-            is_stream=False
-        )
-    except Exception as e:
-        print(f"LLM接口请求失败. Exception: {e}")
-        return formatted_response(success=False, msg="语言模型生成回复失败")
+    if cached_answer is not None:
+        print("\t命中答案缓存")
+        openai_response = cached_answer
+    else:
+        ticket = services.acquire_llm_slot(trace)
+        try:
+            with trace.span("llm_total"):
+                openai_response = services.answer(
+                    context_text=context_text,
+                    user_question=user_question,
+                    is_stream=False
+                )
+        except Exception as e:
+            print(f"LLM接口请求失败. Exception: {e}")
+            trace.finish("llm_error")
+            return formatted_response(success=False, msg="语言模型生成回复失败")
+        finally:
+            services.release_llm_slot(ticket)
+
+        if services.caches_answer(embedded_query):
+            services.answer_cache.store(user_question, embedded_query, openai_response)
 
-    time4 = time.time()
-    print(f"3.语言模型生成回复耗时: {time4 - time3}")
     data = {"answer": openai_response}
     print(f"用户:{user_id}\n问题:{user_question}\n回答:{openai_response}")
 
     """Redis存储聊天记录"""
-    redis_client = get_redis_client()
-    r_key = redis_client.key_chat_history.format(user_id)
-    redis_client.lpush(r_key, user_question)
-    redis_client.lpush(r_key, openai_response)
-    redis_client.ltrim(r_key, 0, CHAT_MEMORY_LEN - 1)  # 使用 LTRIM 修剪列表保持长度
-    redis_client.expire(r_key, 1800)  # 设置TTL为1800秒（30 分钟)
+    with trace.span("redis_write"):
+        services.chat_memory.append(user_id, UserMessage(user_question), AssistantMessage(openai_response))
 
+    trace.finish("cached" if cached_answer is not None else "ok")
     return formatted_response(success=True, msg="回复成功", data=data)
 
 
-@app.route('/qa/stream', methods=['GET', 'POST'])
+@bp.route('/qa/stream', methods=['GET', 'POST'])
 def qa_chat_stream():
     """
     QA chat API in stream mode.
@@ -177,84 +402,282 @@ def qa_chat_stream():
         :param stream_response_generator: OpenAI ChatCompletion API in stream mode.
         :param chunk_size: Chunk size for each response.
         """
-        buffer, buffer_all = "", ""
-        index = 0
-        for chunk in stream_response_generator:
-            chunk = chunk['choices'][0].get('delta', {}).get('content', '')
-            buffer += chunk
-            buffer_all += chunk
-            # print(f"{index} Buffer:{buffer}")
-            index += 1
-            if len(buffer) >= chunk_size:
-                buffer = buffer.replace('\n', r'\n')
-                yield 'data: %s\n\n' % buffer
-                buffer = ""
-        if buffer:
-            buffer = buffer.replace('\n', r'\n')
-            yield 'data: %s\n\n' % buffer
-
-        redis_client.lpush(r_key, buffer_all)
-        redis_client.ltrim(r_key, 0, CHAT_MEMORY_LEN - 1)  # 使用 LTRIM 修剪列表保持长度
-        redis_client.expire(r_key, 1800)  # 设置TTL为1800秒（30 分钟)
+        nonlocal stream_started
+        stream_started = True
+        # A message posted again without Last-Event-ID is a new generation
+        journal = services.stream_journal.start(message_id)
+        encoder = SSEEncoder(max_chunk_size=chunk_size, max_delay=flush_interval, start_time=time1)
+
+        def timed_tokens():
+            first_token = True
+            for token in iter_openai_tokens(stream_response_generator):
+                if first_token:
+                    trace.observe("llm_first_token", time.perf_counter() - llm_start_time, llm_start_time)
+                    first_token = False
+                yield token
+
+        chunks = enumerate(encoder.chunks(timed_tokens()), start=1)
+
+        def finish(last_seq: int, status: str) -> None:
+            services.release_llm_slot(ticket)
+            trace.observe("llm_total", time.perf_counter() - llm_start_time, llm_start_time)
+            if encoder.ttfb is not None:
+                trace.observe("first_event", encoder.ttfb, trace.start_time)
+            journal.finish(last_seq)
+
+            answer = encoder.text
+            # Streamed completions carry no usage field
+            LLM_TOKENS.inc(services.context_builder.count_tokens(answer), call="answer", kind="completion")
+            with trace.span("redis_write"):
+                services.chat_memory.append(user_id, UserMessage(user_question), AssistantMessage(answer))
+
+            # Answers conditioned on earlier turns are not reusable for other users
+            if services.caches_answer(embedded_query, chat_history):
+                services.answer_cache.store(user_question, embedded_query, answer)
+            trace.finish(status)
+
+        def drain(last_seq: int) -> None:
+            try:
+                for last_seq, chunk in chunks:
+                    journal.append(last_seq, chunk)
+                finish(last_seq, "client_closed")
+            except Exception as e:
+                print(f"后台生成回复失败. Exception: {e}")
+                services.release_llm_slot(ticket)
+                trace.finish("llm_error")
+
+        seq = 0
+        try:
+            for seq, chunk in chunks:
+                journal.append(seq, chunk)
+                yield format_event(chunk, event_id=str(seq))
+        except GeneratorExit:
+            # The client went away: finish the generation in the background so that a
+            # reconnect with Last-Event-ID can be served from the journal
+            services.background_executor.submit(drain, seq)
+            raise
+        except Exception:
+            services.release_llm_slot(ticket)
+            trace.finish("llm_error")
+            raise
+        finish(seq, "ok")
+
+    def replay_stream_response(answer: str):
+        """
+        Replay a cached answer as SSE.
+        :param answer: cached answer
+        """
+        try:
+            journal = services.stream_journal.start(message_id)
+            journal.append(1, answer)
+            journal.finish(1)
+            yield format_event(answer, event_id="1")
+
+            with trace.span("redis_write"):
+                services.chat_memory.append(user_id, UserMessage(user_question), AssistantMessage(answer))
+        finally:
+            trace.finish("cached")
+
+    def resume_stream_response(last_seq: int):
+        """
+        Serve the events after ``last_seq`` from the journal, without calling the LLM again.
+        :param last_seq: last event id received by the client
+        """
+        try:
+            for seq, chunk in services.stream_journal.read(message_id, last_seq):
+                yield format_event(chunk, event_id=str(seq))
+        finally:
+            trace.finish("resumed")
 
     """Get request parameters"""
     time1 = time.time()
+    services = get_services()
+    flush_interval = current_app.config["RESPONSE_FLUSH_INTERVAL"]
+    trace = start_trace('/qa/stream')
     try:
-        request_data = request.get_json()  # 获取 JSON 数据
-        user_id = str(request_data['userId'])  # 用户id
-        user_question = str(request_data['userQuestion'])  # 用户消息
-        message_id = str(request_data['messageId'])  # 消息id
+        with trace.span("parse"):
+            request_data = request.get_json()  # 获取 JSON 数据
+            user_id = str(request_data['userId'])  # 用户id
+            user_question = str(request_data['userQuestion'])  # 用户消息
+            message_id = str(request_data['messageId'])  # 消息id
+            last_event_id = services.stream_journal.parse_event_id(
+                request.headers.get('Last-Event-ID', request_data.get('lastEventId'))
+            )
     except Exception as e:
         print(f"参数解析失败. Exception: {e}")
+        trace.finish("bad_request")
         return formatted_response(success=False, msg="参数解析失败")
 
-    time2 = time.time()
-    print(f"1.参数解析耗时: {time2 - time1}")
+    """Resume an interrupted stream"""
+    if last_event_id is not None and services.stream_journal.exists(message_id):
+        print(f"\t从事件{last_event_id}恢复消息{message_id}的回复")
+        return Response(response=resume_stream_response(last_event_id), mimetype='text/event-stream')
+
+    # Load chat history from redis
+    with trace.span("history_fetch"):
+        chat_history = services.chat_memory.get(user_id)
+    print(chat_history)
 
     """Retrieve similar vectors from database"""
     try:
-        embedded_query = get_text_embedding(text=user_question, embedding_model_name=EMBEDDING_MODEL_NAME)
-        points = get_qdrant_client().retrieve_similar_vectors(embedded_query, top_k=1)
-        context_text = " ".join([point['page_content'] for point in points])
+        # Same rule as the answer cache store: answers to follow-up questions are not shared
+        embedded_query, cached_answer, context_text = services.retrieve_context(
+            user_question, trace, use_answer_cache=not chat_history
+        )
     except Exception as e:
         print(f"向量数据库检索失败. Exception: {e}")
+        trace.finish("retrieval_error")
         return formatted_response(success=False, msg="向量数据库检索失败")
 
-    ########################################
-    # 向量数据库检索超时处理
-    ########################################
-
-    time3 = time.time()
-    print(f"2.向量数据库检索耗时: {time3 - time2}")
     print(f"\t向量数据库中检索到的文本长度: {len(context_text)}")
 
     """Generate response from LLM"""
-    # Load chat history from redis
-    redis_client = get_redis_client()
-    r_key = redis_client.key_chat_history.format(user_id)
-    redis_client.lpush(r_key.format(user_id), user_question)
+    if cached_answer is not None:
+        print("\t命中答案缓存")
+        return Response(
+            response=replay_stream_response(cached_answer),
+            mimetype='text/event-stream'
+        )
 
-    chat_history = redis_client.get_chat_history(user_id=user_id)
-    print(chat_history)
+    ticket = services.acquire_llm_slot(trace)
 
+    def release_unstarted_stream() -> None:
+        # A stream closed before its first iteration never reaches its own clean-up
+        if not stream_started:
+            services.release_llm_slot(ticket)
+            trace.finish("client_closed")
+
+    stream_started = False
     try:
+        llm_start_time = time.perf_counter()
         stream_response = get_stream_response(
-            stream_response_generator=get_openai_response(
+            stream_response_generator=services.answer(
                 context_text=context_text,
                 user_question=user_question,
-                llm_model_name=CHAT_MODEL_NAME,
                 is_stream=True,
                 chat_history=chat_history,
             ),
             chunk_size=RESPONSE_CHUNK_SIZE,
             user_id=user_id
         )
-        return Response(response=stream_response, mimetype='text/event-stream')
+        response = Response(response=stream_response, mimetype='text/event-stream')
+        response.call_on_close(release_unstarted_stream)
+        return response
 
     except Exception as e:
         print(f"LLM接口请求失败. Exception: {e}")
+        services.release_llm_slot(ticket)
+        trace.finish("llm_error")
         return formatted_response(success=False, msg="语言模型生成回复失败")
 
 
+@bp.route('/qa/batch', methods=['POST'])
+def qa_chat_batch():
+    """
+    Batch QA API: one NDJSON line per question, written as soon as its answer is ready.
+    """
+    services = get_services()
+    trace = start_trace('/qa/batch')
+    """Get request parameters"""
+    try:
+        with trace.span("parse"):
+            request_data = request.get_json()  # 获取 JSON 数据
+            user_id = str(request_data['userId'])  # 用户id
+            questions = [str(question) for question in request_data['questions']]  # 问题列表
+            if not 0 < len(questions) <= services.max_batch_size:
+                raise ValueError(f"Expected 1 to {services.max_batch_size} questions, got {len(questions)}")
+    except Exception as e:
+        print(f"参数解析失败. Exception: {e}")
+        trace.finish("bad_request")
+        return formatted_response(success=False, msg="参数解析失败")
+
+    print(f"/qa/batch 接受参数：{user_id} {len(questions)}个问题")
+
+    """Retrieve similar vectors from database"""
+    try:
+        results = services.answer_batch(questions, trace)
+    except Exception as e:
+        print(f"向量数据库检索失败. Exception: {e}")
+        trace.finish("retrieval_error")
+        return formatted_response(success=False, msg="向量数据库检索失败")
+
+    def stream_results():
+        from admission import AdmissionRejected
+
+        num_failed = 0
+        try:
+            for idx, answer, error in results:
+                if error is None:
+                    line = formatted_response(success=True, msg="回复成功", data={"question": questions[idx], "answer": answer})
+                elif isinstance(error, AdmissionRejected):
+                    num_failed += 1
+                    line = formatted_response(success=False, msg="服务繁忙，请稍后重试", code=429)
+                    line["retryAfter"] = error.retry_after
+                else:
+                    num_failed += 1
+                    print(f"LLM接口请求失败. Exception: {error}")
+                    line = formatted_response(success=False, msg="语言模型生成回复失败")
+                yield json.dumps({"index": idx, **line}, ensure_ascii=False) + "\n"
+        except GeneratorExit:
+            trace.finish("client_closed")
+            raise
+        trace.finish("partial" if num_failed else "ok")
+
+    response = Response(response=stream_results(), mimetype='application/x-ndjson')
+    # A response closed before its first iteration never reaches its own clean-up
+    response.call_on_close(lambda: trace.finish("client_closed"))
+    return response
+
+
+def create_app(config_path: str = "config.yaml", warm_up: bool = True, metrics_dir: Optional[str] = None) -> Flask:
+    """
+    Build the QA app and the long-lived services of this worker process.
+    :param config_path: path of config.yaml
+    :param warm_up: whether to open the connections and load the caches before returning; under a
+        pre-fork server, create the app in each worker, after the fork
+    :param metrics_dir: directory shared by the workers of a pre-fork server, so that /metrics
+        reports all of them; defaults to ``metrics.multiprocess_dir`` of config.yaml
+    :return: WSGI app
+    """
+    start_time = time.perf_counter()
+    # Heavy dependencies; a pre-fork launcher has already imported them in the master
+    from admission import AdmissionRejected
+    from services import QAServices, load_config
+    STARTUP_SECONDS.set(time.perf_counter() - start_time, phase="import")
+
+    phase_start_time = time.perf_counter()
+    config = load_config(config_path)
+    services = QAServices(config)
+    STARTUP_SECONDS.set(time.perf_counter() - phase_start_time, phase="services")
+
+    metrics_config = config.get('metrics', {})
+    metrics_dir = metrics_dir or metrics_config.get('multiprocess_dir')
+    if metrics_dir:
+        registry.enable_multiprocess(metrics_dir, flush_interval=metrics_config.get('flush_interval', 5.0))
+
+    if warm_up:
+        phase_start_time = time.perf_counter()
+        timings = services.warm_up()
+        STARTUP_SECONDS.set(time.perf_counter() - phase_start_time, phase="warm_up")
+        print("预热完成: " + ", ".join(f"{step} {seconds * 1000:.1f}ms" for step, seconds in timings.items()))
+
+    app = Flask(__name__)
+    app.config["TRACE_ENABLED"] = metrics_config.get('trace', False)  # 每个请求结束时打印各阶段耗时
+    app.config["RESPONSE_FLUSH_INTERVAL"] = config.get('stream', {}).get('flush_interval', 0.05)  # 最长缓冲时间（秒）
+    app.extensions["qa"] = services
+    app.register_blueprint(bp)
+    app.register_error_handler(AdmissionRejected, rejected_response)
+
+    registry.gauge(
+        "qa_cache_hit_ratio", "Hit ratio of the caches of this worker", ("cache",), function=services.cache_hit_ratios
+    )
+
+    ready_seconds = time.perf_counter() - start_time
+    STARTUP_SECONDS.set(ready_seconds, phase="ready")
+    print(f"Worker {os.getpid()} ready in {ready_seconds:.3f}s")
+    return app
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=7001, debug=True)
+    # Development server; use serve.py in production
+    create_app().run(host='0.0.0.0', port=7001)
@@ -0,0 +1,298 @@
+"""
+Asyncio serving path for the QA endpoints.
+
+Serve with an ASGI server, e.g. ``hypercorn api_async:app --bind 0.0.0.0:7001``. config.yaml
+(or ``app.config["QA_CONFIG_PATH"]``) is read when the server starts, not on import.
+A single event loop holds many open streams, and the Redis chat-history fetch runs
+concurrently with the embedding + vector search of each request.
+"""
+import asyncio
+import time
+from typing import AsyncGenerator, Optional
+
+from quart import Quart, request, Response, g
+
+from admission import AdmissionRejected, AsyncAdmissionTicket
+from metrics import CONTENT_TYPE, LLM_TOKENS, Trace, registry
+from schema import UserMessage, AssistantMessage
+from services import AsyncQAServices, load_config
+from sse import SSEEncoder, aiter_openai_tokens, format_event
+from responses import formatted_response
+
+RESPONSE_CHUNK_SIZE = 100
+
+# Built from config.yaml when the server starts, see configure
+config: dict
+services: AsyncQAServices
+RESPONSE_FLUSH_INTERVAL: float
+TRACE_ENABLED: bool
+
+
+def configure(config_path: str = "config.yaml") -> None:
+    """
+    Read config.yaml and build the caches and indexes of this process; importing the module
+    does not touch the configuration.
+    """
+    global config, services, RESPONSE_FLUSH_INTERVAL, TRACE_ENABLED
+
+    config = load_config(config_path)
+    services = AsyncQAServices(config)
+    RESPONSE_FLUSH_INTERVAL = config.get('stream', {}).get('flush_interval', 0.05)  # 最长缓冲时间（秒）
+
+    # ------------------------------------ Metrics ------------------------------------
+    metrics_config = config.get('metrics', {})
+    TRACE_ENABLED = metrics_config.get('trace', False)  # 每个请求结束时打印各阶段耗时
+    if metrics_config.get('multiprocess_dir'):
+        # Several hypercorn workers share the socket; empty the directory before starting them
+        registry.enable_multiprocess(metrics_config['multiprocess_dir'], flush_interval=metrics_config.get('flush_interval', 5.0))
+    registry.gauge("qa_cache_hit_ratio", "Hit ratio of the caches of this worker", ("cache",), function=services.cache_hit_ratios)
+
+
+# ------------------------------------ Quart ------------------------------------
+app = Quart(__name__)
+
+
+@app.before_serving
+async def create_clients():
+    # Async clients are bound to the event loop, so they are created once it is running
+    configure(app.config.get("QA_CONFIG_PATH", "config.yaml"))
+    await services.open()
+
+
+@app.after_serving
+async def close_clients():
+    await services.close()
+    # Final values: the counters of an exited worker keep counting in the totals, its snapshot is deleted
+    registry.retire()
+
+
+def start_trace(endpoint: str) -> Trace:
+    g.trace = Trace(endpoint, request_id=request.headers.get('X-Request-ID'), enabled=TRACE_ENABLED)
+    return g.trace
+
+
+@app.after_request
+async def add_request_id(response):
+    trace = g.get("trace")
+    if trace is not None:
+        response.headers['X-Request-ID'] = trace.request_id
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
+
+def release_when_served(ticket: Optional[AsyncAdmissionTicket], trace: Trace) -> None:
+    """
+    Release ``ticket`` once the task serving the request is done, whether the response was sent,
+    failed or was cancelled by a client going away, possibly before its body was iterated, in
+    which case the body's own clean-up never runs. The counterpart of ``call_on_close`` in ``api``.
+    """
+    if ticket is None:
+        return
+
+    def on_done(task: asyncio.Task) -> None:
+        # Releasing twice is a no-op
+        asyncio.ensure_future(services.release_llm_slot(ticket))
+        trace.finish("client_closed")
+
+    asyncio.current_task().add_done_callback(on_done)
+
+
+def rejected_response(e: AdmissionRejected):
+    print(f"请求被限流. Exception: {e}")
+    return (
+        formatted_response(success=False, msg="服务繁忙，请稍后重试", code=429),
+        429,
+        {"Retry-After": str(e.retry_after)}
+    )
+
+
+async def parse_request() -> tuple[str, str, str]:
+    request_data = await request.get_json()  # 获取 JSON 数据
+    user_id = str(request_data['userId'])  # 用户id
+    user_question = str(request_data['userQuestion'])  # 用户消息
+    message_id = str(request_data['messageId'])  # 消息id
+    return user_id, user_question, message_id
+
+
+async def fetch_chat_history(user_id: str, trace: Trace) -> list[dict]:
+    with trace.span("history_fetch"):
+        return await services.chat_memory.get(user_id)
+
+
+async def save_chat_turn(user_id: str, user_question: str, answer: str, trace: Trace) -> None:
+    with trace.span("redis_write"):
+        await services.chat_memory.append(user_id, UserMessage(user_question), AssistantMessage(answer))
+
+
+@app.route('/stats/admission', methods=['GET'])
+async def admission_stats():
+    data = services.admission.stats() if services.admission is not None else None
+    return formatted_response(success=True, msg="查询成功", data=data)
+
+
+@app.route('/qa', methods=['GET', 'POST'])
+async def qa_chat():
+    """
+    QA chat API.
+    :return: Answer
+    """
+    trace = start_trace('/qa')
+    """Get request parameters"""
+    try:
+        with trace.span("parse"):
+            user_id, user_question, message_id = await parse_request()
+    except Exception as e:
+        print(f"参数解析失败. Exception: {e}")
+        trace.finish("bad_request")
+        return formatted_response(success=False, msg="参数解析失败")
+
+    """Retrieve similar vectors from database"""
+    try:
+        embedded_query, cached_answer, context_text = await services.retrieve_context(user_question, trace)
+    except Exception as e:
+        print(f"向量数据库检索失败. Exception: {e}")
+        trace.finish("retrieval_error")
+        return formatted_response(success=False, msg="向量数据库检索失败")
+
+    """Generate response from LLM"""
+    if cached_answer is not None:
+        openai_response = cached_answer
+    else:
+        try:
+            ticket = await services.acquire_llm_slot(trace)
+        except AdmissionRejected as e:
+            trace.finish("rejected")
+            return rejected_response(e)
+
+        try:
+            with trace.span("llm_total"):
+                openai_response = await services.answer(context_text=context_text, user_question=user_question)
+        except Exception as e:
+            print(f"LLM接口请求失败. Exception: {e}")
+            trace.finish("llm_error")
+            return formatted_response(success=False, msg="语言模型生成回复失败")
+        finally:
+            await services.release_llm_slot(ticket)
+
+        if services.caches_answer(embedded_query):
+            await services.answer_cache.store(user_question, embedded_query, openai_response)
+
+    """Redis存储聊天记录"""
+    await save_chat_turn(user_id, user_question, openai_response, trace)
+
+    trace.finish("cached" if cached_answer is not None else "ok")
+    return formatted_response(success=True, msg="回复成功", data={"answer": openai_response})
+
+
+@app.route('/qa/stream', methods=['GET', 'POST'])
+async def qa_chat_stream():
+    """
+    QA chat API in stream mode.
+
+    Unlike the Flask path, the events are not journaled: a client that reconnects with
+    Last-Event-ID gets a new answer. Resuming is out of scope here until the journal has an
+    asyncio client.
+    """
+    async def timed_tokens(stream_response_generator: AsyncGenerator):
+        first_token = True
+        async for token in aiter_openai_tokens(stream_response_generator):
+            if first_token:
+                trace.observe("llm_first_token", time.perf_counter() - llm_start_time, llm_start_time)
+                first_token = False
+            yield token
+
+    async def get_stream_response(stream_response_generator: AsyncGenerator, chunk_size: int = 70):
+        encoder = SSEEncoder(max_chunk_size=chunk_size, max_delay=RESPONSE_FLUSH_INTERVAL, start_time=time1)
+        try:
+            async for event in encoder.aencode(timed_tokens(stream_response_generator)):
+                yield event
+        except Exception:
+            trace.finish("llm_error")
+            raise
+        except BaseException:
+            # Cancellation of a stream whose client went away
+            trace.finish("client_closed")
+            raise
+        finally:
+            await services.release_llm_slot(ticket)
+        trace.observe("llm_total", time.perf_counter() - llm_start_time, llm_start_time)
+        if encoder.ttfb is not None:
+            trace.observe("first_event", encoder.ttfb, trace.start_time)
+
+        answer = encoder.text
+        # Streamed completions carry no usage field
+        LLM_TOKENS.inc(services.context_builder.count_tokens(answer), call="answer", kind="completion")
+        await save_chat_turn(user_id, user_question, answer, trace)
+        if services.caches_answer(embedded_query, chat_history):
+            await services.answer_cache.store(user_question, embedded_query, answer)
+        trace.finish("ok")
+
+    async def replay_stream_response(answer: str):
+        try:
+            yield format_event(answer)
+            await save_chat_turn(user_id, user_question, answer, trace)
+        finally:
+            trace.finish("cached")
+
+    """Get request parameters"""
+    time1 = time.time()
+    trace = start_trace('/qa/stream')
+    try:
+        with trace.span("parse"):
+            user_id, user_question, message_id = await parse_request()
+    except Exception as e:
+        print(f"参数解析失败. Exception: {e}")
+        trace.finish("bad_request")
+        return formatted_response(success=False, msg="参数解析失败")
+
+    """Fetch chat history while retrieving similar vectors"""
+    history_fetch = asyncio.ensure_future(fetch_chat_history(user_id, trace))
+    try:
+        embedded_query, cached_answer, context_text = await services.retrieve_context(user_question, trace, history_fetch)
+        chat_history = await history_fetch
+    except Exception as e:
+        history_fetch.cancel()
+        print(f"向量数据库检索失败. Exception: {e}")
+        trace.finish("retrieval_error")
+        return formatted_response(success=False, msg="向量数据库检索失败")
+
+    if cached_answer is not None:
+        return Response(
+            replay_stream_response(cached_answer),
+            mimetype='text/event-stream'
+        )
+
+    """Generate response from LLM"""
+    try:
+        ticket = await services.acquire_llm_slot(trace)
+    except AdmissionRejected as e:
+        trace.finish("rejected")
+        return rejected_response(e)
+    release_when_served(ticket, trace)
+
+    try:
+        llm_start_time = time.perf_counter()
+        stream_response_generator = await services.answer(
+            context_text=context_text,
+            user_question=user_question,
+            is_stream=True,
+            chat_history=chat_history,
+        )
+    except Exception as e:
+        print(f"LLM接口请求失败. Exception: {e}")
+        await services.release_llm_slot(ticket)
+        trace.finish("llm_error")
+        return formatted_response(success=False, msg="语言模型生成回复失败")
+
+    return Response(
+        get_stream_response(stream_response_generator, chunk_size=RESPONSE_CHUNK_SIZE),
+        mimetype='text/event-stream'
+    )
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=7001)
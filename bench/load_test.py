@@ -0,0 +1,332 @@
+"""
+Offline load test of the QA API.
+
+OpenAI, Qdrant and Redis are replaced by the deterministic stand-ins of ``bench.stubs``, the
+document collection is filled from local .txt files, and the Flask app is served on a local
+port. A JSONL request corpus (one ``{"userId", "userQuestion", "messageId"}`` object per line)
+is replayed against ``/qa`` and ``/qa/stream``, and the latency percentiles, time to first
+SSE event, throughput and per-stage breakdown are reported.
+
+Usage: python -m bench.load_test [--corpus questions.jsonl] [--requests 200] [--concurrency 8]
+       [--endpoint both] [--token-delay-ms 20] [--first-token-ms 300] [--embedding-ms 50]
+"""
+import argparse
+import contextlib
+import glob
+import http.client
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import yaml
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from . import stubs
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The API modules are imported after changing into the work dir
+sys.path.insert(0, REPO_ROOT)
+DOCUMENT_COLLECTION_NAME = "documents"
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs) -> None:
+        pass
+
+
+def split_chunks(text: str, chunk_size: int = 300) -> list[str]:
+    """
+    Pack whole lines into chunks of at most ``chunk_size`` characters
+    """
+    chunks, current = [], ""
+    for line in filter(None, map(str.strip, text.split("\n"))):
+        if current and len(current) + len(line) + 1 > chunk_size:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def load_documents(pattern: str) -> list[tuple[str, str]]:
+    """
+    :return: (source, chunk) of every chunk of the files matching ``pattern``
+    """
+    chunks = []
+    for filepath in sorted(glob.glob(pattern, recursive=True)):
+        with open(filepath, "r", encoding="utf-8") as f:
+            chunks.extend((os.path.abspath(filepath), chunk) for chunk in split_chunks(f.read()))
+    return chunks
+
+
+def generate_corpus(chunks: list[tuple[str, str]], num_questions: int, num_users: int, seed: int = 0) -> list[dict]:
+    """
+    Questions about the topics of the knowledge points (``-- topic | content`` lines), with a
+    long tail: a few topics are asked much more often than the others.
+    """
+    topics = []
+    for _, chunk in chunks:
+        for line in chunk.split("\n"):
+            topic = line.lstrip("- ").split("|")[0].strip()
+            if topic:
+                topics.append(topic)
+
+    rng = random.Random(seed)
+    templates = ["{}是什么？", "请介绍一下{}", "关于{}有哪些规定？", "{}的要求是什么"]
+    weights = [1 / (rank + 1) for rank in range(len(topics))]
+    return [
+        {
+            "userId": f"user-{rng.randrange(num_users)}",
+            "userQuestion": rng.choice(templates).format(rng.choices(topics, weights=weights)[0]),
+        }
+        for _ in range(num_questions)
+    ]
+
+
+def load_corpus(path: str) -> list[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_config(work_dir: str, args: argparse.Namespace) -> None:
+    config = {
+        "openai": {"chat_model": "gpt-3.5-turbo", "embedding_model": "text-embedding-ada-002"},
+        "qdrant": {
+            "url": "http://qdrant.invalid:6333",
+            "embedding_dim": args.embedding_dim,
+            "document_collection_name": DOCUMENT_COLLECTION_NAME,
+            "answer_cache_collection_name": "answer_cache",
+            "local_index_path": os.path.join(work_dir, "vecdb_index"),
+            "retrieval": {"timeout": args.search_timeout, "hedge": not args.no_hedging},
+        },
+        "redis": {"host": "localhost", "port": 6379, "password": None},
+        "answer_cache": {"enabled": args.answer_cache},
+        "embedding_batch": {"enabled": not args.no_batching},
+        "lexical": {"enabled": not args.no_lexical},
+        "chat_memory": {"mode": args.memory_mode},
+        "admission": {"max_in_flight": args.max_in_flight, "max_queue": args.max_queue, "max_wait": args.max_wait},
+        # Similarities of the hashed stand-in embeddings are much lower than those of real ones
+        "context": {"score_threshold": args.score_threshold},
+    }
+    with open(os.path.join(work_dir, "config.yaml"), "w", encoding="utf-8") as f:
+        yaml.safe_dump(config, f, allow_unicode=True)
+
+
+def send_request(port: int, endpoint: str, payload: dict, timeout: float) -> dict:
+    """
+    POST one question and read the whole response.
+    :return: latency, time to first SSE event (streams only), success flag, shed flag (429)
+    """
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    start_time = time.perf_counter()
+    ttfe = None
+    shed = False
+    try:
+        connection.request(
+            "POST",
+            endpoint,
+            body=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+            headers={"Content-Type": "application/json"}
+        )
+        response = connection.getresponse()
+        shed = response.status == 429
+        if response.getheader("Content-Type", "").startswith("text/event-stream"):
+            ok = True
+            while True:
+                line = response.readline()
+                if not line:
+                    break
+                if ttfe is None and line.startswith(b"data:"):
+                    ttfe = time.perf_counter() - start_time
+        else:
+            ok = response.status == 200 and json.loads(response.read()).get("code") == 200
+    except Exception as e:
+        print(f"Request to {endpoint} failed. Exception: {e}")
+        ok = False
+    finally:
+        connection.close()
+
+    return {"latency": time.perf_counter() - start_time, "ttfe": ttfe, "ok": ok, "shed": shed}
+
+
+def percentiles(values: list[float]) -> str:
+    if not values:
+        return "-"
+    values_ms = np.asarray(values) * 1000
+    return "  ".join(
+        f"p{q} {np.percentile(values_ms, q):8.1f}ms" for q in (50, 95, 99)
+    )
+
+
+def run_load(port: int, endpoint: str, corpus: list[dict], num_requests: int, concurrency: int, timeout: float) -> dict:
+    results = []
+    lock = threading.Lock()
+
+    def worker(idx: int) -> None:
+        payload = {**corpus[idx % len(corpus)], "messageId": f"bench-{endpoint}-{idx}-{time.time_ns()}"}
+        result = send_request(port, endpoint, payload, timeout)
+        with lock:
+            results.append(result)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(num_requests)))
+    elapsed = time.perf_counter() - start_time
+
+    succeeded = [result for result in results if result["ok"]]
+    return {
+        "requests": len(results),
+        "errors": sum(not result["ok"] and not result["shed"] for result in results),
+        "shed": sum(result["shed"] for result in results),
+        "elapsed": elapsed,
+        "throughput": len(succeeded) / elapsed,
+        "latencies": [result["latency"] for result in succeeded],
+        "ttfes": [result["ttfe"] for result in succeeded if result["ttfe"] is not None],
+    }
+
+
+def print_stages(stages: dict[str, list[float]], num_requests: int) -> None:
+    print(f"  {'stage':<26}{'calls':>7}{'per req':>9}{'mean':>11}   percentiles")
+    for stage, values in sorted(stages.items()):
+        if stage in ("embedding_batch_size", "llm_prompt_chars", "llm_summary_prompt_chars"):
+            print(f"  {stage:<26}{len(values):>7}{len(values) / num_requests:>9.2f}{np.mean(values):>11.1f}")
+            continue
+        print(
+            f"  {stage:<26}{len(values):>7}{len(values) / num_requests:>9.2f}"
+            f"{np.mean(values) * 1000:>9.1f}ms   {percentiles(values)}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", help="JSONL request corpus; generated from the documents if omitted")
+    parser.add_argument("--save-corpus", help="write the generated corpus to this file")
+    parser.add_argument("--docs", default=os.path.join(REPO_ROOT, "*知识点.txt"), help="glob of the .txt documents")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--endpoint", choices=["qa", "stream", "both"], default="both")
+    parser.add_argument("--users", type=int, default=50, help="distinct users of the generated corpus")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests per endpoint")
+    parser.add_argument("--embedding-dim", type=int, default=1536)
+    parser.add_argument("--embedding-ms", type=float, default=50.0, help="latency of an embedding call")
+    parser.add_argument("--first-token-ms", type=float, default=300.0, help="LLM time to first token")
+    parser.add_argument("--token-delay-ms", type=float, default=20.0, help="LLM delay between streamed tokens")
+    parser.add_argument("--answer-tokens", type=int, default=120)
+    parser.add_argument("--answer-cache", action="store_true", help="enable the semantic answer cache")
+    parser.add_argument("--no-batching", action="store_true", help="disable embedding micro-batching")
+    parser.add_argument("--no-lexical", action="store_true", help="disable the lexical fast path")
+    parser.add_argument("--memory-mode", choices=["summary", "window"], default="summary")
+    parser.add_argument("--search-spike-rate", type=float, default=0.0, help="share of slow vector searches")
+    parser.add_argument("--search-spike-ms", type=float, default=2000.0, help="latency of a slow vector search")
+    parser.add_argument("--search-timeout", type=float, default=1.0, help="deadline of the vector search")
+    parser.add_argument("--no-hedging", action="store_true", help="disable hedged vector searches")
+    parser.add_argument("--max-in-flight", type=int, default=64, help="LLM calls admitted at once")
+    parser.add_argument("--max-queue", type=int, default=64, help="requests waiting for an LLM call slot")
+    parser.add_argument("--max-wait", type=float, default=10.0, help="maximum wait for an LLM call slot")
+    parser.add_argument("--score-threshold", type=float, default=0.1, help="similarity cut of the retrieval")
+    parser.add_argument("--verbose", action="store_true", help="show the API's own output")
+    parser.add_argument("--dump-metrics", action="store_true", help="print the API's /metrics after the run")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    chunks = load_documents(args.docs)
+    if not chunks:
+        sys.exit(f"No documents match {args.docs}")
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+    else:
+        corpus = generate_corpus(chunks, num_questions=max(args.requests, 100), num_users=args.users, seed=args.seed)
+        if args.save_corpus:
+            with open(args.save_corpus, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(request, ensure_ascii=False) + "\n" for request in corpus)
+
+    # ------------------------------------ Stand-ins ------------------------------------
+    recorder = stubs.StageRecorder()
+    fake_openai = stubs.FakeOpenAI(
+        recorder,
+        embedding_dim=args.embedding_dim,
+        embedding_latency=args.embedding_ms / 1000,
+        first_token_latency=args.first_token_ms / 1000,
+        token_delay=args.token_delay_ms / 1000,
+        answer_tokens=args.answer_tokens
+    )
+    vecdb_clients = stubs.install(
+        fake_openai,
+        args.embedding_dim,
+        spike_rate=args.search_spike_rate,
+        spike_latency=args.search_spike_ms / 1000
+    )
+
+    work_dir = tempfile.mkdtemp(prefix="qa-bench-")
+    write_config(work_dir, args)
+    os.chdir(work_dir)
+
+    import context_builder
+    try:
+        context_builder.get_encoding("gpt-3.5-turbo")
+    except Exception:
+        # The BPE tables are downloaded on first use; offline, count characters instead
+        print("tiktoken encoding unavailable offline, counting tokens as characters")
+        context_builder.get_encoding = lambda model_name: stubs.CharEncoding()
+
+    import api
+    from retrieval import LexicalIndex
+
+    # ------------------------------------ Documents ------------------------------------
+    payloads = [{"page_content": chunk, "metadata": {"source": source}} for source, chunk in chunks]
+    vectors = [stubs.hashed_embedding(chunk, args.embedding_dim) for _, chunk in chunks]
+    ids = [f"00000000-0000-0000-0000-{idx:012d}" for idx in range(len(chunks))]
+    # The lexical index is loaded by create_app, the in-memory collections are created by it
+    LexicalIndex(os.path.join(work_dir, "vecdb_index"), DOCUMENT_COLLECTION_NAME).build(list(zip(ids, payloads)))
+    app = api.create_app()
+    services = app.extensions["qa"]
+    vecdb_client = vecdb_clients[DOCUMENT_COLLECTION_NAME]
+    vecdb_client.insert_vectors(list(zip(ids, vectors, payloads)))
+    print(f"Loaded {len(chunks)} chunks, {len(corpus)} questions, work dir {work_dir}")
+
+    # ------------------------------------ Instrumentation ------------------------------------
+    services.retrieve_context = recorder.wrap("retrieval", services.retrieve_context)
+    services.chat_memory.get = recorder.wrap("chat_history", services.chat_memory.get)
+    services.chat_memory.append = recorder.wrap("chat_history_save", services.chat_memory.append)
+    if services.retriever is not None:
+        services.retriever.fast_path = recorder.wrap("lexical_search", services.retriever.fast_path)
+    vecdb_client.search = recorder.wrap("vector_search", vecdb_client.search)
+
+    server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving on port {server.server_port}")
+
+    endpoints = {"qa": ["/qa"], "stream": ["/qa/stream"], "both": ["/qa", "/qa/stream"]}[args.endpoint]
+    try:
+        for endpoint in endpoints:
+            with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w")):
+                run_load(server.server_port, endpoint, corpus, args.warmup, 1, args.timeout)
+            recorder.reset()
+
+            with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w")):
+                result = run_load(server.server_port, endpoint, corpus, args.requests, args.concurrency, args.timeout)
+            print(
+                f"\n{endpoint}: {result['requests']} requests, {result['errors']} errors, {result['shed']} shed, "
+                f"concurrency {args.concurrency}, {result['throughput']:.1f} req/s"
+            )
+            print(f"  latency                   {percentiles(result['latencies'])}")
+            if result["ttfes"]:
+                print(f"  first SSE event           {percentiles(result['ttfes'])}")
+            print_stages(recorder.snapshot(), result["requests"])
+        if args.dump_metrics:
+            print()
+            print(app.test_client().get("/metrics").get_data(as_text=True))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
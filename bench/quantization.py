@@ -0,0 +1,165 @@
+"""
+Measure the recall and memory footprint of quantized copies of the document collection.
+
+The collection is copied into temporary collections, one per quantization mode, and the
+top-k of every query is compared with an exact (brute-force, full precision) search. Searches
+start once Qdrant has finished optimizing (indexing and quantizing) the collection; the RAM and
+disk usage are the ones Qdrant reports for the segments of the collection.
+
+Usage: python -m bench.quantization [--queries 200] [--top-k 5] [--oversampling 2.0] [--index-timeout 600]
+"""
+import argparse
+import time
+from typing import Optional
+
+import numpy as np
+import requests
+import yaml
+from qdrant_client.models import CollectionStatus, OptimizersStatusOneOf, PointStruct, SearchParams
+
+from db import VecDBClient
+from .vecdb_search import sample_queries
+
+
+def copy_collection(source: VecDBClient, target: VecDBClient, batch_size: int = 256) -> int:
+    target.drop_collection()
+    num_points = 0
+    offset = None
+    while True:
+        points, offset = source.scroll(
+            collection_name=source.collection_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True
+        )
+        target.upsert(
+            collection_name=target.collection_name,
+            points=[PointStruct(id=point.id, vector=point.vector, payload=point.payload) for point in points]
+        )
+        num_points += len(points)
+        if offset is None:
+            break
+    return num_points
+
+
+def wait_for_indexing(vecdb_client: VecDBClient, timeout: float, poll_interval: float = 1.0):
+    """
+    Wait until the optimizers of the collection are idle, so that the HNSW index and the
+    quantized vectors of every segment are built.
+    :return: collection info of the optimized collection
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        info = vecdb_client.get_collection(vecdb_client.collection_name)
+        if info.status == CollectionStatus.GREEN and info.optimizer_status == OptimizersStatusOneOf.OK:
+            return info
+        if time.monotonic() > deadline:
+            raise TimeoutError(
+                f"Collection <{vecdb_client.collection_name}> still optimizing after {timeout}s: "
+                f"status {info.status}, optimizer {info.optimizer_status}, "
+                f"{info.indexed_vectors_count}/{info.points_count} vectors indexed"
+            )
+        time.sleep(poll_interval)
+
+
+def collection_usage(url: str, collection_name: str) -> Optional[tuple[int, int]]:
+    """
+    RAM and disk usage of the local segments of a collection, from the Qdrant telemetry
+    :return: (ram bytes, disk bytes), or None if the telemetry has no segment details
+    """
+    response = requests.get(
+        f"{url.rstrip('/')}/telemetry",
+        params={"details_level": 3},
+        timeout=30
+    )
+    response.raise_for_status()
+    collections = response.json()["result"]["collections"].get("collections") or []
+    for collection in collections:
+        if collection.get("id") != collection_name:
+            continue
+        segments = [
+            segment["info"]
+            for shard in collection.get("shards", [])
+            for segment in ((shard.get("local") or {}).get("segments") or [])
+        ]
+        if not segments:
+            return None
+        return (
+            sum(segment.get("ram_usage_bytes", 0) for segment in segments),
+            sum(segment.get("disk_usage_bytes", 0) for segment in segments)
+        )
+    return None
+
+
+def exact_top_k(vecdb_client: VecDBClient, query: list[float], top_k: int) -> list:
+    hits = vecdb_client.search(
+        collection_name=vecdb_client.collection_name,
+        query_vector=query,
+        limit=top_k,
+        search_params=SearchParams(exact=True)
+    )
+    return [hit.id for hit in hits]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--oversampling", type=float, default=2.0)
+    parser.add_argument("--index-timeout", type=float, default=600.0, help="seconds to wait for the optimizers")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary collections")
+    args = parser.parse_args()
+
+    qdrant_config = yaml.safe_load(open("config.yaml", "r"))['qdrant']
+    source_client = VecDBClient(
+        url=qdrant_config["url"],
+        collection_name=qdrant_config["document_collection_name"],
+        embedding_dim=qdrant_config["embedding_dim"]
+    )
+    queries = sample_queries(source_client, args.queries)
+    ground_truth = [exact_top_k(source_client, query, args.top_k) for query in queries]
+
+    for mode in ["none", "scalar", "binary"]:
+        # "none" measures the HNSW search on the full-precision vectors of the source collection
+        collection_name = source_client.collection_name if mode == "none" else f"{source_client.collection_name}_bench_{mode}"
+
+        for rescore in ([False] if mode == "none" else [False, True]):
+            client = VecDBClient(
+                url=qdrant_config["url"],
+                collection_name=collection_name,
+                embedding_dim=qdrant_config["embedding_dim"],
+                quantization={"mode": mode, "rescore": rescore, "oversampling": args.oversampling}
+            )
+            if not rescore:
+                if mode != "none":
+                    copy_collection(source_client, client)
+                info = wait_for_indexing(client, args.index_timeout)
+                usage = collection_usage(qdrant_config["url"], collection_name)
+                memory = (
+                    f"RAM {usage[0] / 2 ** 20:.1f}MB  disk {usage[1] / 2 ** 20:.1f}MB" if usage is not None
+                    else "RAM n/a (no segment telemetry)"
+                )
+                # Below the indexing threshold, segments are searched without HNSW
+                memory += f"  indexed {info.indexed_vectors_count}/{info.points_count}"
+
+            latencies, num_found = [], 0
+            for query, expected in zip(queries, ground_truth):
+                start_time = time.perf_counter()
+                found = client.retrieve_similar_note_vec_ids(query, limit=args.top_k)
+                latencies.append(time.perf_counter() - start_time)
+                num_found += len(set(map(str, found)) & set(map(str, expected)))
+
+            recall = num_found / max(sum(map(len, ground_truth)), 1)
+            print(
+                f"{mode:>7} rescore={str(rescore):<5}: recall@{args.top_k} {recall:.3f}  "
+                f"p50 {np.percentile(np.asarray(latencies) * 1000, 50):.2f}ms  "
+                f"{memory}"
+            )
+
+        if mode != "none" and not args.keep:
+            client.delete_collection(collection_name)
+
+
+if __name__ == "__main__":
+    main()
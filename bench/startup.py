@@ -0,0 +1,118 @@
+"""
+Startup time of the QA API, measured in fresh interpreters.
+
+Each run imports ``api``, then the heavy dependencies that ``create_app`` imports, then creates
+the app on the offline stand-ins of ``bench.stubs`` and serves one /qa request. The
+``qa_startup_seconds`` phases are read from the app's /metrics, as a scraper would.
+
+Usage: python -m bench.startup [--runs 5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STEPS = ("import_api", "import_dependencies", "import", "services", "warm_up", "ready", "first_request")
+
+
+def measure(work_dir: str) -> dict[str, float]:
+    """
+    One cold start; call it in a fresh interpreter.
+    :return: duration of each step, in seconds
+    """
+    timings = {}
+
+    start_time = time.perf_counter()
+    import api
+    timings["import_api"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    import services  # noqa: F401
+    timings["import_dependencies"] = time.perf_counter() - start_time
+
+    import yaml
+    from . import stubs
+
+    embedding_dim = 256
+    # No simulated latency: the first request measures the server's own cold paths
+    fake_openai = stubs.FakeOpenAI(
+        stubs.StageRecorder(),
+        embedding_dim=embedding_dim,
+        embedding_latency=0.0,
+        first_token_latency=0.0,
+        token_delay=0.0
+    )
+    stubs.install(fake_openai, embedding_dim)
+    import context_builder
+    try:
+        context_builder.get_encoding("gpt-3.5-turbo")
+    except Exception:
+        context_builder.get_encoding = lambda model_name: stubs.CharEncoding()
+
+    config_path = os.path.join(work_dir, "config.yaml")
+    with open(config_path, "w", encoding="utf-8") as f:
+        yaml.safe_dump({
+            "openai": {"chat_model": "gpt-3.5-turbo", "embedding_model": "text-embedding-ada-002"},
+            "qdrant": {
+                "url": "http://qdrant.invalid:6333",
+                "embedding_dim": embedding_dim,
+                "document_collection_name": "documents",
+                "local_index_path": os.path.join(work_dir, "vecdb_index"),
+            },
+            "redis": {"host": "localhost", "port": 6379, "password": None},
+        }, f)
+
+    app = api.create_app(config_path)
+    metrics = app.test_client().get("/metrics").get_data(as_text=True)
+    for line in metrics.splitlines():
+        if line.startswith("qa_startup_seconds{"):
+            phase = line.split('"')[1]
+            timings[phase] = float(line.rsplit(" ", 1)[1])
+
+    start_time = time.perf_counter()
+    app.test_client().post("/qa", json={"userId": "1", "userQuestion": "公司简介", "messageId": "1"})
+    timings["first_request"] = time.perf_counter() - start_time
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5, help="cold starts to measure")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, REPO_ROOT)
+        work_dir = tempfile.mkdtemp(prefix="qa-startup-")
+        os.chdir(work_dir)
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                timings = measure(work_dir)
+            finally:
+                sys.stdout = stdout
+        print(json.dumps(timings))
+        return
+
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, "-m", "bench.startup", "--child"],
+            cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{args.runs} cold starts, median (min - max)")
+    for step in STEPS:
+        values = [run[step] * 1000 for run in runs if step in run]
+        if values:
+            print(f"  {step:<20} {statistics.median(values):8.1f}ms  ({min(values):.1f} - {max(values):.1f})")
+
+
+if __name__ == "__main__":
+    main()
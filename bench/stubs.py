@@ -0,0 +1,247 @@
+"""
+Deterministic, offline stand-ins for the OpenAI, Qdrant and Redis services used by the API.
+
+``install`` patches them in before the API module is imported. Every stand-in records how
+long it took in a ``StageRecorder``, so that a benchmark can break the request latency down.
+"""
+import hashlib
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Iterator
+
+import fakeredis
+import numpy as np
+import openai
+from openai.util import convert_to_openai_object
+
+import db.pool
+from db import ClientPool, VecDBClient
+from prompt import summary_prompt
+
+
+class StageRecorder:
+    """
+    Thread-safe collection of durations per named stage, in seconds.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._durations: dict[str, list[float]] = defaultdict(list)
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._durations[stage].append(seconds)
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start_time)
+
+    def wrap(self, stage: str, func: Callable) -> Callable:
+        @wraps(func)
+        def timed(*args, **kwargs):
+            with self.time(stage):
+                return func(*args, **kwargs)
+        return timed
+
+    def reset(self) -> None:
+        with self._lock:
+            self._durations.clear()
+
+    def snapshot(self) -> dict[str, list[float]]:
+        with self._lock:
+            return {stage: list(durations) for stage, durations in self._durations.items()}
+
+
+class CharEncoding:
+    """
+    Stand-in for a tiktoken encoding that counts one token per character.
+    """
+
+    def encode(self, text: str) -> list[int]:
+        return list(map(ord, text))
+
+
+def hashed_embedding(text: str, dim: int) -> list[float]:
+    """
+    Feature-hashed bag of character bigrams: deterministic, and texts sharing words get
+    similar vectors, so the retrieval still returns plausible chunks.
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    text = re.sub(r"\s+", "", text)
+    for idx in range(max(len(text) - 1, 1)):
+        digest = hashlib.blake2b(text[idx:idx + 2].encode("utf-8"), digest_size=8).digest()
+        bucket = int.from_bytes(digest[:4], "little") % dim
+        vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+class FakeOpenAI:
+    """
+    Stand-in for ``openai.Embedding`` and ``openai.ChatCompletion``.
+    """
+
+    def __init__(
+            self,
+            recorder: StageRecorder,
+            embedding_dim: int = 1536,
+            embedding_latency: float = 0.05,
+            first_token_latency: float = 0.3,
+            token_delay: float = 0.02,
+            answer_tokens: int = 120
+    ) -> None:
+        """
+        :param recorder: stage recorder
+        :param embedding_dim: embedding dimension
+        :param embedding_latency: latency of an embedding call, in seconds
+        :param first_token_latency: time until the first streamed token, in seconds
+        :param token_delay: delay between two streamed tokens, in seconds
+        :param answer_tokens: number of tokens of an answer
+        """
+        self._recorder = recorder
+        self._embedding_dim = embedding_dim
+        self._embedding_latency = embedding_latency
+        self._first_token_latency = first_token_latency
+        self._token_delay = token_delay
+        self._answer_tokens = answer_tokens
+
+    def create_embedding(self, model: str, input, **kwargs):
+        texts = [input] if isinstance(input, str) else list(input)
+        with self._recorder.time("embedding_api"):
+            time.sleep(self._embedding_latency)
+            data = [
+                {"index": idx, "embedding": hashed_embedding(text, self._embedding_dim)}
+                for idx, text in enumerate(texts)
+            ]
+        self._recorder.record("embedding_batch_size", len(texts))
+        return convert_to_openai_object({"data": data, "usage": {"total_tokens": sum(map(len, texts))}})
+
+    def answer_tokens(self, messages: list[dict]) -> list[str]:
+        digest = hashlib.sha256(messages[-1]["content"].encode("utf-8")).hexdigest()
+        return [f"答{digest[idx % len(digest)]}" for idx in range(self._answer_tokens)]
+
+    def create_chat_completion(self, model: str, messages: list[dict], stream: bool = False, **kwargs):
+        tokens = self.answer_tokens(messages)
+        prompt_tokens = sum(len(message["content"]) for message in messages)
+        # Chat history summarization runs in the background, keep it apart from the answers
+        is_summary = messages[0]["content"] == summary_prompt["system"]
+        self._recorder.record("llm_summary_prompt_chars" if is_summary else "llm_prompt_chars", prompt_tokens)
+        if stream:
+            return self._stream(tokens)
+
+        with self._recorder.time("llm_summary" if is_summary else "llm_total"):
+            time.sleep(self._first_token_latency + self._token_delay * (len(tokens) - 1))
+        return convert_to_openai_object({
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}}],
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens + len(tokens)},
+        })
+
+    def _stream(self, tokens: list[str]) -> Iterator[dict]:
+        start_time = time.perf_counter()
+        time.sleep(self._first_token_latency)
+        self._recorder.record("llm_first_token", time.perf_counter() - start_time)
+        for idx, token in enumerate(tokens):
+            if idx:
+                time.sleep(self._token_delay)
+            yield {"choices": [{"index": 0, "delta": {"content": token}}]}
+        yield {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        self._recorder.record("llm_total", time.perf_counter() - start_time)
+
+
+class InMemoryVecDBClient(VecDBClient):
+    """
+    ``VecDBClient`` on qdrant-client's in-process mode. The in-process mode is not meant
+    for concurrent use, so calls are serialized.
+
+    A share ``spike_rate`` of the searches is delayed by ``spike_latency`` seconds, outside
+    of the lock, to mimic a Qdrant hiccup.
+    """
+
+    def __init__(
+            self,
+            collection_name: str,
+            embedding_dim: int = 1536,
+            spike_rate: float = 0.0,
+            spike_latency: float = 0.0,
+            **kwargs
+    ) -> None:
+        super().__init__(collection_name, embedding_dim, location=":memory:", **kwargs)
+        self._call_lock = threading.Lock()
+        self._spike_rate = spike_rate
+        self._spike_latency = spike_latency
+
+    def search(self, *args, **kwargs):
+        if self._spike_rate and random.random() < self._spike_rate:
+            time.sleep(self._spike_latency)
+        with self._call_lock:
+            return super().search(*args, **kwargs)
+
+    def search_batch(self, *args, **kwargs):
+        if self._spike_rate and random.random() < self._spike_rate:
+            time.sleep(self._spike_latency)
+        with self._call_lock:
+            return super().search_batch(*args, **kwargs)
+
+    def upsert(self, *args, **kwargs):
+        with self._call_lock:
+            return super().upsert(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with self._call_lock:
+            return super().delete(*args, **kwargs)
+
+    def scroll(self, *args, **kwargs):
+        with self._call_lock:
+            return super().scroll(*args, **kwargs)
+
+
+def install(
+        fake_openai: FakeOpenAI,
+        embedding_dim: int,
+        spike_rate: float = 0.0,
+        spike_latency: float = 0.0
+) -> dict[str, InMemoryVecDBClient]:
+    """
+    Patch the stand-ins into ``openai`` and ``db.pool``.
+    :param spike_rate: share of the document searches delayed by ``spike_latency`` seconds
+    :return: the in-memory Qdrant clients by collection name, filled in as pools are created
+    """
+    openai.Embedding.create = staticmethod(fake_openai.create_embedding)
+    openai.ChatCompletion.create = staticmethod(fake_openai.create_chat_completion)
+
+    vecdb_clients: dict[str, InMemoryVecDBClient] = {}
+
+    def create_vecdb_pool(
+            url: str,
+            collection_name: str,
+            embedding_dim: int = embedding_dim,
+            size: int = 8,
+            hedging=None,
+            **kwargs
+    ):
+        if collection_name not in vecdb_clients:
+            vecdb_clients[collection_name] = InMemoryVecDBClient(
+                collection_name,
+                embedding_dim,
+                # The answer cache is searched outside of the deadline, keep it fast
+                spike_rate=spike_rate if hedging is not None else 0.0,
+                spike_latency=spike_latency,
+                hedging=hedging
+            )
+            vecdb_clients[collection_name].create_collection_if_not_exists()
+        client = vecdb_clients[collection_name]
+        return ClientPool(factory=lambda: client, size=size)
+
+    redis_server = fakeredis.FakeServer()
+    db.pool.create_vecdb_pool = create_vecdb_pool
+    db.pool.create_redis_client = lambda **kwargs: fakeredis.FakeStrictRedis(server=redis_server)
+    return vecdb_clients
@@ -0,0 +1,99 @@
+"""
+Compare retrieval latency and QPS of the remote Qdrant search and the local NumPy index.
+
+Usage: python -m bench.vecdb_search [--queries 200] [--top-k 5] [--concurrency 8]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import yaml
+
+from db import LocalVecDBClient, VecDBClient
+
+
+def sample_queries(vecdb_client: VecDBClient, num_queries: int, seed: int = 0) -> list[list[float]]:
+    """
+    Perturbed copies of stored vectors, so that the searches return realistic neighbours
+    """
+    points, _ = vecdb_client.scroll(
+        collection_name=vecdb_client.collection_name,
+        limit=num_queries,
+        with_vectors=True
+    )
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray([point.vector for point in points], dtype=np.float32)
+    vectors = vectors[rng.integers(0, len(vectors), size=num_queries)]
+    noisy = vectors + rng.normal(scale=0.01, size=vectors.shape).astype(np.float32)
+    return noisy.tolist()
+
+
+def run_benchmark(search, queries: list[list[float]], concurrency: int) -> dict:
+    latencies = []
+
+    def timed_search(query):
+        start_time = time.perf_counter()
+        search(query)
+        latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed_search, queries))
+    elapsed = time.perf_counter() - start_time
+
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "qps": len(queries) / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--sync", action="store_true", help="sync the local index from Qdrant first")
+    args = parser.parse_args()
+
+    qdrant_config = yaml.safe_load(open("config.yaml", "r"))['qdrant']
+    remote_client = VecDBClient(
+        url=qdrant_config["url"],
+        collection_name=qdrant_config["document_collection_name"],
+        embedding_dim=qdrant_config["embedding_dim"]
+    )
+    local_client = LocalVecDBClient(
+        index_path=qdrant_config.get("local_index_path", "./vecdb_index"),
+        collection_name=qdrant_config["document_collection_name"],
+        embedding_dim=qdrant_config["embedding_dim"]
+    )
+    if args.sync or local_client.num_vectors == 0:
+        print(f"Synced {local_client.sync_from_qdrant(remote_client)} vectors into the local index")
+
+    queries = sample_queries(remote_client, args.queries)
+
+    # Both backends must agree on the results before their speed is compared
+    num_agreeing = sum(
+        remote_client.retrieve_similar_note_vec_ids(query, limit=args.top_k)
+        == local_client.retrieve_similar_note_vec_ids(query, limit=args.top_k)
+        for query in queries
+    )
+    print(f"Identical top-{args.top_k}: {num_agreeing}/{len(queries)}")
+
+    for name, client in [("qdrant", remote_client), ("local", local_client)]:
+        result = run_benchmark(
+            lambda query: client.retrieve_similar_vectors(query, top_k=args.top_k),
+            queries,
+            args.concurrency
+        )
+        print(
+            f"{name:>8}: p50 {result['p50_ms']:.2f}ms  p95 {result['p95_ms']:.2f}ms  "
+            f"p99 {result['p99_ms']:.2f}ms  {result['qps']:.0f} QPS"
+        )
+
+
+if __name__ == "__main__":
+    main()
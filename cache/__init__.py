@@ -0,0 +1,2 @@
+from .embedding_cache import EmbeddingCache, AsyncEmbeddingCache
+from .answer_cache import SemanticAnswerCache, AsyncSemanticAnswerCache
@@ -0,0 +1,214 @@
+import threading
+import time
+from typing import Optional
+from uuid import uuid4
+
+from qdrant_client.models import (
+    FieldCondition,
+    Filter,
+    FilterSelector,
+    PayloadSchemaType,
+    Range
+)
+
+from db import AsyncVecDBClient, ClientPool, VecDBClient
+
+
+class SemanticAnswerCache:
+    """
+    Qdrant-backed cache of LLM answers keyed by question embedding.
+
+    A question whose embedding is within ``score_threshold`` cosine similarity of a cached
+    question is answered with the cached answer. Entries older than ``ttl`` seconds are never
+    served, and ``invalidate`` drops the whole cache, e.g. after the documents are re-ingested.
+    """
+
+    def __init__(
+            self,
+            vecdb_pool: ClientPool[VecDBClient],
+            score_threshold: float = 0.95,
+            ttl: int = 24 * 3600,
+            purge_interval: int = 600
+    ) -> None:
+        """
+        :param vecdb_pool: pool of clients checked out on the answer cache collection
+        :param score_threshold: minimum cosine similarity for a cache hit
+        :param ttl: lifetime of a cached answer, in seconds
+        :param purge_interval: minimum interval between deletions of expired entries, in seconds
+        """
+        self._vecdb_pool = vecdb_pool
+        self._score_threshold = score_threshold
+        self._ttl = ttl
+        self._purge_interval = purge_interval
+        self._last_purge_time = 0.0
+
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def ensure_collection(self) -> None:
+        with self._vecdb_pool.borrow() as vecdb_client:
+            vecdb_client.create_collection_if_not_exists()
+            vecdb_client.create_payload_index(
+                collection_name=vecdb_client.collection_name,
+                field_name="created_at",
+                field_schema=PayloadSchemaType.FLOAT
+            )
+
+    def _created_after(self, timestamp: float) -> Filter:
+        return Filter(must=[FieldCondition(key="created_at", range=Range(gte=timestamp))])
+
+    def _expired(self) -> FilterSelector:
+        return FilterSelector(
+            filter=Filter(must=[
+                FieldCondition(key="created_at", range=Range(lt=time.time() - self._ttl))
+            ])
+        )
+
+    def _record_lookup(self, payloads: list[dict]) -> Optional[str]:
+        with self._lock:
+            if payloads:
+                self._hits += 1
+            else:
+                self._misses += 1
+
+        return payloads[0]["answer"] if payloads else None
+
+    def _purge_due(self) -> bool:
+        return time.time() - self._last_purge_time >= self._purge_interval
+
+    def lookup(self, query_vec: list[float]) -> Optional[str]:
+        """
+        Find the answer of a nearly identical, unexpired question.
+        :param query_vec: embedding of the question
+        :return: cached answer, or None on miss
+        """
+        try:
+            with self._vecdb_pool.borrow() as vecdb_client:
+                payloads = vecdb_client.retrieve_similar_vectors(
+                    query_vec,
+                    top_k=1,
+                    score_threshold=self._score_threshold,
+                    query_filter=self._created_after(time.time() - self._ttl)
+                )
+        except Exception as e:
+            print(f"Answer cache lookup failed. Exception: {e}")
+            payloads = []
+        return self._record_lookup(payloads)
+
+    def store(self, question: str, query_vec: list[float], answer: str) -> None:
+        """
+        Cache the answer of a question.
+        :param question: question text
+        :param query_vec: embedding of the question
+        :param answer: LLM answer
+        """
+        with self._vecdb_pool.borrow() as vecdb_client:
+            vecdb_client.insert_vector(
+                vec_id=str(uuid4()),
+                vector=query_vec,
+                payload={"question": question, "answer": answer, "created_at": time.time()}
+            )
+
+        if self._purge_due():
+            self.purge_expired()
+
+    def purge_expired(self) -> None:
+        """
+        Delete entries older than the TTL.
+        """
+        self._last_purge_time = time.time()
+        try:
+            with self._vecdb_pool.borrow() as vecdb_client:
+                vecdb_client.delete(
+                    collection_name=vecdb_client.collection_name,
+                    points_selector=self._expired()
+                )
+        except Exception as e:
+            print(f"Answer cache purge failed. Exception: {e}")
+
+    def invalidate(self) -> None:
+        """
+        Drop every cached answer.
+        """
+        with self._vecdb_pool.borrow() as vecdb_client:
+            vecdb_client.drop_collection()
+        self.ensure_collection()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": self._hits / lookups if lookups else 0.0,
+            }
+
+
+class AsyncSemanticAnswerCache(SemanticAnswerCache):
+    """
+    ``SemanticAnswerCache`` on an asyncio client of the answer cache collection.
+    """
+
+    def __init__(
+            self,
+            vecdb_client: AsyncVecDBClient,
+            score_threshold: float = 0.95,
+            ttl: int = 24 * 3600,
+            purge_interval: int = 600
+    ) -> None:
+        """
+        :param vecdb_client: client on the answer cache collection, shared by the requests
+        """
+        super().__init__(
+            vecdb_pool=None,
+            score_threshold=score_threshold,
+            ttl=ttl,
+            purge_interval=purge_interval
+        )
+        self._vecdb_client = vecdb_client
+
+    async def ensure_collection(self) -> None:
+        await self._vecdb_client.create_collection_if_not_exists()
+        await self._vecdb_client.create_payload_index(
+            collection_name=self._vecdb_client.collection_name,
+            field_name="created_at",
+            field_schema=PayloadSchemaType.FLOAT
+        )
+
+    async def lookup(self, query_vec: list[float]) -> Optional[str]:
+        try:
+            payloads = await self._vecdb_client.retrieve_similar_vectors(
+                query_vec,
+                top_k=1,
+                score_threshold=self._score_threshold,
+                query_filter=self._created_after(time.time() - self._ttl)
+            )
+        except Exception as e:
+            print(f"Answer cache lookup failed. Exception: {e}")
+            payloads = []
+        return self._record_lookup(payloads)
+
+    async def store(self, question: str, query_vec: list[float], answer: str) -> None:
+        await self._vecdb_client.insert_vector(
+            vec_id=str(uuid4()),
+            vector=query_vec,
+            payload={"question": question, "answer": answer, "created_at": time.time()}
+        )
+
+        if self._purge_due():
+            await self.purge_expired()
+
+    async def purge_expired(self) -> None:
+        self._last_purge_time = time.time()
+        try:
+            await self._vecdb_client.delete(
+                collection_name=self._vecdb_client.collection_name,
+                points_selector=self._expired()
+            )
+        except Exception as e:
+            print(f"Answer cache purge failed. Exception: {e}")
+
+    async def invalidate(self) -> None:
+        await self._vecdb_client.drop_collection()
+        await self.ensure_collection()
@@ -0,0 +1,267 @@
+import asyncio
+import hashlib
+import re
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from redis import StrictRedis
+from redis.asyncio import StrictRedis as AsyncStrictRedis
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache for query embeddings.
+
+    Tier 1 is an in-process LRU bounded by ``max_local_size``, tier 2 is a shared Redis tier
+    where each embedding is stored as packed little-endian float32 bytes with a TTL.
+    Entries are keyed on (embedding model, hash of the normalized text).
+    """
+
+    def __init__(
+            self,
+            redis_client: Optional[StrictRedis] = None,
+            max_local_size: int = 4096,
+            ttl: int = 7 * 24 * 3600,
+            key_prefix: str = "emb"
+    ) -> None:
+        self._redis_client = redis_client
+        self._max_local_size = max_local_size
+        self._ttl = ttl
+        self._key_prefix = key_prefix
+
+        self._local: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Counters
+        self._local_hits = 0
+        self._redis_hits = 0
+        self._misses = 0
+        self._redis_errors = 0
+        self._miss_seconds = 0.0
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        """
+        Normalize text so that trivially different questions share one cache entry.
+        :param text: raw text
+        :return: NFKC-normalized text with collapsed whitespace
+        """
+        text = unicodedata.normalize("NFKC", text)
+        return re.sub(r"\s+", " ", text).strip()
+
+    def make_key(self, text: str, embedding_model_name: str) -> str:
+        digest = hashlib.sha256(self.normalize_text(text).encode("utf-8")).hexdigest()
+        return f"{self._key_prefix}:{embedding_model_name}:{digest}"
+
+    @staticmethod
+    def pack_embedding(embedding: list[float]) -> bytes:
+        packed = array("f", embedding)
+        if sys.byteorder == "big":
+            packed.byteswap()
+        return packed.tobytes()
+
+    @staticmethod
+    def unpack_embedding(raw: bytes) -> list[float]:
+        packed = array("f")
+        packed.frombytes(raw)
+        if sys.byteorder == "big":
+            packed.byteswap()
+        return packed.tolist()
+
+    def get(self, text: str, embedding_model_name: str) -> Optional[list[float]]:
+        """
+        Look up an embedding in the local tier, then in the Redis tier.
+        :param text: text to embed
+        :param embedding_model_name: embedding model name
+        :return: cached embedding, or None on miss
+        """
+        key = self.make_key(text, embedding_model_name)
+        embedding = self._get_local(key)
+        if embedding is not None or self._redis_client is None:
+            return embedding
+
+        try:
+            raw = self._redis_client.get(key)
+        except Exception as e:
+            self._redis_failed("get", e)
+            return None
+        return self._redis_hit(key, raw)
+
+    def set(self, text: str, embedding_model_name: str, embedding: list[float]) -> None:
+        key = self.make_key(text, embedding_model_name)
+        self._put_local(key, embedding)
+
+        if self._redis_client is not None:
+            try:
+                self._redis_client.set(key, self.pack_embedding(embedding), ex=self._ttl)
+            except Exception as e:
+                self._redis_failed("set", e)
+
+    def get_or_compute(
+            self,
+            text: str,
+            embedding_model_name: str,
+            compute: Callable[[str], list[float]]
+    ) -> list[float]:
+        """
+        Return the cached embedding or compute, store and return it.
+        :param text: text to embed
+        :param embedding_model_name: embedding model name
+        :param compute: function that calls the embedding model for ``text``
+        :return: embedding vector
+        """
+        embedding = self.get(text, embedding_model_name)
+        if embedding is not None:
+            return embedding
+
+        start_time = time.perf_counter()
+        embedding = compute(text)
+        self._record_miss(time.perf_counter() - start_time)
+
+        self.set(text, embedding_model_name, embedding)
+        return embedding
+
+    async def aget_or_compute(
+            self,
+            text: str,
+            embedding_model_name: str,
+            compute: Callable[[str], Awaitable[list[float]]]
+    ) -> list[float]:
+        """
+        Async version of ``get_or_compute``. The Redis tier is accessed from a worker thread,
+        ``AsyncEmbeddingCache`` uses an asyncio client instead.
+        """
+        embedding = await asyncio.to_thread(self.get, text, embedding_model_name)
+        if embedding is not None:
+            return embedding
+
+        start_time = time.perf_counter()
+        embedding = await compute(text)
+        self._record_miss(time.perf_counter() - start_time)
+
+        await asyncio.to_thread(self.set, text, embedding_model_name, embedding)
+        return embedding
+
+    def _get_local(self, key: str) -> Optional[list[float]]:
+        with self._lock:
+            embedding = self._local.get(key)
+            if embedding is not None:
+                self._local.move_to_end(key)
+                self._local_hits += 1
+            return embedding
+
+    def _redis_hit(self, key: str, raw: Optional[bytes]) -> Optional[list[float]]:
+        if not raw:
+            return None
+        embedding = self.unpack_embedding(raw)
+        with self._lock:
+            self._redis_hits += 1
+        self._put_local(key, embedding)
+        return embedding
+
+    def _redis_failed(self, command: str, e: Exception) -> None:
+        print(f"Embedding cache redis {command} failed. Exception: {e}")
+        with self._lock:
+            self._redis_errors += 1
+
+    def _record_miss(self, seconds: float) -> None:
+        with self._lock:
+            self._misses += 1
+            self._miss_seconds += seconds
+
+    def _put_local(self, key: str, embedding: list[float]) -> None:
+        with self._lock:
+            self._local[key] = embedding
+            self._local.move_to_end(key)
+            while len(self._local) > self._max_local_size:
+                self._local.popitem(last=False)
+
+    def clear_local(self) -> None:
+        with self._lock:
+            self._local.clear()
+
+    def stats(self) -> dict:
+        """
+        Hit/miss counters of this process, plus an estimate of the embedding latency saved
+        (hits multiplied by the mean latency of a miss).
+        """
+        with self._lock:
+            hits = self._local_hits + self._redis_hits
+            lookups = hits + self._misses
+            mean_miss_seconds = self._miss_seconds / self._misses if self._misses else 0.0
+            return {
+                "local_size": len(self._local),
+                "local_hits": self._local_hits,
+                "redis_hits": self._redis_hits,
+                "misses": self._misses,
+                "redis_errors": self._redis_errors,
+                "hit_ratio": hits / lookups if lookups else 0.0,
+                "mean_miss_seconds": mean_miss_seconds,
+                "saved_seconds": hits * mean_miss_seconds,
+                "saved_requests": hits,
+            }
+
+
+class AsyncEmbeddingCache(EmbeddingCache):
+    """
+    ``EmbeddingCache`` whose Redis tier is read and written with an asyncio client.
+    """
+
+    def __init__(
+            self,
+            redis_client: Optional[AsyncStrictRedis] = None,
+            max_local_size: int = 4096,
+            ttl: int = 7 * 24 * 3600,
+            key_prefix: str = "emb"
+    ) -> None:
+        super().__init__(
+            redis_client=redis_client,
+            max_local_size=max_local_size,
+            ttl=ttl,
+            key_prefix=key_prefix
+        )
+
+    async def get(self, text: str, embedding_model_name: str) -> Optional[list[float]]:
+        key = self.make_key(text, embedding_model_name)
+        embedding = self._get_local(key)
+        if embedding is not None or self._redis_client is None:
+            return embedding
+
+        try:
+            raw = await self._redis_client.get(key)
+        except Exception as e:
+            self._redis_failed("get", e)
+            return None
+        return self._redis_hit(key, raw)
+
+    async def set(self, text: str, embedding_model_name: str, embedding: list[float]) -> None:
+        key = self.make_key(text, embedding_model_name)
+        self._put_local(key, embedding)
+
+        if self._redis_client is not None:
+            try:
+                await self._redis_client.set(key, self.pack_embedding(embedding), ex=self._ttl)
+            except Exception as e:
+                self._redis_failed("set", e)
+
+    async def aget_or_compute(
+            self,
+            text: str,
+            embedding_model_name: str,
+            compute: Callable[[str], Awaitable[list[float]]]
+    ) -> list[float]:
+        embedding = await self.get(text, embedding_model_name)
+        if embedding is not None:
+            return embedding
+
+        start_time = time.perf_counter()
+        embedding = await compute(text)
+        self._record_miss(time.perf_counter() - start_time)
+
+        await self.set(text, embedding_model_name, embedding)
+        return embedding
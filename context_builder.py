@@ -0,0 +1,117 @@
+from functools import lru_cache
+
+import tiktoken
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    # Loading an encoding parses its whole BPE table, so it is done once per process
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        # Models unknown to tiktoken (fine-tunes, proxies, newer releases) are counted with cl100k_base
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str, model_name: str) -> int:
+    # Popular chunks are packed again and again, so their token counts are cached too
+    return len(get_encoding(model_name).encode(text))
+
+
+def overlap_length(head: str, tail: str, min_overlap: int, max_overlap: int) -> int:
+    """
+    Length of the longest suffix of ``head`` that is also a prefix of ``tail``, or 0 if it is
+    shorter than ``min_overlap``.
+    """
+    for length in range(min(len(head), len(tail), max_overlap), min_overlap - 1, -1):
+        if head.endswith(tail[:length]):
+            return length
+    return 0
+
+
+class ContextBuilder:
+    """
+    Packs retrieved chunks into the context of the QA prompt.
+
+    Candidates are taken best first. A chunk contained in an already selected one is dropped,
+    and a chunk overlapping the head or tail of a selected one (the splitter repeats up to
+    ``chunk_overlap`` characters between neighbours) is merged into it without the repeated
+    part. A candidate is skipped if it does not fit into what is left of ``token_budget``,
+    so that smaller, lower ranked chunks can still fill the budget.
+    """
+
+    def __init__(
+            self,
+            token_budget: int = 1500,
+            candidate_k: int = 8,
+            score_threshold: float = 0.80,
+            min_overlap: int = 10,
+            max_overlap: int = 100,
+            model_name: str = "gpt-3.5-turbo"
+    ) -> None:
+        """
+        :param token_budget: maximum number of context tokens
+        :param candidate_k: number of chunks to retrieve
+        :param score_threshold: minimum similarity score of retrieved chunks
+        :param min_overlap: minimum number of repeated characters for two chunks to be merged
+        :param max_overlap: maximum number of repeated characters looked for
+        :param model_name: model whose tokenizer counts the tokens
+        """
+        self.token_budget = token_budget
+        self.candidate_k = candidate_k
+        self.score_threshold = score_threshold
+        self._min_overlap = min_overlap
+        self._max_overlap = max_overlap
+        self._model_name = model_name
+
+    def count_tokens(self, text: str) -> int:
+        return count_tokens(text, self._model_name)
+
+    def _merge(self, segment: str, chunk: str) -> str | None:
+        """
+        :return: ``segment`` extended by ``chunk``, or None if they do not overlap
+        """
+        length = overlap_length(segment, chunk, self._min_overlap, self._max_overlap)
+        if length:
+            return segment + chunk[length:]
+        length = overlap_length(chunk, segment, self._min_overlap, self._max_overlap)
+        if length:
+            return chunk + segment[length:]
+        return None
+
+    def pack(self, chunks: list[str]) -> list[str]:
+        """
+        :param chunks: chunk texts, best first
+        :return: deduplicated segments that fit into the token budget, in rank order
+        """
+        segments: list[str] = []
+        used_tokens = 0
+        for chunk in chunks:
+            chunk = chunk.strip()
+            if not chunk or any(chunk in segment for segment in segments):
+                continue
+
+            for idx, segment in enumerate(segments):
+                merged = self._merge(segment, chunk)
+                if merged is None:
+                    continue
+                extra_tokens = self.count_tokens(merged) - self.count_tokens(segment)
+                if used_tokens + extra_tokens <= self.token_budget:
+                    segments[idx] = merged
+                    used_tokens += extra_tokens
+                break
+            else:
+                tokens = self.count_tokens(chunk)
+                if used_tokens + tokens <= self.token_budget:
+                    segments.append(chunk)
+                    used_tokens += tokens
+
+        return segments
+
+    def build(self, payloads: list[dict]) -> str:
+        """
+        :param payloads: payloads of the retrieved chunks, best first
+        :return: context text
+        """
+        return "\n".join(self.pack([payload['page_content'] for payload in payloads]))
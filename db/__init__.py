@@ -1,3 +1,6 @@
-from .pgdb import PostgresqlClient
-from .vecdb import VecDBClient
-from .redisdb import ChatBotRedisClient
+from .pgdb import PostgresqlClient, PooledPostgresqlClient
+from .vecdb import VecDBClient, AsyncVecDBClient
+from .hedging import HedgingPolicy, LatencyTracker, SearchTimeoutError
+from .localvecdb import LocalVecDBClient
+from .redisdb import ChatBotRedisClient, AsyncChatBotRedisClient, ChatHistoryStore, AsyncChatHistoryStore, StreamJournal, StreamJournalWriter
+from .pool import ClientPool, ConnectionPools, PoolExhaustedError, create_vecdb_pool, create_redis_client
@@ -0,0 +1,241 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class SearchTimeoutError(TimeoutError):
+    pass
+
+
+def server_timeout(timeout: Optional[float]) -> Optional[int]:
+    """
+    Whole seconds for Qdrant's own search timeout, so that abandoned searches stop server-side too.
+    """
+    return math.ceil(timeout) if timeout is not None else None
+
+
+class LatencyTracker:
+    """
+    Latencies of the most recent calls, for percentile estimates.
+    """
+
+    def __init__(self, window: int = 512) -> None:
+        self._samples: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """
+        :param q: percentile in [0, 1]
+        :return: latency in seconds, or None before any call was recorded
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+
+class HedgingPolicy:
+    """
+    Deadline and request hedging of vector searches, shared by the clients of a pool.
+
+    A call that has not answered after the ``hedge_percentile`` latency of the recent calls
+    is issued a second time, and the first answer wins; the slow call is abandoned, not
+    cancelled, and ends with the client's own timeout. A call that has not answered by its
+    deadline raises ``SearchTimeoutError``.
+    """
+
+    def __init__(
+            self,
+            timeout: Optional[float] = 1.0,
+            hedge: bool = True,
+            hedge_percentile: float = 0.95,
+            hedge_min_delay: float = 0.05,
+            min_samples: int = 20,
+            max_workers: int = 16
+    ) -> None:
+        """
+        :param timeout: default deadline of a call, in seconds; None to wait indefinitely
+        :param hedge: whether to issue hedged calls
+        :param hedge_percentile: latency percentile after which a call is hedged
+        :param hedge_min_delay: minimum delay before a hedged call, in seconds
+        :param min_samples: recorded calls needed before the percentile is used; until then, and whenever it
+            is longer, calls are hedged after ``timeout / 2``
+        :param max_workers: threads running the calls of the synchronous clients
+        """
+        self.timeout = timeout
+        self._hedge = hedge
+        self._hedge_percentile = hedge_percentile
+        self._hedge_min_delay = hedge_min_delay
+        self._min_samples = min_samples
+        self._max_workers = max_workers
+        self.latencies = LatencyTracker()
+
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._calls = 0
+        self._hedged = 0
+        self._hedge_wins = 0
+        self._timeouts = 0
+
+    @classmethod
+    def from_config(cls, retrieval_config: Optional[dict]) -> Optional["HedgingPolicy"]:
+        """
+        :param retrieval_config: ``qdrant.retrieval`` section of config.yaml, e.g.
+            {"timeout": 1.0, "hedge": True, "hedge_percentile": 0.95}
+        :return: policy, or None if neither a timeout nor hedging is configured
+        """
+        retrieval_config = retrieval_config or {}
+        timeout = retrieval_config.get("timeout", 1.0)
+        hedge = retrieval_config.get("hedge", True)
+        if timeout is None and not hedge:
+            return None
+        return cls(
+            timeout=timeout,
+            hedge=hedge,
+            hedge_percentile=retrieval_config.get("hedge_percentile", 0.95),
+            hedge_min_delay=retrieval_config.get("hedge_min_delay", 0.05),
+            max_workers=retrieval_config.get("max_workers", 16),
+        )
+
+    def hedge_delay(self, timeout: Optional[float]) -> Optional[float]:
+        """
+        :return: delay before the hedged call, or None if the call is not hedged
+        """
+        if not self._hedge:
+            return None
+        if len(self.latencies) < self._min_samples:
+            return timeout / 2 if timeout is not None else None
+        delay = max(self.latencies.percentile(self._hedge_percentile), self._hedge_min_delay)
+        # Leave the hedged call at least half of the deadline
+        return min(delay, timeout / 2) if timeout is not None else delay
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Created on first use, so that pre-fork workers do not inherit an executor without threads
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="vecdb-search")
+            return self._executor
+
+    def _timed(self, func: Callable[[], T]) -> Callable[[], T]:
+        def timed() -> T:
+            start_time = time.perf_counter()
+            result = func()
+            self.latencies.record(time.perf_counter() - start_time)
+            return result
+        return timed
+
+    def _count(self, hedged: bool = False, hedge_won: bool = False, timed_out: bool = False) -> None:
+        with self._lock:
+            self._calls += 1
+            self._hedged += hedged
+            self._hedge_wins += hedge_won
+            self._timeouts += timed_out
+
+    def call(self, func: Callable[[], T], timeout: Optional[float] = None) -> T:
+        """
+        Run ``func`` with a deadline, hedging it once if it is slow.
+        :param func: call to run, safe to run twice concurrently
+        :param timeout: deadline in seconds, defaults to the policy's
+        :return: result of the first call to succeed
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        executor = self._get_executor()
+
+        def remaining() -> Optional[float]:
+            return max(deadline - time.monotonic(), 0.0) if deadline is not None else None
+
+        futures: list[Future] = [executor.submit(self._timed(func))]
+        delay = self.hedge_delay(timeout)
+        if delay is not None:
+            wait(futures, timeout=delay if deadline is None else min(delay, remaining()))
+            if not futures[0].done() and (deadline is None or remaining() > 0):
+                futures.append(executor.submit(self._timed(func)))
+
+        pending = set(futures)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    self._count(hedged=len(futures) > 1, hedge_won=future is not futures[0])
+                    return future.result()
+                error = future.exception()
+
+        if error is not None and not pending:
+            self._count(hedged=len(futures) > 1)
+            raise error
+        self._count(hedged=len(futures) > 1, timed_out=True)
+        raise SearchTimeoutError(f"Vector search did not answer within {timeout}s")
+
+    async def acall(self, func: Callable[[], Awaitable[T]], timeout: Optional[float] = None) -> T:
+        """
+        Asyncio counterpart of ``call``; the abandoned call is cancelled.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        async def timed() -> T:
+            start_time = time.perf_counter()
+            result = await func()
+            self.latencies.record(time.perf_counter() - start_time)
+            return result
+
+        def remaining() -> Optional[float]:
+            return max(deadline - time.monotonic(), 0.0) if deadline is not None else None
+
+        tasks = [asyncio.ensure_future(timed())]
+        try:
+            delay = self.hedge_delay(timeout)
+            if delay is not None:
+                await asyncio.wait(tasks, timeout=delay if deadline is None else min(delay, remaining()))
+                if not tasks[0].done() and (deadline is None or remaining() > 0):
+                    tasks.append(asyncio.ensure_future(timed()))
+
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=remaining(), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        self._count(hedged=len(tasks) > 1, hedge_won=task is not tasks[0])
+                        return task.result()
+                    error = task.exception()
+
+            if error is not None and not pending:
+                self._count(hedged=len(tasks) > 1)
+                raise error
+            self._count(hedged=len(tasks) > 1, timed_out=True)
+            raise SearchTimeoutError(f"Vector search did not answer within {timeout}s")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self._calls,
+                "hedged": self._hedged,
+                "hedge_wins": self._hedge_wins,
+                "timeouts": self._timeouts,
+                "p50_seconds": self.latencies.percentile(0.5),
+                "hedge_delay_seconds": self.hedge_delay(self.timeout),
+            }
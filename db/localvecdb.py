@@ -0,0 +1,391 @@
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Optional
+from uuid import UUID, uuid4
+
+import numpy as np
+from qdrant_client.models import (
+    FieldCondition,
+    Filter,
+    HasIdCondition,
+    IsEmptyCondition,
+    IsNullCondition,
+    MatchAny,
+    MatchExcept,
+    MatchText,
+    MatchValue,
+    Range
+)
+
+from .vecdb import VecDBClient
+
+
+def payload_values(payload: dict, key: str, flat: bool = True) -> list[Any]:
+    """
+    Values of a payload field, as Qdrant reads them for filtering
+    :param key: field path, e.g. "metadata.source" or "tags[].name"
+    :param flat: whether the elements of array values are returned instead of the arrays
+    :return: values found, empty if the field is missing
+    """
+    values = [payload]
+    for part in key.split("."):
+        name = part.removesuffix("[]")
+        values = [value[name] for value in values if isinstance(value, dict) and name in value]
+        if part.endswith("[]"):
+            values = [item for value in values if isinstance(value, list) for item in value]
+    if flat:
+        values = [item for value in values for item in (value if isinstance(value, list) else [value])]
+    return values
+
+
+def check_field_condition(condition: FieldCondition, payload: dict) -> bool:
+    values = payload_values(payload, condition.key)
+    match, value_range = condition.match, condition.range
+    if match is not None:
+        if isinstance(match, MatchValue):
+            return any(value == match.value for value in values)
+        if isinstance(match, MatchAny):
+            return any(value in match.any for value in values)
+        if isinstance(match, MatchExcept):
+            return any(value not in match.except_ for value in values)
+        if isinstance(match, MatchText):
+            return any(isinstance(value, str) and match.text in value for value in values)
+    elif isinstance(value_range, Range):
+        return any(
+            isinstance(value, (int, float))
+            and (value_range.gt is None or value > value_range.gt)
+            and (value_range.gte is None or value >= value_range.gte)
+            and (value_range.lt is None or value < value_range.lt)
+            and (value_range.lte is None or value <= value_range.lte)
+            for value in values
+        )
+    raise ValueError(f"Unsupported condition on field {condition.key!r} in the local index")
+
+
+def check_condition(condition, payload: dict, point_id: str) -> bool:
+    if isinstance(condition, FieldCondition):
+        return check_field_condition(condition, payload)
+    if isinstance(condition, Filter):
+        return check_filter(condition, payload, point_id)
+    if isinstance(condition, HasIdCondition):
+        return point_id in {str(vec_id) for vec_id in condition.has_id}
+    if isinstance(condition, IsEmptyCondition):
+        return all(value is None or value == [] for value in payload_values(payload, condition.is_empty.key, flat=False))
+    if isinstance(condition, IsNullCondition):
+        return any(value is None for value in payload_values(payload, condition.is_null.key, flat=False))
+    raise ValueError(f"Unsupported condition in the local index: {type(condition).__name__}")
+
+
+def check_filter(query_filter: Filter, payload: dict, point_id: str) -> bool:
+    """
+    Whether a point passes a Qdrant payload filter. Supports match and numeric range conditions
+    on fields, has_id, is_empty, is_null and nested filters.
+    """
+    return (
+        all(check_condition(condition, payload, point_id) for condition in query_filter.must or [])
+        and not any(check_condition(condition, payload, point_id) for condition in query_filter.must_not or [])
+        and (not query_filter.should or any(check_condition(condition, payload, point_id) for condition in query_filter.should))
+        and (
+            query_filter.min_should is None
+            or sum(
+                check_condition(condition, payload, point_id) for condition in query_filter.min_should.conditions
+            ) >= query_filter.min_should.min_count
+        )
+    )
+
+
+class LocalVecDBClient:
+    """
+    In-process exact-search backend with the retrieval API of ``VecDBClient``.
+
+    The embeddings of a collection are kept as an L2-normalized float32 matrix in a ``.npy``
+    file that is memory-mapped read-only, so cosine similarity is a single matrix-vector
+    product and top-k selection an ``argpartition``. Payloads are kept in memory and filtered
+    with ``check_filter``. Every save writes a new version of both files and switches a pointer
+    file to it, so processes reloading the index never mix two versions.
+    """
+
+    def __init__(
+            self,
+            index_path: str,
+            collection_name: str,
+            embedding_dim: int = 1536,
+            reload_interval: float = 10.0
+    ) -> None:
+        """
+        :param index_path: folder holding the index files
+        :param collection_name: collection to load
+        :param embedding_dim: embedding dimension
+        :param reload_interval: how often to check whether the index files were replaced, in seconds
+        """
+        self._index_path = index_path
+        self._embedding_dim = embedding_dim
+        self._reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self.checkout_collection(collection_name)
+
+    @property
+    def collection_name(self) -> Optional[str]:
+        return self._collection_name
+
+    @property
+    def num_vectors(self) -> int:
+        return len(self._index[1])
+
+    def _pointer_path(self) -> str:
+        return os.path.join(self._index_path, f"{self._collection_name}.index.json")
+
+    def _vectors_path(self, version: Optional[str]) -> str:
+        # Version None is the unversioned layout of older indexes, read until the next save
+        infix = f".{version}" if version is not None else ""
+        return os.path.join(self._index_path, f"{self._collection_name}{infix}.vectors.npy")
+
+    def _payloads_path(self, version: Optional[str]) -> str:
+        infix = f".{version}" if version is not None else ""
+        return os.path.join(self._index_path, f"{self._collection_name}{infix}.payloads.json")
+
+    def checkout_collection(self, collection_name: str) -> None:
+        self._collection_name = collection_name
+        self._load()
+
+    def _current_version(self) -> Optional[str]:
+        try:
+            with open(self._pointer_path(), "r", encoding="utf-8") as f:
+                return json.load(f)["version"]
+        except FileNotFoundError:
+            return None
+
+    def _reload_if_changed(self) -> None:
+        # Picks up a sync done by another process, e.g. setup_vecdb.sync_local_index
+        now = time.monotonic()
+        if now - self._last_check_time < self._reload_interval:
+            return
+        self._last_check_time = now
+        if self._current_version() != self._loaded_version:
+            with self._lock:
+                self._load()
+
+    def _load(self, max_attempts: int = 3) -> None:
+        self._last_check_time = time.monotonic()
+        for attempt in range(max_attempts):
+            version = self._current_version()
+            vectors_path = self._vectors_path(version)
+            try:
+                if version is None and not os.path.exists(vectors_path):
+                    vectors = np.empty((0, self._embedding_dim), dtype=np.float32)
+                    records = {"ids": [], "payloads": []}
+                else:
+                    vectors = np.load(vectors_path, mmap_mode="r")
+                    with open(self._payloads_path(version), "r", encoding="utf-8") as f:
+                        records = json.load(f)
+                break
+            except FileNotFoundError:
+                # A newer save pruned this version between reading the pointer and opening its files
+                if attempt == max_attempts - 1:
+                    raise
+
+        self._loaded_version = version
+        # Swap vectors, ids and payloads at once so concurrent searches see a consistent index
+        self._index = (vectors, records["ids"], records["payloads"])
+
+    def _save(self, vectors: np.ndarray, ids: list[str], payloads: list[dict]) -> None:
+        """
+        Write the vectors and payloads as a new version, then switch the pointer file to it in one
+        ``os.replace``: a process reloading meanwhile reads either the old or the new version,
+        never the vectors of one with the payloads of the other.
+        """
+        os.makedirs(self._index_path, exist_ok=True)
+        version = uuid4().hex
+        with open(self._vectors_path(version), "wb") as f:
+            np.save(f, vectors.astype(np.float32, copy=False))
+        with open(self._payloads_path(version), "w", encoding="utf-8") as f:
+            json.dump({"ids": ids, "payloads": payloads}, f, ensure_ascii=False)
+
+        pointer_path = self._pointer_path()
+        with open(f"{pointer_path}.{version}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"version": version}, f)
+        os.replace(f"{pointer_path}.{version}.tmp", pointer_path)
+
+        previous_version = self._loaded_version
+        self._load()
+        self._prune(keep={version, previous_version})
+
+    def _prune(self, keep: set[Optional[str]]) -> None:
+        """
+        Delete the files of older versions. The previous one is kept for processes that read the
+        pointer just before the switch; a deleted file that is memory-mapped stays readable.
+        """
+        pattern = re.compile(rf"{re.escape(self._collection_name)}(\.[0-9a-f]{{32}})?\.(vectors\.npy|payloads\.json)")
+        for file_name in os.listdir(self._index_path):
+            match = pattern.fullmatch(file_name)
+            if match is None:
+                continue
+            version = match.group(1)[1:] if match.group(1) else None
+            if version not in keep:
+                try:
+                    os.remove(os.path.join(self._index_path, file_name))
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def insert_vectors(self, to_vecdb_data: list[tuple[str, list[float], dict]]) -> int:
+        """
+        Insert or replace the embedding vectors
+        :param to_vecdb_data: format: [(vec_id, vector, payload), ...]
+        :return: the number of inserted vectors
+        """
+        with self._lock:
+            old_vectors, old_ids, old_payloads = self._index
+            new_ids = {str(vec_id) for vec_id, _, _ in to_vecdb_data}
+            keep = [idx for idx, vec_id in enumerate(old_ids) if vec_id not in new_ids]
+
+            new_vectors = self._normalize(np.asarray([vector for _, vector, _ in to_vecdb_data], dtype=np.float32))
+            vectors = np.concatenate([np.asarray(old_vectors)[keep], new_vectors.reshape(-1, self._embedding_dim)])
+            ids = [old_ids[idx] for idx in keep] + [str(vec_id) for vec_id, _, _ in to_vecdb_data]
+            payloads = [old_payloads[idx] for idx in keep] + [payload for _, _, payload in to_vecdb_data]
+            self._save(vectors, ids, payloads)
+
+        return len(to_vecdb_data)
+
+    def insert_vector(self, vec_id: str, vector: list[float], payload: dict) -> int:
+        return self.insert_vectors([(vec_id, vector, payload)])
+
+    def delete_vectors(self, vec_ids: list[str]) -> int:
+        with self._lock:
+            old_vectors, old_ids, old_payloads = self._index
+            deleted_ids = set(map(str, vec_ids))
+            keep = [idx for idx, vec_id in enumerate(old_ids) if vec_id not in deleted_ids]
+            self._save(
+                np.asarray(old_vectors)[keep],
+                [old_ids[idx] for idx in keep],
+                [old_payloads[idx] for idx in keep]
+            )
+
+        return len(deleted_ids)
+
+    def _snapshot(self) -> tuple[np.ndarray, list[str], list[dict]]:
+        self._reload_if_changed()
+        return self._index
+
+    def _search(
+            self,
+            index: tuple[np.ndarray, list[str], list[dict]],
+            query_vec: list[float],
+            top_k: int,
+            mask: Optional[np.ndarray] = None
+    ) -> list[tuple[str, float, dict]]:
+        """
+        :param index: vectors, ids and payloads to search
+        :param mask: points allowed by the payload filter, None for all of them
+        :return: (id, score, payload) of the ``top_k`` most similar vectors, best first
+        """
+        vectors, ids, payloads = index
+        candidates = np.arange(len(ids)) if mask is None else np.flatnonzero(mask)
+        if len(candidates) == 0:
+            return []
+
+        query = self._normalize(np.asarray(query_vec, dtype=np.float32))
+        scores = vectors @ query if mask is None else np.asarray(vectors)[candidates] @ query
+
+        top_k = min(top_k, len(scores))
+        indices = np.argpartition(-scores, top_k - 1)[:top_k]
+        indices = indices[np.argsort(-scores[indices])]
+        return [(ids[candidates[idx]], float(scores[idx]), payloads[candidates[idx]]) for idx in indices]
+
+    @staticmethod
+    def _filter_mask(index: tuple[np.ndarray, list[str], list[dict]], query_filter: Optional[Filter]) -> Optional[np.ndarray]:
+        if query_filter is None:
+            return None
+        _, ids, payloads = index
+        return np.fromiter(
+            (check_filter(query_filter, payload, vec_id) for vec_id, payload in zip(ids, payloads)),
+            dtype=bool,
+            count=len(ids)
+        )
+
+    def retrieve_similar_vectors(
+            self,
+            query_vec: list[float],
+            top_k: int = 5,
+            score_threshold: float = 0.80,
+            query_filter: Optional[Filter] = None,
+            timeout: Optional[float] = None
+    ) -> list[dict]:
+        """
+        Retrieve similar vectors
+        :param query_vec: query vector
+        :param top_k: number of similar vectors to retrieve
+        :param score_threshold: minimum similarity score of returned points
+        :param query_filter: optional payload filter
+        :param timeout: ignored, the search runs in process and does not wait on the network
+        :return: list of PointStruct Payload
+        """
+        index = self._snapshot()
+        return [
+            payload for _, score, payload in self._search(index, query_vec, top_k, self._filter_mask(index, query_filter))
+            if score >= score_threshold
+        ]
+
+    def retrieve_similar_vectors_batch(
+            self,
+            query_vecs: list[list[float]],
+            top_k: int = 5,
+            score_threshold: float = 0.80,
+            query_filter: Optional[Filter] = None,
+            timeout: Optional[float] = None
+    ) -> list[list[dict]]:
+        """
+        Retrieve similar vectors of several queries, see ``retrieve_similar_vectors``
+        :param query_filter: optional payload filter, applied to every query and evaluated once
+        :return: list of PointStruct Payload per query, in the order of ``query_vecs``
+        """
+        index = self._snapshot()
+        mask = self._filter_mask(index, query_filter)
+        return [
+            [payload for _, score, payload in self._search(index, query_vec, top_k, mask) if score >= score_threshold]
+            for query_vec in query_vecs
+        ]
+
+    def retrieve_similar_note_vec_ids(self, query_vec: list[float], limit: int = 5) -> list[UUID]:
+        return [UUID(vec_id) for vec_id, _, _ in self._search(self._snapshot(), query_vec, limit)]
+
+    def drop_collection(self) -> None:
+        with self._lock:
+            self._save(np.empty((0, self._embedding_dim), dtype=np.float32), [], [])
+
+    def sync_from_qdrant(self, vecdb_client: VecDBClient, batch_size: int = 256) -> int:
+        """
+        Replace the local index with the points of the same collection in Qdrant.
+        :param vecdb_client: Qdrant client
+        :param batch_size: number of points fetched per scroll request
+        :return: the number of synced vectors
+        """
+        vectors, ids, payloads = [], [], []
+        offset = None
+        while True:
+            points, offset = vecdb_client.scroll(
+                collection_name=self._collection_name,
+                limit=batch_size,
+                offset=offset,
+                with_payload=True,
+                with_vectors=True
+            )
+            for point in points:
+                vectors.append(point.vector)
+                ids.append(str(point.id))
+                payloads.append(point.payload)
+            if offset is None:
+                break
+
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(-1, self._embedding_dim)
+        with self._lock:
+            self._save(self._normalize(matrix), ids, payloads)
+
+        return len(ids)
@@ -1,6 +1,64 @@
-from typing import Tuple, List
+import io
+import json
+import re
+from contextlib import contextmanager
+from typing import Any, Iterable, Iterator, Tuple, List
 
 import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+
+def split_values_template(query: str) -> Tuple[str, str]:
+    """
+    Split ``INSERT ... VALUES (%s, ...)`` into ``INSERT ... VALUES %s`` and the row template
+    ``(%s, ...)``, as expected by ``execute_values``.
+    """
+    match = re.match(r"^(.*\bVALUES\s*)(\(.*\))\s*;?\s*$", query, flags=re.IGNORECASE | re.DOTALL)
+    if match is None:
+        raise ValueError(f"Not an INSERT ... VALUES (...) query: {query}")
+    return match.group(1) + "%s", match.group(2)
+
+
+def _copy_quote(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _array_literal(values: Iterable) -> str:
+    elements = []
+    for value in values:
+        if value is None:
+            elements.append("NULL")
+        else:
+            elements.append('"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"')
+    return "{" + ",".join(elements) + "}"
+
+
+def _copy_field(value: Any) -> str:
+    """
+    Encode a value as a CSV field of COPY: dicts become JSON (for JSONB columns), lists and
+    tuples become array literals, None becomes NULL.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, dict):
+        return _copy_quote(json.dumps(value, ensure_ascii=False))
+    if isinstance(value, (list, tuple)):
+        return _copy_quote(_array_literal(value))
+    return _copy_quote(str(value))
+
+
+def rows_to_copy_buffer(rows: Iterable[Tuple]) -> io.StringIO:
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(",".join(map(_copy_field, row)))
+        buffer.write("\n")
+    buffer.seek(0)
+    return buffer
 
 
 class PostgresqlClient:
@@ -14,23 +72,98 @@ class PostgresqlClient:
         )
         self.cursor = self.conn.cursor()
 
+    @contextmanager
+    def transaction(self) -> Iterator[psycopg2.extensions.cursor]:
+        """
+        Cursor of a transaction that is committed on success and rolled back on error.
+        """
+        try:
+            yield self.cursor
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+
     def execute_query(self, query, params=None):
         self.cursor.execute(query, params)
         return self.cursor.fetchall()
 
     def execute_insert(self, query, params):
-        self.cursor.execute(query, params)
-        self.conn.commit()
+        with self.transaction() as cursor:
+            cursor.execute(query, params)
 
     def execute_insert_many(self, query, params: List[Tuple]):
-        self.cursor.executemany(query, params)
-        self.conn.commit()
+        with self.transaction() as cursor:
+            cursor.executemany(query, params)
+
+    def execute_insert_batch(self, query, params: List[Tuple], page_size: int = 1000):
+        """
+        Insert rows with multi-row INSERT statements, ``page_size`` rows per round trip.
+        :param query: ``INSERT ... VALUES (%s, ...)`` query, e.g. a template from sql.ini
+        :param params: rows
+        :param page_size: number of rows per statement
+        """
+        values_query, template = split_values_template(query)
+        with self.transaction() as cursor:
+            execute_values(cursor, values_query, params, template=template, page_size=page_size)
+
+    def copy_insert(self, target: str, rows: Iterable[Tuple], batch_size: int = 10000) -> int:
+        """
+        Bulk-load rows with ``COPY ... FROM STDIN``, one round trip per batch, in one transaction.
+        :param target: table and column list, e.g. ``questions (doc_code, question_id, ...)``
+        :param rows: rows; dicts are loaded as JSON and lists as arrays
+        :param batch_size: number of rows per COPY
+        :return: the number of loaded rows
+        """
+        rows = list(rows)
+        with self.transaction() as cursor:
+            for start in range(0, len(rows), batch_size):
+                cursor.copy_expert(
+                    f"COPY {target} FROM STDIN WITH (FORMAT csv)",
+                    rows_to_copy_buffer(rows[start:start + batch_size])
+                )
+        return len(rows)
 
     def execute_delete(self, query, params):
-        self.cursor.execute(query, params)
-        self.conn.commit()
+        with self.transaction() as cursor:
+            cursor.execute(query, params)
 
     def close(self):
         self.cursor.close()
         self.conn.close()
 
+
+class PooledPostgresqlClient(PostgresqlClient):
+    """
+    ``PostgresqlClient`` for concurrent callers: every call borrows a connection from a
+    ``psycopg2`` thread-safe connection pool and runs in its own transaction.
+    """
+
+    def __init__(self, database, user, password, host, port, min_connections: int = 1, max_connections: int = 8):
+        self.pool = ThreadedConnectionPool(
+            min_connections,
+            max_connections,
+            host=host,
+            port=port,
+            database=database,
+            user=user,
+            password=password
+        )
+
+    @contextmanager
+    def transaction(self) -> Iterator[psycopg2.extensions.cursor]:
+        conn = self.pool.getconn()
+        try:
+            with conn:  # commits on success, rolls back on error
+                with conn.cursor() as cursor:
+                    yield cursor
+        finally:
+            self.pool.putconn(conn)
+
+    def execute_query(self, query, params=None):
+        with self.transaction() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+    def close(self):
+        self.pool.closeall()
@@ -0,0 +1,292 @@
+import os
+import queue
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Callable, Generic, Iterator, Optional, TypeVar
+
+from redis import BlockingConnectionPool
+
+from .hedging import HedgingPolicy
+from .localvecdb import LocalVecDBClient
+from .redisdb import ChatBotRedisClient
+from .vecdb import VecDBClient
+
+T = TypeVar("T")
+
+
+class PoolExhaustedError(Exception):
+    pass
+
+
+class ClientPool(Generic[T]):
+    """
+    Thread-safe pool of reusable clients, created lazily up to ``size``.
+
+    Idle clients are health-checked before they are handed out again once they have been idle
+    for ``health_check_interval`` seconds. The pool is fork-safe: clients inherited from a parent
+    process are discarded, and the child process builds its own on demand.
+    """
+
+    def __init__(
+            self,
+            factory: Callable[[], T],
+            size: int = 8,
+            health_check: Optional[Callable[[T], bool]] = None,
+            health_check_interval: float = 30.0,
+            acquire_timeout: float = 10.0,
+            close: Optional[Callable[[T], None]] = None
+    ) -> None:
+        """
+        :param factory: function creating a new client
+        :param size: maximum number of clients
+        :param health_check: function returning whether a client is still usable
+        :param health_check_interval: idle time after which a client is health-checked, in seconds
+        :param acquire_timeout: maximum time to wait for a free client, in seconds
+        :param close: function closing a discarded client
+        """
+        self._factory = factory
+        self._size = size
+        self._health_check = health_check
+        self._health_check_interval = health_check_interval
+        self._acquire_timeout = acquire_timeout
+        self._close = close
+
+        self._reset()
+
+        # Re-initialize in children of pre-fork servers
+        pool_ref = weakref.ref(self)
+
+        def reset_after_fork() -> None:
+            pool = pool_ref()
+            if pool is not None:
+                pool._reset()
+
+        os.register_at_fork(after_in_child=reset_after_fork)
+
+    def _reset(self) -> None:
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._idle: queue.LifoQueue[tuple[T, float]] = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self._size)
+        self._num_created = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def _check_pid(self) -> None:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    def acquire(self) -> T:
+        """
+        Take a client from the pool, creating one if none is idle.
+        :return: client, to be given back with ``release``
+        """
+        self._check_pid()
+        if not self._slots.acquire(timeout=self._acquire_timeout):
+            raise PoolExhaustedError(f"No client available after {self._acquire_timeout}s")
+
+        try:
+            while True:
+                try:
+                    client, released_at = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+
+                if (
+                        self._health_check is None
+                        or time.monotonic() - released_at < self._health_check_interval
+                        or self._is_healthy(client)
+                ):
+                    return client
+                self._discard(client)
+
+            client = self._factory()
+            with self._lock:
+                self._num_created += 1
+            return client
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, client: T, healthy: bool = True) -> None:
+        """
+        Give a client back to the pool.
+        :param client: client obtained from ``acquire``
+        :param healthy: False to discard the client, e.g. after a connection error
+        """
+        if self._pid != os.getpid():
+            # Borrowed before a fork; the new process has its own pool state
+            return
+
+        if healthy:
+            self._idle.put((client, time.monotonic()))
+        else:
+            self._discard(client)
+        self._slots.release()
+
+    @contextmanager
+    def borrow(self) -> Iterator[T]:
+        client = self.acquire()
+        healthy = True
+        try:
+            yield client
+        except Exception:
+            # The client may hold a broken connection; a fresh one is created on demand
+            healthy = False
+            raise
+        finally:
+            self.release(client, healthy=healthy)
+
+    def _is_healthy(self, client: T) -> bool:
+        try:
+            return bool(self._health_check(client))
+        except Exception as e:
+            print(f"Pooled client failed health check. Exception: {e}")
+            return False
+
+    def _discard(self, client: T) -> None:
+        with self._lock:
+            self._num_created -= 1
+        if self._close is not None:
+            try:
+                self._close(client)
+            except Exception as e:
+                print(f"Error closing pooled client: {e}")
+
+    def close_all(self) -> None:
+        while True:
+            try:
+                client, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(client)
+
+    def stats(self) -> dict:
+        return {
+            "size": self._size,
+            "created": self._num_created,
+            "idle": self._idle.qsize(),
+        }
+
+
+def _qdrant_health_check(client: VecDBClient) -> bool:
+    client.get_collections()
+    return True
+
+
+def create_vecdb_pool(
+        url: str,
+        collection_name: str,
+        embedding_dim: int = 1536,
+        size: int = 8,
+        health_check_interval: float = 30.0,
+        **kwargs
+) -> ClientPool[VecDBClient]:
+    """
+    Pool of ``VecDBClient`` checked out on ``collection_name``.
+    """
+    return ClientPool(
+        factory=lambda: VecDBClient(
+            url=url,
+            collection_name=collection_name,
+            embedding_dim=embedding_dim,
+            **kwargs
+        ),
+        size=size,
+        health_check=_qdrant_health_check,
+        health_check_interval=health_check_interval,
+        close=lambda client: client.close()
+    )
+
+
+def create_redis_client(
+        host: str,
+        port: int,
+        password: Optional[str],
+        db: int = 0,
+        max_connections: int = 32,
+        health_check_interval: int = 30,
+        timeout: float = 10.0
+) -> ChatBotRedisClient:
+    """
+    ``ChatBotRedisClient`` backed by a bounded, blocking connection pool.
+
+    The client is thread-safe and meant to be shared by the whole process; redis-py resets
+    the connection pool by itself when it detects it is used after a fork.
+    """
+    connection_pool = BlockingConnectionPool(
+        host=host,
+        port=port,
+        password=password,
+        db=db,
+        max_connections=max_connections,
+        health_check_interval=health_check_interval,
+        timeout=timeout,
+    )
+    return ChatBotRedisClient(connection_pool=connection_pool)
+
+
+class ConnectionPools:
+    """
+    Process-wide pools for the API, created once per worker process.
+    """
+
+    def __init__(self, config: dict) -> None:
+        qdrant_config = config['qdrant']
+        redis_config = config['redis']
+        pool_config = config.get('pool', {})
+
+        # Shared by the document clients, so that the hedge delay follows the latency of the whole pool
+        self.hedging = HedgingPolicy.from_config(qdrant_config.get("retrieval"))
+
+        if qdrant_config.get("backend", "remote") == "local":
+            # One shared, read-mostly index per process, handed out through the same pool API
+            local_client = LocalVecDBClient(
+                index_path=qdrant_config.get("local_index_path", "./vecdb_index"),
+                collection_name=qdrant_config["document_collection_name"],
+                embedding_dim=qdrant_config["embedding_dim"],
+            )
+            self.qdrant = ClientPool(factory=lambda: local_client, size=pool_config.get('qdrant_size', 8))
+        else:
+            self.qdrant = create_vecdb_pool(
+                url=qdrant_config["url"],
+                collection_name=qdrant_config["document_collection_name"],
+                embedding_dim=qdrant_config["embedding_dim"],
+                size=pool_config.get('qdrant_size', 8),
+                health_check_interval=pool_config.get('health_check_interval', 30),
+                quantization=qdrant_config.get("quantization"),
+                hedging=self.hedging,
+            )
+        self.answer_cache_qdrant = create_vecdb_pool(
+            url=qdrant_config["url"],
+            collection_name=qdrant_config.get("answer_cache_collection_name", "answer_cache"),
+            embedding_dim=qdrant_config["embedding_dim"],
+            size=pool_config.get('qdrant_size', 8),
+            health_check_interval=pool_config.get('health_check_interval', 30),
+        )
+        self.redis = create_redis_client(
+            host=redis_config["host"],
+            port=redis_config["port"],
+            password=redis_config["password"],
+            db=0,
+            max_connections=pool_config.get('redis_max_connections', 32),
+            health_check_interval=pool_config.get('health_check_interval', 30),
+        )
+
+    def stats(self) -> dict:
+        return {
+            "qdrant": self.qdrant.stats(),
+            "answer_cache_qdrant": self.answer_cache_qdrant.stats(),
+            "retrieval": self.hedging.stats() if self.hedging is not None else None,
+        }
+
+    def close(self) -> None:
+        self.qdrant.close_all()
+        self.answer_cache_qdrant.close_all()
+        self.redis.close()
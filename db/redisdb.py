@@ -1,9 +1,29 @@
-from typing import List, Dict
+import json
+import uuid
+from typing import Iterator, List, Dict, Optional, Tuple
 
 from redis import StrictRedis
+from redis.asyncio import StrictRedis as AsyncStrictRedis
+
+from schema import ChatMessage
 
 
 class ChatBotRedisClient(StrictRedis):
+    def __init__(self, host="localhost", port=6379, password=None, db=0, **kwargs):
+        super().__init__(
+            host=host,
+            port=port,
+            password=password,
+            db=db,
+            **kwargs
+        )
+
+
+class AsyncChatBotRedisClient(AsyncStrictRedis):
+    """
+    Async counterpart of ``ChatBotRedisClient`` for the asyncio serving path.
+    """
+
     def __init__(self, host, port, password, db):
         super().__init__(
             host=host,
@@ -11,20 +31,219 @@ class ChatBotRedisClient(StrictRedis):
             password=password,
             db=db,
         )
-        self.key_chat_history = "qa:{}"
 
-    def get_chat_history(self, user_id: str) -> List[Dict]:
-        key = self.key_chat_history.format(user_id)
-        chat_history = self.lrange(key, 0, -1)[::-1]  # 左侧入队（最新），倒序后时间顺序为最旧到最新
-        chat_history_decoded = [item.decode("utf-8") for item in chat_history]
 
-        if not chat_history_decoded:
-            return []
+class ChatHistoryStore:
+    """
+    Role-tagged chat history of each user, kept in a Redis list.
+
+    Every record is a compact JSON ``{"role": ..., "content": ...}`` object, so the history is
+    read back as ready-to-send OpenAI messages with a single ``json.loads`` call. Appending,
+    trimming and refreshing the TTL happen in one MULTI/EXEC round trip.
+    """
+
+    def __init__(
+            self,
+            redis_client: StrictRedis,
+            max_len: int = 6,
+            ttl: int = 1800,
+            key_template: str = "qa:history:{}"
+    ) -> None:
+        """
+        :param redis_client: Redis client
+        :param max_len: maximum number of messages kept per user
+        :param ttl: lifetime of a history after its last update, in seconds
+        :param key_template: Redis key template, formatted with the user id
+        """
+        self._redis_client = redis_client
+        self._max_len = max_len
+        self._ttl = ttl
+        self._key_template = key_template
+
+    @property
+    def max_len(self) -> int:
+        return self._max_len
+
+    def key(self, user_id: str) -> str:
+        return self._key_template.format(user_id)
+
+    @staticmethod
+    def encode(message: ChatMessage) -> bytes:
+        return json.dumps(message.to_dict(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    @staticmethod
+    def decode(records: List[bytes]) -> List[Dict]:
+        # Join the records into one JSON array instead of decoding them one by one
+        return json.loads(b"[" + b",".join(records) + b"]")
+
+    def append(self, user_id: str, *messages: ChatMessage) -> int:
+        """
+        Append messages, keep the newest ``max_len`` of them and refresh the TTL.
+        :param user_id: user id
+        :param messages: messages in chronological order
+        :return: the number of messages kept
+        """
+        key = self.key(user_id)
+        with self._redis_client.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, *map(self.encode, messages))
+            pipe.ltrim(key, -self._max_len, -1)
+            pipe.expire(key, self._ttl)
+            length, _, _ = pipe.execute()
+        return min(length, self._max_len)
+
+    def get(self, user_id: str) -> List[Dict]:
+        """
+        :param user_id: user id
+        :return: OpenAI messages, oldest first
+        """
+        return self.decode(self._redis_client.lrange(self.key(user_id), 0, -1))
+
+    def clear(self, user_id: str) -> None:
+        self._redis_client.delete(self.key(user_id))
+
+
+class StreamJournal:
+    """
+    Short-lived Redis Stream copy of the SSE events of a ``/qa/stream`` response.
+
+    Every generation of a message gets its own stream, and a pointer key holds the stream of the
+    latest one, so a message posted again starts afresh while an earlier generation may still be
+    draining. Event ``seq`` is stored under stream id ``0-<seq>`` and a final entry marks the end
+    of the generation, so a client reconnecting with ``Last-Event-ID`` can be served the
+    remaining events, including ones that are still being generated.
+
+    Writes are best-effort: a Redis error is logged and never interrupts the response.
+    """
+
+    def __init__(
+            self,
+            redis_client: StrictRedis,
+            ttl: int = 300,
+            block_ms: int = 15000,
+            key_template: str = "qa:stream:{}"
+    ) -> None:
+        """
+        :param redis_client: Redis client
+        :param ttl: lifetime of a journal after its last event, in seconds
+        :param block_ms: how long a reader waits for the next event before giving up, in milliseconds
+        :param key_template: Redis key template of the pointer, formatted with the message id
+        """
+        self._redis_client = redis_client
+        self._ttl = ttl
+        self._block_ms = block_ms
+        self._key_template = key_template
+
+    def key(self, message_id: str) -> str:
+        return self._key_template.format(message_id)
+
+    def current_stream(self, message_id: str) -> Optional[str]:
+        """
+        :return: key of the stream of the latest generation, or None if it has expired
+        """
+        stream_key = self._redis_client.get(self.key(message_id))
+        if stream_key is None:
+            return None
+        return stream_key.decode("utf-8") if isinstance(stream_key, bytes) else stream_key
+
+    def exists(self, message_id: str) -> bool:
+        try:
+            stream_key = self.current_stream(message_id)
+            return stream_key is not None and bool(self._redis_client.exists(stream_key))
+        except Exception as e:
+            print(f"Stream journal lookup failed. Exception: {e}")
+            return False
+
+    def start(self, message_id: str) -> "StreamJournalWriter":
+        """
+        Start a new generation of a message; readers are pointed at it right away.
+        """
+        writer = StreamJournalWriter(self, message_id, f"{self.key(message_id)}:{uuid.uuid4().hex}")
+        try:
+            self._redis_client.set(self.key(message_id), writer.stream_key, ex=self._ttl)
+        except Exception as e:
+            print(f"Stream journal start failed. Exception: {e}")
+        return writer
+
+    def _add(self, message_id: str, stream_key: str, seq: int, fields: dict) -> None:
+        try:
+            with self._redis_client.pipeline(transaction=False) as pipe:
+                pipe.xadd(stream_key, fields, id=f"0-{seq}")
+                pipe.expire(stream_key, self._ttl)
+                pipe.expire(self.key(message_id), self._ttl)
+                pipe.execute()
+        except Exception as e:
+            print(f"Stream journal <{stream_key}> write of event {seq} failed. Exception: {e}")
+
+    def read(self, message_id: str, last_seq: int = 0) -> Iterator[Tuple[int, str]]:
+        """
+        Events of the latest generation after ``last_seq``, tailing the journal until the
+        generation is complete. Stops early if no new event arrives within ``block_ms``.
+        :param message_id: message id
+        :param last_seq: last event received by the client
+        :return: (seq, data) pairs
+        """
+        key = self.current_stream(message_id)
+        if key is None:
+            return
+        while True:
+            response = self._redis_client.xread({key: f"0-{last_seq}"}, count=100, block=self._block_ms)
+            if not response:
+                print(f"Stream journal <{key}> stalled after event {last_seq}")
+                return
+
+            for entry_id, fields in response[0][1]:
+                if b"done" in fields:
+                    return
+                last_seq = int(entry_id.split(b"-")[1])
+                yield last_seq, fields[b"data"].decode("utf-8")
+
+    @staticmethod
+    def parse_event_id(event_id: Optional[str]) -> Optional[int]:
+        try:
+            return int(event_id)
+        except (TypeError, ValueError):
+            return None
+
+
+class StreamJournalWriter:
+    """
+    Writes the events of one generation, see ``StreamJournal.start``.
+    """
+
+    def __init__(self, journal: StreamJournal, message_id: str, stream_key: str) -> None:
+        self._journal = journal
+        self._message_id = message_id
+        self.stream_key = stream_key
+
+    def append(self, seq: int, data: str) -> None:
+        """
+        Record event ``seq`` (counting from 1).
+        """
+        self._journal._add(self._message_id, self.stream_key, seq, {"data": data})
+
+    def finish(self, last_seq: int) -> None:
+        """
+        Mark the generation as complete after event ``last_seq``.
+        """
+        self._journal._add(self._message_id, self.stream_key, last_seq + 1, {"done": 1})
+
+
+class AsyncChatHistoryStore(ChatHistoryStore):
+    """
+    ``ChatHistoryStore`` on an asyncio Redis client.
+    """
 
-        openai_messages = []
-        for idx, message in enumerate(chat_history_decoded):
-            role = "user" if idx % 2 == 1 else "assistant"
-            openai_messages.append({"role": role, "content": message})
+    async def append(self, user_id: str, *messages: ChatMessage) -> int:
+        key = self.key(user_id)
+        async with self._redis_client.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, *map(self.encode, messages))
+            pipe.ltrim(key, -self._max_len, -1)
+            pipe.expire(key, self._ttl)
+            length, _, _ = await pipe.execute()
+        return min(length, self._max_len)
 
-        return openai_messages
+    async def get(self, user_id: str) -> List[Dict]:
+        return self.decode(await self._redis_client.lrange(self.key(user_id), 0, -1))
 
+    async def clear(self, user_id: str) -> None:
+        await self._redis_client.delete(self.key(user_id))
@@ -1,20 +1,99 @@
 from typing import Self, Optional, List
 from uuid import UUID, uuid4
-from qdrant_client import QdrantClient
+from qdrant_client import QdrantClient, AsyncQdrantClient
 from qdrant_client.http.models import ScoredPoint
 from qdrant_client.models import (
     PointStruct,
     VectorParams,
-    Distance
+    Distance,
+    Filter,
+    PointIdsList,
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    QuantizationConfig,
+    QuantizationSearchParams,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+    SearchRequest,
+    VectorParamsDiff
 )
 
+from .hedging import HedgingPolicy, server_timeout
+
+
+def build_quantization_config(quantization: Optional[dict]) -> Optional[QuantizationConfig]:
+    """
+    Qdrant quantization config from the ``qdrant.quantization`` section of config.yaml
+    :param quantization: e.g. {"mode": "scalar", "always_ram": True, "quantile": 0.99}
+    :return: quantization config, or None for mode "none"
+    """
+    mode = (quantization or {}).get("mode", "none")
+    always_ram = quantization.get("always_ram", True) if quantization else True
+
+    match mode:
+        case "none":
+            return None
+        case "scalar":
+            return ScalarQuantization(
+                scalar=ScalarQuantizationConfig(
+                    type=ScalarType.INT8,
+                    quantile=quantization.get("quantile", 0.99),
+                    always_ram=always_ram
+                )
+            )
+        case "binary":
+            return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=always_ram))
+        case _:
+            raise ValueError(f"Unknown quantization mode: {mode}")
+
+
+def build_search_params(quantization: Optional[dict]) -> Optional[SearchParams]:
+    """
+    Search params of a collection quantized as configured in ``qdrant.quantization``
+    :param quantization: e.g. {"mode": "binary", "rescore": True, "oversampling": 2.0}
+    :return: rescoring and oversampling of the quantized search, or None for mode "none"
+    """
+    if (quantization or {}).get("mode", "none") == "none":
+        return None
+
+    return SearchParams(
+        quantization=QuantizationSearchParams(
+            rescore=quantization.get("rescore", True),
+            oversampling=quantization.get("oversampling", 2.0)
+        )
+    )
+
 
 class VecDBClient(QdrantClient):
 
-    def __init__(self, collection_name: str, embedding_dim: int = 1536, *args, **kwargs) -> None:
+    def __init__(
+            self,
+            collection_name: str,
+            embedding_dim: int = 1536,
+            *args,
+            quantization: Optional[dict] = None,
+            hedging: Optional[HedgingPolicy] = None,
+            **kwargs
+    ) -> None:
+        """
+        :param collection_name: collection name
+        :param embedding_dim: embedding dimension
+        :param quantization: quantization settings of created collections and searches:
+            mode ("none", "scalar" or "binary"), always_ram, quantile, on_disk (keep original
+            vectors on disk), oversampling and rescore
+        :param hedging: deadline and hedging of ``retrieve_similar_vectors``, shared by the clients of a pool
+        """
         # Initialize super class
         super().__init__(*args, **kwargs)
 
+        # Quantization
+        self._quantization = quantization or {}
+
+        # Deadlines and hedged searches
+        self._hedging = hedging
+
         # # Create a new collection if it does not exist
         # if collection_name and collection_name not in self.collection_names:
         #     self.recreate_collection(
@@ -98,28 +177,146 @@ class VecDBClient(QdrantClient):
             print(f"Error inserting vector: {e}")
             return 0
 
-    def retrieve_similar_vectors(self, query_vec: list[float], top_k: int = 5) -> list[dict]:
+    @property
+    def is_quantized(self) -> bool:
+        return self._quantization.get("mode", "none") != "none"
+
+    def _vectors_config(self) -> VectorParams:
+        return VectorParams(
+            size=self._embedding_dim,
+            distance=Distance.COSINE,
+            # With quantization, only the quantized vectors need to stay in RAM
+            on_disk=self._quantization.get("on_disk", True) if self.is_quantized else None
+        )
+
+    def _search_params(self) -> Optional[SearchParams]:
+        return build_search_params(self._quantization)
+
+    def create_collection_if_not_exists(self) -> None:
+        if self._collection_name in self.collection_names:
+            return
+
+        self.create_collection(
+            collection_name=self._collection_name,
+            vectors_config=self._vectors_config(),
+            quantization_config=build_quantization_config(self._quantization)
+        )
+        print(f"Created collection <{self._collection_name}>")
+
+    def apply_quantization(self) -> None:
+        """
+        Apply the configured quantization to the existing collection; Qdrant re-indexes it in place.
+        """
+        self.update_collection(
+            collection_name=self._collection_name,
+            vectors_config={"": VectorParamsDiff(on_disk=self._vectors_config().on_disk)} if self.is_quantized else None,
+            quantization_config=build_quantization_config(self._quantization)
+        )
+
+    def retrieve_similar_vectors(
+            self,
+            query_vec: list[float],
+            top_k: int = 5,
+            score_threshold: float = 0.80,
+            query_filter: Optional[Filter] = None,
+            timeout: Optional[float] = None
+    ) -> list[dict]:
         """
         Retrieve similar vectors
         :param query_vec: query vector
         :param top_k: number of similar vectors to retrieve
+        :param score_threshold: minimum similarity score of returned points
+        :param query_filter: optional payload filter
+        :param timeout: deadline in seconds, defaults to the hedging policy's; past it,
+            ``SearchTimeoutError`` is raised (without a hedging policy, only Qdrant's own timeout applies)
         :return: list of PointStruct Payload
         """
-        # Find similar points
-        points = self.search(
-            collection_name=self._collection_name,
-            query_vector=query_vec,
-            limit=top_k,
-            with_payload=True
-        )
+        if timeout is None and self._hedging is not None:
+            timeout = self._hedging.timeout
+
+        def search() -> list[ScoredPoint]:
+            # Find similar points
+            return self.search(
+                collection_name=self._collection_name,
+                query_vector=query_vec,
+                query_filter=query_filter,
+                search_params=self._search_params(),
+                limit=top_k,
+                with_payload=True,
+                timeout=server_timeout(timeout)
+            )
+
+        points = self._hedging.call(search, timeout) if self._hedging is not None else search()
 
-        return [point.payload for point in points if point.score >= 0.80]
+        return [point.payload for point in points if point.score >= score_threshold]
+
+    def retrieve_similar_vectors_batch(
+            self,
+            query_vecs: list[list[float]],
+            top_k: int = 5,
+            score_threshold: float = 0.80,
+            query_filter: Optional[Filter] = None,
+            timeout: Optional[float] = None
+    ) -> list[list[dict]]:
+        """
+        Retrieve similar vectors of several queries with one search_batch request
+        :param query_vecs: query vectors
+        :param top_k: number of similar vectors to retrieve per query
+        :param score_threshold: minimum similarity score of returned points
+        :param query_filter: optional payload filter, applied to every query
+        :param timeout: deadline of the whole batch in seconds, see ``retrieve_similar_vectors``
+        :return: list of PointStruct Payload per query, in the order of ``query_vecs``
+        """
+        if not query_vecs:
+            return []
+        if timeout is None and self._hedging is not None:
+            timeout = self._hedging.timeout
+
+        def search_batch() -> list[list[ScoredPoint]]:
+            return self.search_batch(
+                collection_name=self._collection_name,
+                requests=[
+                    SearchRequest(
+                        vector=query_vec,
+                        filter=query_filter,
+                        params=self._search_params(),
+                        limit=top_k,
+                        with_payload=True,
+                        score_threshold=score_threshold
+                    ) for query_vec in query_vecs
+                ],
+                timeout=server_timeout(timeout)
+            )
+
+        batches = self._hedging.call(search_batch, timeout) if self._hedging is not None else search_batch()
+
+        return [[point.payload for point in points] for points in batches]
+
+    def delete_vectors(self, vec_ids: list[str]) -> int:
+        """
+        Delete vectors by id
+        :param vec_ids: ids of the vectors to delete
+        :return: the number of deleted ids
+        """
+        if not vec_ids:
+            return 0
+
+        try:
+            self.delete(
+                collection_name=self._collection_name,
+                points_selector=PointIdsList(points=vec_ids)
+            )
+            return len(vec_ids)
+        except Exception as e:
+            print(f"Error deleting vectors: {e}")
+            return 0
 
     def retrieve_similar_note_vec_ids(self, query_vec: list[float], limit: int = 5) -> list[UUID]:
         # Find similar points
         points = self.search(
             collection_name=self._collection_name,
             query_vector=query_vec,
+            search_params=self._search_params(),
             limit=limit
         )
 
@@ -139,10 +336,124 @@ class VecDBClient(QdrantClient):
         # Recreate the collection
         self.recreate_collection(
             collection_name=self._collection_name,
-            vectors_config=VectorParams(
-                size=self._embedding_dim,
-                distance=Distance.COSINE
+            vectors_config=self._vectors_config(),
+            quantization_config=build_quantization_config(self._quantization)
+        )
+
+
+class AsyncVecDBClient(AsyncQdrantClient):
+    """
+    Async counterpart of ``VecDBClient`` for the asyncio serving path.
+    """
+
+    def __init__(
+            self,
+            collection_name: str,
+            embedding_dim: int = 1536,
+            *args,
+            quantization: Optional[dict] = None,
+            hedging: Optional[HedgingPolicy] = None,
+            **kwargs
+    ) -> None:
+        """
+        :param quantization: quantization settings of searches, see ``VecDBClient``
+        """
+        super().__init__(*args, **kwargs)
+        self._collection_name = collection_name
+        self._embedding_dim = embedding_dim
+        self._quantization = quantization or {}
+        self._hedging = hedging
+
+    @property
+    def collection_name(self) -> Optional[str]:
+        return self._collection_name
+
+    @property
+    def is_quantized(self) -> bool:
+        return self._quantization.get("mode", "none") != "none"
+
+    def _vectors_config(self) -> VectorParams:
+        return VectorParams(
+            size=self._embedding_dim,
+            distance=Distance.COSINE,
+            on_disk=self._quantization.get("on_disk", True) if self.is_quantized else None
+        )
+
+    async def create_collection_if_not_exists(self) -> None:
+        if await self.collection_exists(self._collection_name):
+            return
+
+        await self.create_collection(
+            collection_name=self._collection_name,
+            vectors_config=self._vectors_config(),
+            quantization_config=build_quantization_config(self._quantization)
+        )
+        print(f"Created collection <{self._collection_name}>")
+
+    async def insert_vector(self, vec_id: str, vector: list[float], payload: dict) -> int:
+        """
+        Insert the embedding vector
+        :param vec_id: 's id in vecdb
+        :param vector: embedding vector
+        :param payload: appending data
+        :return: the number of inserted vectors
+        """
+        try:
+            await self.upsert(
+                collection_name=self._collection_name,
+                points=[
+                    PointStruct(
+                        id=vec_id,
+                        vector=vector,
+                        payload=payload
+                    )
+                ]
             )
+            return 1
+        except Exception as e:
+            print(f"Error inserting vector: {e}")
+            return 0
+
+    async def drop_collection(self) -> None:
+        # Delete and recreate the collection
+        await self.delete_collection(self._collection_name)
+        await self.create_collection(
+            collection_name=self._collection_name,
+            vectors_config=self._vectors_config(),
+            quantization_config=build_quantization_config(self._quantization)
         )
 
+    async def retrieve_similar_vectors(
+            self,
+            query_vec: list[float],
+            top_k: int = 5,
+            score_threshold: float = 0.80,
+            query_filter: Optional[Filter] = None,
+            timeout: Optional[float] = None
+    ) -> list[dict]:
+        """
+        Retrieve similar vectors
+        :param query_vec: query vector
+        :param top_k: number of similar vectors to retrieve
+        :param score_threshold: minimum similarity score of returned points
+        :param query_filter: optional payload filter
+        :param timeout: deadline in seconds, defaults to the hedging policy's
+        :return: list of PointStruct Payload
+        """
+        if timeout is None and self._hedging is not None:
+            timeout = self._hedging.timeout
+
+        def search():
+            return self.search(
+                collection_name=self._collection_name,
+                query_vector=query_vec,
+                query_filter=query_filter,
+                search_params=build_search_params(self._quantization),
+                limit=top_k,
+                with_payload=True,
+                timeout=server_timeout(timeout)
+            )
+
+        points = await (self._hedging.acall(search, timeout) if self._hedging is not None else search())
 
+        return [point.payload for point in points if point.score >= score_threshold]
@@ -0,0 +1,110 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, NamedTuple
+
+
+class _EmbeddingRequest(NamedTuple):
+    text: str
+    embedding_model_name: str
+    future: Future
+
+
+class BatchEmbedder:
+    """
+    Micro-batching embedder.
+
+    Concurrent ``embed`` calls are collected for up to ``max_wait_ms`` milliseconds, or until
+    ``max_batch_size`` texts are queued, and sent to the embedding API as one batched call.
+    The resulting vectors are fanned back out to the waiting callers.
+    """
+
+    def __init__(
+            self,
+            embed_batch: Callable[[list[str], str], list[list[float]]],
+            max_batch_size: int = 64,
+            max_wait_ms: float = 5.0
+    ) -> None:
+        """
+        :param embed_batch: function embedding a list of texts with the given model, in order
+        :param max_batch_size: maximum number of texts per API call
+        :param max_wait_ms: batching window, in milliseconds
+        """
+        self._embed_batch = embed_batch
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000
+
+        self._queue: queue.SimpleQueue[_EmbeddingRequest] = queue.SimpleQueue()
+        self._worker: threading.Thread | None = None
+        self._worker_pid: int | None = None
+        self._lock = threading.Lock()
+
+    def embed(self, text: str, embedding_model_name: str) -> list[float]:
+        """
+        Embed a single text. Blocks until the batch containing it has been embedded.
+        """
+        return self.submit(text, embedding_model_name).result()
+
+    def submit(self, text: str, embedding_model_name: str) -> Future:
+        self._ensure_worker()
+        future = Future()
+        self._queue.put(_EmbeddingRequest(text, embedding_model_name, future))
+        return future
+
+    def _ensure_worker(self) -> None:
+        # The worker thread does not survive a fork, so start one lazily in every process
+        if self._worker_pid == os.getpid() and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker_pid != os.getpid() or not self._worker.is_alive():
+                # The queue is kept: requests queued before a restart are served by the new thread
+                self._worker = threading.Thread(target=self._run, name="batch-embedder", daemon=True)
+                self._worker.start()
+                self._worker_pid = os.getpid()
+
+    def _collect_batch(self) -> list[_EmbeddingRequest]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self._max_wait
+        while len(batch) < self._max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            try:
+                self._embed_requests(batch)
+            except Exception as e:
+                # Never let a batch kill the worker: its callers would wait forever
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def _embed_requests(self, batch: list[_EmbeddingRequest]) -> None:
+        # One API call per model, with identical texts embedded once
+        requests_by_model: dict[str, list[_EmbeddingRequest]] = {}
+        for request in batch:
+            requests_by_model.setdefault(request.embedding_model_name, []).append(request)
+
+        for embedding_model_name, requests in requests_by_model.items():
+            texts = list(dict.fromkeys(request.text for request in requests))
+            try:
+                vectors = self._embed_batch(texts, embedding_model_name)
+                if len(vectors) != len(texts):
+                    raise ValueError(f"Embedding API returned {len(vectors)} vectors for {len(texts)} texts")
+            except Exception as e:
+                for request in requests:
+                    request.future.set_exception(e)
+                continue
+
+            embeddings = dict(zip(texts, vectors))
+            for request in requests:
+                request.future.set_result(embeddings[request.text])
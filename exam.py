@@ -0,0 +1,224 @@
+import hashlib
+import json
+import random
+import threading
+from array import array
+from typing import NamedTuple, Optional
+
+from redis import StrictRedis
+
+from marking import Question, QuestionBank
+
+# Pool entries pack the index of the doc_code and the question id into one 64-bit integer
+DOC_INDEX_SHIFT = 32
+QUESTION_ID_MASK = (1 << DOC_INDEX_SHIFT) - 1
+
+
+class PaperPool(NamedTuple):
+    # Version of the pool's questions and paper layout, part of the cache keys
+    digest: str
+    doc_codes: tuple[str, ...]
+    # Packed question ids by question type, sorted
+    question_ids: dict[int, array]
+
+
+class PaperIndex(NamedTuple):
+    version: int
+    # Snapshot of the question bank the pools were built from
+    questions: dict[tuple[str, int], Question]
+    doc_codes: tuple[str, ...]
+    documents: dict[str, PaperPool]
+    departments: dict[str, PaperPool]
+
+
+def sample_without_replacement(pool: array, k: int, rng: random.Random) -> list[int]:
+    """
+    Partial Fisher-Yates shuffle of ``pool`` that only records the swapped positions, so it runs
+    in O(k) time and memory whatever the size of the pool.
+    :param pool: population, left untouched
+    :param k: sample size, at most ``len(pool)``
+    :param rng: random generator; the same seed gives the same sample
+    :return: ``k`` distinct entries of ``pool``, in random order
+    """
+    swapped: dict[int, int] = {}
+    sample = []
+    for i in range(k):
+        j = rng.randrange(i, len(pool))
+        sample.append(pool[swapped.get(j, j)])
+        swapped[j] = swapped.get(i, i)
+    return sample
+
+
+class ExamAssembler:
+    """
+    Randomized exam papers, per document or per department, drawn from a ``QuestionBank``.
+
+    The question ids of every doc_code and every department are kept in compact arrays by
+    question type, rebuilt when the bank changes. A paper samples ``question_counts[type]``
+    questions of each type without replacement, from a generator seeded by the pool and the
+    paper seed: a seed always gives the same paper, in every worker, until the questions change.
+    Rendered papers are cached in Redis by pool digest and seed.
+    """
+
+    def __init__(
+            self,
+            question_bank: QuestionBank,
+            redis_client: Optional[StrictRedis] = None,
+            departments: Optional[dict[str, list[str]]] = None,
+            question_counts: Optional[dict[int, int]] = None,
+            ttl: int = 24 * 3600,
+            key_prefix: str = "exam"
+    ) -> None:
+        """
+        :param question_bank: source of the questions
+        :param redis_client: Redis tier of the paper cache; None to render every paper
+        :param departments: doc_codes of each department
+        :param question_counts: questions per paper, by question type
+        :param ttl: lifetime of a cached paper, in seconds
+        :param key_prefix: prefix of the Redis keys
+        """
+        self._question_bank = question_bank
+        self._redis_client = redis_client
+        self._departments = {department: tuple(doc_codes) for department, doc_codes in (departments or {}).items()}
+        self._question_counts = {int(question_type): count for question_type, count in (question_counts or {0: 20}).items()}
+        self._ttl = ttl
+        self._key_prefix = key_prefix
+
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._index: Optional[PaperIndex] = None
+
+        # Counters
+        self._papers = 0
+        self._cache_hits = 0
+        self._redis_errors = 0
+        self._index_builds = 0
+
+    def department_doc_codes(self, department: str) -> Optional[tuple[str, ...]]:
+        return self._departments.get(department)
+
+    def _build_pool(self, doc_codes: list[str], digests: dict[str, str], question_ids: dict[int, array]) -> PaperPool:
+        layout = json.dumps([[doc_code, digests[doc_code]] for doc_code in doc_codes] + sorted(self._question_counts.items()))
+        return PaperPool(hashlib.md5(layout.encode("utf-8")).hexdigest(), tuple(doc_codes), question_ids)
+
+    def index(self) -> PaperIndex:
+        """
+        :return: question id arrays of the current questions, rebuilt if the bank has changed
+        """
+        index = self._index
+        version = self._question_bank.version
+        if index is not None and index.version == version:
+            return index
+
+        with self._lock:
+            if self._index is not None and self._index.version == version:
+                return self._index
+            version, questions, digests = self._question_bank.snapshot()
+
+            # Sorted, so that every worker draws the same paper from the same seed
+            doc_codes = tuple(sorted(digests))
+            doc_indexes = {doc_code: idx for idx, doc_code in enumerate(doc_codes)}
+            question_ids: dict[str, dict[int, array]] = {doc_code: {} for doc_code in doc_codes}
+            for doc_code, question_id in sorted(questions):
+                question_type = questions[(doc_code, question_id)].question_type
+                question_ids[doc_code].setdefault(question_type, array("q")).append(
+                    doc_indexes[doc_code] << DOC_INDEX_SHIFT | question_id
+                )
+
+            documents = {
+                doc_code: self._build_pool([doc_code], digests, question_ids[doc_code]) for doc_code in doc_codes
+            }
+            departments = {}
+            for department, department_doc_codes in self._departments.items():
+                known_doc_codes = [doc_code for doc_code in department_doc_codes if doc_code in documents]
+                department_question_ids: dict[int, array] = {}
+                for doc_code in known_doc_codes:
+                    for question_type, ids in question_ids[doc_code].items():
+                        department_question_ids.setdefault(question_type, array("q")).extend(ids)
+                departments[department] = self._build_pool(known_doc_codes, digests, department_question_ids)
+
+            self._index = PaperIndex(version, questions, doc_codes, documents, departments)
+            self._index_builds += 1
+            return self._index
+
+    def make_key(self, pool: PaperPool, seed: int) -> str:
+        return f"{self._key_prefix}:{pool.digest}:{seed}"
+
+    def render(self, index: PaperIndex, pool: PaperPool, seed: int) -> str:
+        """
+        Draw the paper of ``seed`` from ``pool``.
+        :return: the paper as JSON, without the correct options
+        """
+        rng = random.Random(f"{pool.digest}:{seed}")
+        paper_questions = []
+        for question_type, count in sorted(self._question_counts.items()):
+            ids = pool.question_ids.get(question_type, array("q"))
+            for packed_id in sample_without_replacement(ids, min(count, len(ids)), rng):
+                question = index.questions[(index.doc_codes[packed_id >> DOC_INDEX_SHIFT], packed_id & QUESTION_ID_MASK)]
+                paper_questions.append({
+                    "docCode": question.doc_code,
+                    "questionId": question.question_id,
+                    "questionType": question.question_type,
+                    "question": question.text,
+                    "options": question.options,
+                })
+        paper = {"seed": seed, "docCodes": list(pool.doc_codes), "questions": paper_questions}
+        return json.dumps(paper, ensure_ascii=False)
+
+    def paper(self, index: PaperIndex, pool: PaperPool, seed: int) -> dict:
+        """
+        Paper of ``seed`` from the Redis cache, rendered and cached on a miss.
+        """
+        key = self.make_key(pool, seed)
+        with self._stats_lock:
+            self._papers += 1
+
+        if self._redis_client is not None:
+            try:
+                raw = self._redis_client.get(key)
+            except Exception as e:
+                print(f"Exam paper cache redis get failed. Exception: {e}")
+                raw = None
+                with self._stats_lock:
+                    self._redis_errors += 1
+            if raw:
+                with self._stats_lock:
+                    self._cache_hits += 1
+                return json.loads(raw)
+
+        rendered = self.render(index, pool, seed)
+        if self._redis_client is not None:
+            try:
+                self._redis_client.set(key, rendered.encode("utf-8"), ex=self._ttl)
+            except Exception as e:
+                print(f"Exam paper cache redis set failed. Exception: {e}")
+                with self._stats_lock:
+                    self._redis_errors += 1
+        return json.loads(rendered)
+
+    def document_paper(self, doc_code: str, seed: int) -> Optional[dict]:
+        """
+        :return: paper of the document, or None if it has no questions
+        """
+        index = self.index()
+        pool = index.documents.get(doc_code)
+        return self.paper(index, pool, seed) if pool is not None else None
+
+    def department_paper(self, department: str, seed: int) -> Optional[dict]:
+        """
+        :return: paper over the documents of the department, or None if none of them has questions
+        """
+        index = self.index()
+        pool = index.departments.get(department)
+        return self.paper(index, pool, seed) if pool is not None and pool.doc_codes else None
+
+    def stats(self) -> dict:
+        index = self._index
+        return {
+            "papers": self._papers,
+            "cache_hits": self._cache_hits,
+            "hit_ratio": self._cache_hits / self._papers if self._papers else 0.0,
+            "redis_errors": self._redis_errors,
+            "index_builds": self._index_builds,
+            "doc_codes": len(index.doc_codes) if index is not None else 0,
+        }
@@ -0,0 +1,245 @@
+import os
+import re
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from db import PostgresqlClient
+
+SELECT_DIGESTS = """
+    SELECT doc_code, md5(string_agg(
+        md5(ROW(question_id, question_text, question_type, options, correct_options)::text), ',' ORDER BY question_id
+    ))
+    FROM questions
+    GROUP BY doc_code
+"""
+SELECT_QUESTIONS = """
+    SELECT doc_code, question_id, question_text, question_type, options, correct_options
+    FROM questions
+    WHERE doc_code = ANY(%s)
+"""
+
+# Separators between the options of an answer, e.g. "A,C" or "A、C"
+ANSWER_SEPARATORS = re.compile(r"[,，、;；/\s]+")
+
+
+class Question(NamedTuple):
+    doc_code: str
+    question_id: int
+    text: str
+    question_type: int
+    options: dict[str, str]
+    correct_options: frozenset[str]
+    reference: str
+
+    @property
+    def is_choice(self) -> bool:
+        return bool(self.options)
+
+
+class MarkResult(NamedTuple):
+    question_id: int
+    score: float
+    # None for free-text answers, which are scored by the LLM
+    correct: Optional[bool]
+    reference: str
+
+
+def option_key(text: str) -> str:
+    """
+    Option key of "A", "a" or "A:option text".
+    """
+    return re.split(r"[:：.．]", text.strip(), maxsplit=1)[0].strip().upper()
+
+
+def parse_choice_answer(answer: str, options: dict[str, str]) -> frozenset[str]:
+    """
+    Option keys picked by a user answer: "A", "A:option text", "A,C", "AC" or an option text.
+    :param answer: user answer
+    :param options: options of the question, by key
+    :return: picked option keys; unknown keys are kept so that the answer is marked wrong
+    """
+    answer = answer.strip()
+    for key, text in options.items():
+        if answer == text.strip():
+            return frozenset([key.upper()])
+
+    keys = set()
+    for part in filter(None, ANSWER_SEPARATORS.split(answer)):
+        key = option_key(part)
+        if len(key) > 1 and all(char in options for char in key):
+            # Several keys written together, e.g. "AC"
+            keys.update(key)
+        else:
+            keys.add(key)
+    return frozenset(keys)
+
+
+def build_question(row: tuple) -> Question:
+    doc_code, question_id, text, question_type, options, correct_options = row
+    options = {option_key(key): value for key, value in (options or {}).items()}
+    correct_options = list(correct_options or [])
+    if options:
+        reference = "、".join(
+            f"{key}:{options[key]}" if key in options else key
+            for key in sorted(map(option_key, correct_options))
+        )
+        correct = frozenset(map(option_key, correct_options))
+    else:
+        reference = "\n".join(correct_options)
+        correct = frozenset()
+    return Question(doc_code, int(question_id), text, int(question_type or 0), options, correct, reference)
+
+
+class QuestionBank:
+    """
+    In-memory index of the ``questions`` table, keyed by (doc_code, question_id), for marking
+    answers without a database round trip.
+
+    Choice questions are marked locally against ``correct_options``. The index is refreshed in
+    the background every ``refresh_interval`` seconds: a digest per doc_code is computed by
+    Postgres, and only the doc_codes whose digest changed are reloaded.
+    """
+
+    def __init__(self, pg_client: PostgresqlClient, full_score: float = 5.0, refresh_interval: float = 60.0) -> None:
+        """
+        :param pg_client: Postgres client; a ``PooledPostgresqlClient`` when shared with request threads
+        :param full_score: score of a correct answer
+        :param refresh_interval: how often to look for changed questions, in seconds; None to never refresh
+        """
+        self._pg_client = pg_client
+        self._full_score = full_score
+        self._refresh_interval = refresh_interval
+
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._questions: dict[tuple[str, int], Question] = {}
+        # Documents of each question id, for the requests that only send the question id
+        self._doc_codes: dict[int, tuple[str, ...]] = {}
+        self._digests: dict[str, str] = {}
+        self._refresher: threading.Thread | None = None
+        self._refresher_pid: int | None = None
+
+        # Counters
+        self._marked = 0
+        self._refreshes = 0
+        self._last_refresh_time: Optional[float] = None
+
+    @property
+    def full_score(self) -> float:
+        return self._full_score
+
+    @property
+    def version(self) -> int:
+        """
+        Number of refreshes that changed the index, for the caches built on top of it.
+        """
+        self._ensure_refresher()
+        return self._refreshes
+
+    def snapshot(self) -> tuple[int, dict[tuple[str, int], Question], dict[str, str]]:
+        """
+        :return: version, questions by (doc_code, question_id) and digest of each doc_code; the
+            dicts are never mutated, they are replaced on refresh
+        """
+        if self._last_refresh_time is None:
+            self.refresh()
+        self._ensure_refresher()
+        with self._lock:
+            return self._refreshes, self._questions, self._digests
+
+    def refresh(self) -> int:
+        """
+        Reload the doc_codes whose questions changed since the last refresh, and drop the removed ones.
+        :return: the number of reloaded or dropped doc_codes
+        """
+        with self._lock:
+            digests = dict(self._pg_client.execute_query(SELECT_DIGESTS))
+            changed = [doc_code for doc_code, digest in digests.items() if self._digests.get(doc_code) != digest]
+            removed = set(self._digests) - set(digests)
+            if not changed and not removed:
+                self._last_refresh_time = time.time()
+                return 0
+
+            rows = self._pg_client.execute_query(SELECT_QUESTIONS, (changed,)) if changed else []
+            stale = removed.union(changed)
+            questions = {key: question for key, question in self._questions.items() if key[0] not in stale}
+            for row in rows:
+                question = build_question(row)
+                questions[(question.doc_code, question.question_id)] = question
+
+            doc_codes: dict[int, list[str]] = {}
+            for doc_code, question_id in questions:
+                doc_codes.setdefault(question_id, []).append(doc_code)
+
+            # Swapped at once so concurrent lookups see a consistent index
+            self._questions = questions
+            self._doc_codes = {question_id: tuple(sorted(codes)) for question_id, codes in doc_codes.items()}
+            self._digests = digests
+            self._refreshes += 1
+            self._last_refresh_time = time.time()
+            return len(stale)
+
+    def _ensure_refresher(self) -> None:
+        # The refresher thread does not survive a fork, so start one lazily in every process
+        if self._refresh_interval is None or (self._refresher_pid == os.getpid() and self._refresher.is_alive()):
+            return
+        with self._lock:
+            if self._refresher_pid != os.getpid() or not self._refresher.is_alive():
+                self._refresher = threading.Thread(target=self._run_refresher, name="question-bank", daemon=True)
+                self._refresher.start()
+                self._refresher_pid = os.getpid()
+
+    def _run_refresher(self) -> None:
+        while True:
+            time.sleep(self._refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Question bank refresh failed. Exception: {e}")
+
+    def get(self, doc_code: Optional[str], question_id: int) -> Optional[Question]:
+        """
+        :param doc_code: document code of the question; question ids are only unique within a
+            document, None looks the question up by its id alone
+        :param question_id: question id within the document
+        :return: question, or None if unknown, or if ``doc_code`` is None and several documents
+            have a question with this id
+        """
+        if self._last_refresh_time is None:
+            self.refresh()
+        self._ensure_refresher()
+        if doc_code is None:
+            doc_codes = self.doc_codes_of(question_id)
+            if len(doc_codes) != 1:
+                return None
+            doc_code = doc_codes[0]
+        return self._questions.get((doc_code, question_id))
+
+    def doc_codes_of(self, question_id: int) -> tuple[str, ...]:
+        """
+        :return: codes of the documents that have a question with this id
+        """
+        return self._doc_codes.get(question_id, ())
+
+    def mark_choice(self, question: Question, answer: str) -> MarkResult:
+        """
+        Mark the answer of a choice question; all the correct options, and only them, must be picked.
+        """
+        correct = parse_choice_answer(answer, question.options) == question.correct_options
+        with self._stats_lock:
+            self._marked += 1
+        return MarkResult(question.question_id, self._full_score if correct else 0.0, correct, question.reference)
+
+    def close(self) -> None:
+        self._pg_client.close()
+
+    def stats(self) -> dict:
+        with self._lock, self._stats_lock:
+            return {
+                "questions": len(self._questions),
+                "doc_codes": len(self._digests),
+                "marked": self._marked,
+                "refreshes": self._refreshes,
+                "last_refresh_time": self._last_refresh_time,
+            }
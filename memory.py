@@ -0,0 +1,269 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Awaitable, Callable, Optional
+
+from redis import StrictRedis, WatchError
+from redis.asyncio import StrictRedis as AsyncStrictRedis
+
+from db import ChatHistoryStore, AsyncChatHistoryStore
+from prompt import memory_prompt
+from schema import ChatMessage
+
+# Tokens added by the chat format around the content of every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Attempts at saving a summary while new messages keep being appended
+MAX_FOLD_ATTEMPTS = 5
+
+
+def num_folded_in_head(folded: list[bytes], head: list[bytes]) -> int:
+    """
+    Number of folded records still at the head of the history. An append made during the
+    summarization may have dropped the oldest of them already, so the head starts with a
+    suffix of ``folded``; the longest one found is trimmed, which never drops a record that
+    differs from the folded ones.
+    :param folded: records that were summarized, oldest first
+    :param head: the first ``len(folded)`` records of the history now
+    :return: number of records to trim from the head of the history
+    """
+    for num_dropped in range(len(folded)):
+        if head[:len(folded) - num_dropped] == folded[num_dropped:]:
+            return len(folded) - num_dropped
+    return 0
+
+
+class ChatMemory:
+    """
+    Chat history of bounded size.
+
+    The last ``recent_turns`` turns are kept verbatim in a ``ChatHistoryStore``. With a
+    ``summarize`` function, older turns are folded into a running summary stored next to
+    the history in Redis; the folding runs on ``executor`` after the turn has been saved,
+    so it never delays a response. Without one, older turns are simply dropped.
+
+    ``get`` returns the summary as a system message followed by the newest messages, cut
+    to ``token_budget`` tokens.
+    """
+
+    history_store_class = ChatHistoryStore
+
+    def __init__(
+            self,
+            redis_client: StrictRedis,
+            count_tokens: Callable[[str], int],
+            token_budget: int = 1000,
+            recent_turns: int = 3,
+            summarize: Optional[Callable[[str, list[dict]], str]] = None,
+            executor: Optional[Executor] = None,
+            max_pending_turns: int = 4,
+            ttl: int = 1800,
+            key_template: str = "qa:history:{}",
+            summary_key_template: str = "qa:summary:{}"
+    ) -> None:
+        """
+        :param redis_client: Redis client
+        :param count_tokens: function counting the tokens of a text
+        :param token_budget: maximum number of tokens of the returned history
+        :param recent_turns: number of question/answer turns kept verbatim
+        :param summarize: function folding messages into a summary: (summary, messages) -> summary
+        :param executor: executor running the summarization; required with ``summarize``
+        :param max_pending_turns: turns kept beyond ``recent_turns`` while a summarization is pending
+        :param ttl: lifetime of the history and the summary after their last update, in seconds
+        :param key_template: Redis key template of the history, formatted with the user id
+        :param summary_key_template: Redis key template of the summary, formatted with the user id
+        """
+        self._redis_client = redis_client
+        self._count_tokens = count_tokens
+        self._token_budget = token_budget
+        self._recent_len = 2 * recent_turns
+        self._summarize = summarize
+        self._executor = executor
+        self._ttl = ttl
+        self._summary_key_template = summary_key_template
+        self.history_store = self.history_store_class(
+            redis_client=redis_client,
+            max_len=self._recent_len + (2 * max_pending_turns if summarize is not None else 0),
+            ttl=ttl,
+            key_template=key_template
+        )
+
+    def summary_key(self, user_id: str) -> str:
+        return self._summary_key_template.format(user_id)
+
+    def lock_key(self, user_id: str) -> str:
+        return f"{self.summary_key(user_id)}:lock"
+
+    def fit(self, summary: Optional[bytes], messages: list[dict]) -> list[dict]:
+        """
+        Cut the summary and the messages to the token budget, dropping the oldest messages first.
+        :param summary: stored summary, or None
+        :param messages: verbatim messages, oldest first
+        :return: OpenAI messages
+        """
+        budget = self._token_budget
+        head = []
+        if summary:
+            summary_message = {"role": "system", "content": memory_prompt.format(SUMMARY=summary.decode("utf-8"))}
+            tokens = self._count_tokens(summary_message["content"]) + MESSAGE_OVERHEAD_TOKENS
+            if tokens <= budget:
+                head.append(summary_message)
+                budget -= tokens
+
+        kept = []
+        for message in reversed(messages):
+            tokens = self._count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+            if tokens > budget:
+                break
+            kept.append(message)
+            budget -= tokens
+
+        return head + kept[::-1]
+
+    def get(self, user_id: str) -> list[dict]:
+        """
+        :param user_id: user id
+        :return: OpenAI messages, oldest first
+        """
+        with self._redis_client.pipeline(transaction=False) as pipe:
+            pipe.get(self.summary_key(user_id))
+            pipe.lrange(self.history_store.key(user_id), 0, -1)
+            summary, records = pipe.execute()
+        return self.fit(summary, self.history_store.decode(records))
+
+    def append(self, user_id: str, *messages: ChatMessage) -> None:
+        """
+        Save messages, then fold the turns beyond the recent ones into the summary in the background.
+        :param user_id: user id
+        :param messages: messages in chronological order
+        """
+        length = self.history_store.append(user_id, *messages)
+        if self._summarize is not None and length > self._recent_len:
+            self._executor.submit(self.fold, user_id)
+
+    def fold(self, user_id: str) -> None:
+        """
+        Fold the messages older than the recent turns into the summary.
+        """
+        # One summarization per user at a time, the others find nothing left to fold
+        if not self._redis_client.set(self.lock_key(user_id), 1, nx=True, ex=60):
+            return
+        try:
+            with self._redis_client.pipeline(transaction=False) as pipe:
+                pipe.get(self.summary_key(user_id))
+                pipe.lrange(self.history_store.key(user_id), 0, -1)
+                summary, records = pipe.execute()
+
+            messages = self.history_store.decode(records)
+            num_folded = len(messages) - self._recent_len
+            if num_folded <= 0:
+                return
+
+            new_summary = self._summarize(summary.decode("utf-8") if summary else "", messages[:num_folded])
+            key = self.history_store.key(user_id)
+            with self._redis_client.pipeline(transaction=True) as pipe:
+                for _ in range(MAX_FOLD_ATTEMPTS):
+                    try:
+                        # Appends may have run during the summarization: trim the folded records
+                        # that are still there, by value, and only if the list did not change since
+                        pipe.watch(key)
+                        num_trimmed = num_folded_in_head(records[:num_folded], pipe.lrange(key, 0, num_folded - 1))
+                        pipe.multi()
+                        pipe.set(self.summary_key(user_id), new_summary.encode("utf-8"), ex=self._ttl)
+                        pipe.ltrim(key, num_trimmed, -1)
+                        pipe.execute()
+                        return
+                    except WatchError:
+                        continue
+            print(f"Chat history summarization of user {user_id} dropped: history kept changing")
+        except Exception as e:
+            print(f"Chat history summarization failed. Exception: {e}")
+        finally:
+            self._redis_client.delete(self.lock_key(user_id))
+
+    def clear(self, user_id: str) -> None:
+        self._redis_client.delete(self.history_store.key(user_id), self.summary_key(user_id))
+
+
+class AsyncChatMemory(ChatMemory):
+    """
+    ``ChatMemory`` on an asyncio Redis client; the summarization runs as a background task.
+    """
+
+    history_store_class = AsyncChatHistoryStore
+
+    def __init__(
+            self,
+            redis_client: AsyncStrictRedis,
+            count_tokens: Callable[[str], int],
+            token_budget: int = 1000,
+            recent_turns: int = 3,
+            summarize: Optional[Callable[[str, list[dict]], Awaitable[str]]] = None,
+            max_pending_turns: int = 4,
+            ttl: int = 1800,
+            key_template: str = "qa:history:{}",
+            summary_key_template: str = "qa:summary:{}"
+    ) -> None:
+        super().__init__(
+            redis_client=redis_client,
+            count_tokens=count_tokens,
+            token_budget=token_budget,
+            recent_turns=recent_turns,
+            summarize=summarize,
+            max_pending_turns=max_pending_turns,
+            ttl=ttl,
+            key_template=key_template,
+            summary_key_template=summary_key_template
+        )
+        # Keeps the pending summarization tasks from being garbage collected
+        self._tasks: set[asyncio.Task] = set()
+
+    async def get(self, user_id: str) -> list[dict]:
+        async with self._redis_client.pipeline(transaction=False) as pipe:
+            pipe.get(self.summary_key(user_id))
+            pipe.lrange(self.history_store.key(user_id), 0, -1)
+            summary, records = await pipe.execute()
+        return self.fit(summary, self.history_store.decode(records))
+
+    async def append(self, user_id: str, *messages: ChatMessage) -> None:
+        length = await self.history_store.append(user_id, *messages)
+        if self._summarize is not None and length > self._recent_len:
+            task = asyncio.create_task(self.fold(user_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def fold(self, user_id: str) -> None:
+        if not await self._redis_client.set(self.lock_key(user_id), 1, nx=True, ex=60):
+            return
+        try:
+            async with self._redis_client.pipeline(transaction=False) as pipe:
+                pipe.get(self.summary_key(user_id))
+                pipe.lrange(self.history_store.key(user_id), 0, -1)
+                summary, records = await pipe.execute()
+
+            messages = self.history_store.decode(records)
+            num_folded = len(messages) - self._recent_len
+            if num_folded <= 0:
+                return
+
+            new_summary = await self._summarize(summary.decode("utf-8") if summary else "", messages[:num_folded])
+            key = self.history_store.key(user_id)
+            async with self._redis_client.pipeline(transaction=True) as pipe:
+                for _ in range(MAX_FOLD_ATTEMPTS):
+                    try:
+                        await pipe.watch(key)
+                        num_trimmed = num_folded_in_head(records[:num_folded], await pipe.lrange(key, 0, num_folded - 1))
+                        pipe.multi()
+                        pipe.set(self.summary_key(user_id), new_summary.encode("utf-8"), ex=self._ttl)
+                        pipe.ltrim(key, num_trimmed, -1)
+                        await pipe.execute()
+                        return
+                    except WatchError:
+                        continue
+            print(f"Chat history summarization of user {user_id} dropped: history kept changing")
+        except Exception as e:
+            print(f"Chat history summarization failed. Exception: {e}")
+        finally:
+            await self._redis_client.delete(self.lock_key(user_id))
+
+    async def clear(self, user_id: str) -> None:
+        await self._redis_client.delete(self.history_store.key(user_id), self.summary_key(user_id))
@@ -0,0 +1,572 @@
+"""
+In-process metrics of the QA pipeline, exposed in the Prometheus text format.
+
+Every worker process keeps its own values. Under a pre-fork server, where a scrape reaches any
+one worker, ``MetricsRegistry.enable_multiprocess`` makes the workers share their values through
+a directory: counters and histograms are summed over all the workers, including exited ones, so
+they never go backwards, and gauges are reported per live worker with a ``worker`` label.
+An exiting worker folds its snapshot into the totals of the exited workers, see ``retire_snapshots``.
+"""
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Snapshot of a live or crashed worker: <pid>.<id of the process>.json
+SNAPSHOT_PATTERN = re.compile(r"^(\d+)\.([0-9a-f]+)\.json$")
+# Summed counters and histograms of the exited workers, with the names of their retired snapshots
+EXITED_SNAPSHOT = "exited.json"
+EXITED_LOCK = "exited.lock"
+# Scrape retries when a snapshot is retired while the directory is read
+MAX_READ_ATTEMPTS = 5
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple[str, ...], labelvalues: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(ABC):
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+    @abstractmethod
+    def values(self) -> dict:
+        """
+        :return: current values by label values
+        """
+
+    @staticmethod
+    def merge(values: dict, other: dict) -> None:
+        """
+        Add the values of another process to ``values``.
+        """
+        for key, value in other.items():
+            values[key] = values.get(key, 0.0) + value
+
+    def render_values(self, values: dict, labelnames: Optional[tuple[str, ...]] = None) -> list[str]:
+        labelnames = labelnames or self.labelnames
+        return self.header() + [
+            f"{self.name}{_format_labels(labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+    def render(self) -> list[str]:
+        return self.render_values(self.values())
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def values(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: tuple[str, ...] = (),
+            function: Optional[Callable[[], dict[tuple[str, ...], float]]] = None
+    ) -> None:
+        """
+        :param function: optional callback computing the values at scrape time, keyed by label values
+        """
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+        self._function = function
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def values(self) -> dict:
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception as e:
+                print(f"Metric {self.name} callback failed. Exception: {e}")
+                return {}
+        with self._lock:
+            return dict(self._values)
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets))
+        # Per label set: non-cumulative bucket counts (the last one is +Inf), sum
+        self._values: dict[tuple[str, ...], tuple[list[int], float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        idx = next((idx for idx, bound in enumerate(self._buckets) if value <= bound), len(self._buckets))
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self._buckets) + 1), 0.0)
+            counts[idx] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def values(self) -> dict:
+        with self._lock:
+            return {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+
+    @staticmethod
+    def merge(values: dict, other: dict) -> None:
+        for key, (counts, total) in other.items():
+            if key in values:
+                merged_counts, merged_total = values[key]
+                values[key] = ([a + b for a, b in zip(merged_counts, counts)], merged_total + total)
+            else:
+                values[key] = (list(counts), total)
+
+    def render_values(self, values: dict, labelnames: Optional[tuple[str, ...]] = None) -> list[str]:
+        labelnames = labelnames or self.labelnames
+        lines = self.header()
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labelnames, key)} {cumulative}")
+        return lines
+
+
+# Merge of the values of several processes, by metric type; gauges are not summed
+MERGES = {
+    Counter.type_name: Counter.merge,
+    Histogram.type_name: Histogram.merge,
+}
+
+
+def _dump_values(metric: _Metric) -> dict:
+    return {"type": metric.type_name, "values": [[list(key), value] for key, value in metric.values().items()]}
+
+
+def _load_values(entry: Optional[dict]) -> dict:
+    return {tuple(key): value for key, value in entry["values"]} if entry else {}
+
+
+def _write_json(path: str, data: dict) -> None:
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def read_exited(directory: str) -> dict:
+    """
+    :return: totals of the exited workers: version, names of the retired snapshots, metrics
+    """
+    try:
+        with open(os.path.join(directory, EXITED_SNAPSHOT), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"version": 0, "retired": [], "metrics": {}}
+
+
+def retire_snapshots(directory: str, pid: int) -> int:
+    """
+    Fold the snapshots of an exited process into the totals of the exited workers, then delete
+    them: its counters keep counting, while its files neither outlive it nor are taken over by a
+    new process with the same pid.
+    :param directory: directory shared by the workers
+    :param pid: pid of the process, which must have exited or be exiting
+    :return: the number of retired snapshots
+    """
+    with open(os.path.join(directory, EXITED_LOCK), "a") as lock_file:
+        # Released when the file is closed
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        names, partial_names = [], []
+        for name in os.listdir(directory):
+            # A process killed while writing its snapshot leaves the temporary file behind
+            match = SNAPSHOT_PATTERN.match(name.removesuffix(".tmp"))
+            if match is not None and int(match.group(1)) == pid:
+                (partial_names if name.endswith(".tmp") else names).append(name)
+        for name in partial_names:
+            os.remove(os.path.join(directory, name))
+        if not names:
+            return 0
+
+        exited = read_exited(directory)
+        totals = {name: (entry["type"], _load_values(entry)) for name, entry in exited["metrics"].items()}
+        for name in names:
+            with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            for metric_name, entry in snapshot.items():
+                merge = MERGES.get(entry["type"])
+                if merge is not None:
+                    merge(totals.setdefault(metric_name, (entry["type"], {}))[1], _load_values(entry))
+
+        # Scrapes skip the retired snapshots until they are deleted, so they are never counted twice
+        _write_json(os.path.join(directory, EXITED_SNAPSHOT), {
+            "version": exited["version"] + 1,
+            "retired": [name for name in exited["retired"] if os.path.exists(os.path.join(directory, name))] + names,
+            "metrics": {
+                metric_name: {"type": type_name, "values": [[list(key), value] for key, value in values.items()]}
+                for metric_name, (type_name, values) in totals.items()
+            },
+        })
+        for name in names:
+            os.remove(os.path.join(directory, name))
+    return len(names)
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+        # Multiprocess mode, see enable_multiprocess
+        self._directory: Optional[str] = None
+        self._flush_interval = 5.0
+        self._flusher: threading.Thread | None = None
+        self._flusher_pid: int | None = None
+        self._flush_lock = threading.Lock()
+        self._snapshot_name: Optional[str] = None
+        self._snapshot_pid: int | None = None
+        self._retired_pid: int | None = None
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            # Re-registering a name returns the existing metric, e.g. when a module is reloaded
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), function=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def enable_multiprocess(self, directory: str, flush_interval: float = 5.0) -> None:
+        """
+        Share the values of this process with the other workers of the server through ``directory``,
+        where each worker writes its values every ``flush_interval`` seconds and on ``flush``.
+        The directory must be emptied when the server starts, not when a worker does.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._flush_interval = flush_interval
+        self.flush()
+        self._ensure_flusher()
+
+    def _ensure_flusher(self) -> None:
+        # The flusher thread does not survive a fork, so start one lazily in every process
+        if self._flusher_pid == os.getpid() and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher_pid != os.getpid() or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._run_flusher, name="metrics-flusher", daemon=True)
+                self._flusher.start()
+                self._flusher_pid = os.getpid()
+
+    def _run_flusher(self) -> None:
+        while True:
+            time.sleep(self._flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Metrics flush failed. Exception: {e}")
+
+    def flush(self) -> None:
+        """
+        Write the values of this process to the shared directory.
+        """
+        if self._directory is None:
+            return
+        with self._lock:
+            metrics = list(self._metrics.values())
+        snapshot = {metric.name: _dump_values(metric) for metric in metrics}
+        with self._flush_lock:
+            if self._retired_pid == os.getpid():
+                return
+            if self._snapshot_pid != os.getpid():
+                # A forked worker gets its own file, even if it reuses the pid of an exited one
+                self._snapshot_name = f"{os.getpid()}.{uuid.uuid4().hex}.json"
+                self._snapshot_pid = os.getpid()
+            _write_json(os.path.join(self._directory, self._snapshot_name), snapshot)
+
+    def retire(self) -> None:
+        """
+        Fold the final values of this exiting process into the totals of the exited workers and
+        delete its snapshot; nothing is written for this process afterwards.
+        """
+        if self._directory is None:
+            return
+        self.flush()
+        with self._flush_lock:
+            self._retired_pid = os.getpid()
+            retire_snapshots(self._directory, os.getpid())
+
+    def _read_snapshots(self) -> tuple[dict, list[tuple[int, dict]]]:
+        """
+        :return: totals of the exited workers, and (pid, snapshot) of each other worker
+        """
+        for _ in range(MAX_READ_ATTEMPTS):
+            exited = read_exited(self._directory)
+            retired = set(exited["retired"])
+            snapshots = []
+            for filename in sorted(os.listdir(self._directory)):
+                match = SNAPSHOT_PATTERN.match(filename)
+                if match is None or filename in retired:
+                    continue
+                try:
+                    with open(os.path.join(self._directory, filename), "r", encoding="utf-8") as f:
+                        snapshots.append((int(match.group(1)), json.load(f)))
+                except FileNotFoundError:
+                    # Retired meanwhile, the version check below reads again
+                    continue
+                except (OSError, ValueError) as e:
+                    print(f"Metrics snapshot {filename} unreadable. Exception: {e}")
+            # A snapshot retired during the listing would be missed, or counted twice
+            if read_exited(self._directory)["version"] == exited["version"]:
+                break
+        return exited["metrics"], snapshots
+
+    @staticmethod
+    def _is_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _render_multiprocess(self, metrics: list[_Metric]) -> str:
+        self.flush()
+        exited, snapshots = self._read_snapshots()
+        merged: dict[str, dict] = {metric.name: {} for metric in metrics}
+        for metric in metrics:
+            if not isinstance(metric, Gauge):
+                metric.merge(merged[metric.name], _load_values(exited.get(metric.name)))
+        for pid, snapshot in snapshots:
+            alive = None
+            for metric in metrics:
+                values = _load_values(snapshot.get(metric.name))
+                if isinstance(metric, Gauge):
+                    # Gauges are the current state of a worker: only live workers report one
+                    alive = self._is_alive(pid) if alive is None else alive
+                    if alive:
+                        merged[metric.name].update({key + (str(pid),): value for key, value in values.items()})
+                else:
+                    metric.merge(merged[metric.name], values)
+
+        lines = []
+        for metric in metrics:
+            labelnames = metric.labelnames + ("worker",) if isinstance(metric, Gauge) else metric.labelnames
+            lines.extend(metric.render_values(merged[metric.name], labelnames))
+        return "\n".join(lines) + "\n"
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        if self._directory is not None:
+            return self._render_multiprocess(metrics)
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.histogram(
+    "qa_stage_seconds",
+    "Duration of a stage of the QA pipeline",
+    ("endpoint", "stage")
+)
+REQUEST_SECONDS = registry.histogram(
+    "qa_request_seconds",
+    "Duration of a QA request, until the last byte of a stream",
+    ("endpoint",)
+)
+REQUESTS_TOTAL = registry.counter(
+    "qa_requests_total",
+    "QA requests by outcome",
+    ("endpoint", "status")
+)
+REQUESTS_IN_FLIGHT = registry.gauge(
+    "qa_requests_in_flight",
+    "QA requests being served, including open streams",
+    ("endpoint",)
+)
+RETRIEVAL_FALLBACKS = registry.counter(
+    "qa_retrieval_fallbacks_total",
+    "Vector searches that missed their deadline, by the source of the degraded context",
+    ("source",)
+)
+ADMISSION_IN_FLIGHT = registry.gauge(
+    "qa_admission_in_flight",
+    "LLM calls admitted and not finished yet"
+)
+ADMISSION_QUEUE_DEPTH = registry.gauge(
+    "qa_admission_queue_depth",
+    "Requests waiting for an LLM call slot"
+)
+ADMISSION_WAIT_SECONDS = registry.histogram(
+    "qa_admission_wait_seconds",
+    "Time admitted requests waited for an LLM call slot"
+)
+ADMISSION_REJECTED = registry.counter(
+    "qa_admission_rejected_total",
+    "Requests shed by the admission controller",
+    ("reason",)
+)
+LLM_TOKENS = registry.counter(
+    "qa_llm_tokens_total",
+    "LLM tokens, from the usage field of the responses or counted locally for streams",
+    ("call", "kind")
+)
+STARTUP_SECONDS = registry.gauge(
+    "qa_startup_seconds",
+    "Startup time of this worker by phase: import, services, warm_up, and ready for the whole app creation",
+    ("phase",)
+)
+
+
+def record_usage(call: str, usage: Optional[dict]) -> None:
+    """
+    :param call: purpose of the LLM call, e.g. "answer" or "summary"
+    :param usage: ``usage`` field of a chat completion
+    """
+    if not usage:
+        return
+    LLM_TOKENS.inc(usage.get("prompt_tokens", 0), call=call, kind="prompt")
+    LLM_TOKENS.inc(usage.get("completion_tokens", 0), call=call, kind="completion")
+
+
+class Trace:
+    """
+    Stage timings of one request, tied together by a request id.
+
+    Every span is observed in ``qa_stage_seconds``; with ``enabled``, the spans are also kept
+    and printed as one JSON line when the request finishes.
+    """
+
+    def __init__(self, endpoint: str, request_id: Optional[str] = None, enabled: bool = False) -> None:
+        self.endpoint = endpoint
+        self.request_id = request_id or uuid.uuid4().hex
+        self.enabled = enabled
+        self.start_time = time.perf_counter()
+        self._spans: list[tuple[str, float, float]] = []
+        self._finished = False
+        REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+
+    def observe(self, stage: str, seconds: float, start_time: Optional[float] = None) -> None:
+        """
+        Record a stage measured elsewhere.
+        :param stage: stage name
+        :param seconds: duration
+        :param start_time: ``time.perf_counter()`` at which the stage started, defaults to its end minus its duration
+        """
+        STAGE_SECONDS.observe(seconds, endpoint=self.endpoint, stage=stage)
+        if self.enabled:
+            if start_time is None:
+                start_time = time.perf_counter() - seconds
+            self._spans.append((stage, start_time - self.start_time, seconds))
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_time, start_time)
+
+    def finish(self, status: str = "ok") -> None:
+        """
+        Close the request; later calls are ignored.
+        :param status: outcome, e.g. "ok", "cached" or "error"
+        """
+        if self._finished:
+            return
+        self._finished = True
+        elapsed = time.perf_counter() - self.start_time
+        REQUESTS_IN_FLIGHT.dec(endpoint=self.endpoint)
+        REQUESTS_TOTAL.inc(endpoint=self.endpoint, status=status)
+        REQUEST_SECONDS.observe(elapsed, endpoint=self.endpoint)
+        if self.enabled:
+            print(json.dumps({
+                "request_id": self.request_id,
+                "endpoint": self.endpoint,
+                "status": status,
+                "duration_ms": round(elapsed * 1000, 3),
+                "spans": [
+                    {"stage": stage, "start_ms": round(offset * 1000, 3), "duration_ms": round(seconds * 1000, 3)}
+                    for stage, offset, seconds in self._spans
+                ],
+            }, ensure_ascii=False))
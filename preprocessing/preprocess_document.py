@@ -1,4 +1,11 @@
+import hashlib
+import json
 import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional
+
 from docx import Document
 from docx.document import Document as _Document
 from docx.oxml.text.paragraph import CT_P
@@ -7,79 +14,185 @@ from docx.table import _Cell, Table, _Row
 from docx.text.paragraph import Paragraph
 
 
-def convert_docx_to_txt(root_path: str = '../document'):
-    def iter_block_items(parent):
-        if isinstance(parent, _Document):
-            parent_elm = parent.element.body
-        elif isinstance(parent, _Cell):
-            parent_elm = parent._tc
-        elif isinstance(parent, _Row):
-            parent_elm = parent._tr
-        else:
-            raise ValueError("something's not right")
-        for child in parent_elm.iterchildren():
-            if isinstance(child, CT_P):
-                yield Paragraph(child, parent)
-            elif isinstance(child, CT_Tbl):
-                yield Table(child, parent)
-
-    output_root_path = '../intflex/document_txt'
-    sub_paths = [d for d in os.listdir(root_path) if os.path.isdir(os.path.join(root_path, d))]
+HASH_MANIFEST_NAME = ".source_hashes.json"
 
-    for sub_path in sub_paths:
-        print(f"\nprocessing {root_path}/{sub_path}...")
-        file_names = [file_name for file_name in os.listdir(f"{root_path}/{sub_path}") if file_name.endswith(".docx")]
-        file_names.sort()
+# Process umask, read once: os.umask can only be read by setting it
+UMASK = os.umask(0)
+os.umask(UMASK)
 
-        for file_name in file_names:
-            print(f"processing {file_name}...", end="")
-            doc = Document(f"{root_path}/{sub_path}/{file_name}")
-            output_file_name = file_name.split(".")[0]
-
-            text_content = []  # 列表存储提取的文字
-            for block in iter_block_items(doc):
-                # 1. read Paragraph
-                if isinstance(block, Paragraph):
-                    para_text = block.text.replace(" ", "")
-                    if para_text != "":
-                        text_content.append(para_text)
-                        # print(para_text)
-
-                # 2. read table
-                elif isinstance(block, Table):
-                    skip_flag = False
-                    for row in block.rows:
-                        pre_cell_text = ""
-                        if skip_flag:
-                            break
-                        for cell in row.cells:
-                            cell_text = (".".join([paragraph.text for paragraph in cell.paragraphs])
-                                         .replace("\n", ".").replace(" ", ""))
-                            if cell_text == "更改标记":
-                                skip_flag = True
-                                break
-                            if cell_text == pre_cell_text or cell_text == "":  # 去重
-                                continue
-                            pre_cell_text = cell_text
-                            text_content.append(cell_text)
-                        # print(pre_cell_text)
-
-            # 判断输出文件夹是否存在，如果不存在则创建文件夹
-            if not os.path.exists(f"{output_root_path}/{sub_path}"):
-                os.makedirs(f"{output_root_path}/{sub_path}")
-
-            with open(f"{output_root_path}/{sub_path}/{output_file_name}.txt", "w", encoding="utf-8") as txt_file:
-                # 写入文档标题
-                txt_file.write(file_name + "\n")
-                # 遍历文档中的段落并写入.txt文件
-                for text in text_content:
-                    text = text.replace(" ", "").replace("\u00A0", "").replace("\n", "")
-                    if text.endswith("附录") or text.startswith("相关表单"):
+
+def iter_block_items(parent):
+    if isinstance(parent, _Document):
+        parent_elm = parent.element.body
+    elif isinstance(parent, _Cell):
+        parent_elm = parent._tc
+    elif isinstance(parent, _Row):
+        parent_elm = parent._tr
+    else:
+        raise ValueError("something's not right")
+    for child in parent_elm.iterchildren():
+        if isinstance(child, CT_P):
+            yield Paragraph(child, parent)
+        elif isinstance(child, CT_Tbl):
+            yield Table(child, parent)
+
+
+def extract_text_content(doc: _Document) -> list[str]:
+    text_content = []  # 列表存储提取的文字
+    for block in iter_block_items(doc):
+        # 1. read Paragraph
+        if isinstance(block, Paragraph):
+            para_text = block.text.replace(" ", "")
+            if para_text != "":
+                text_content.append(para_text)
+
+        # 2. read table
+        elif isinstance(block, Table):
+            skip_flag = False
+            for row in block.rows:
+                pre_cell_text = ""
+                if skip_flag:
+                    break
+                for cell in row.cells:
+                    cell_text = (".".join([paragraph.text for paragraph in cell.paragraphs])
+                                 .replace("\n", ".").replace(" ", ""))
+                    if cell_text == "更改标记":
+                        skip_flag = True
                         break
-                    if text and text != "":
-                        txt_file.write(text + "\n")
+                    if cell_text == pre_cell_text or cell_text == "":  # 去重
+                        continue
+                    pre_cell_text = cell_text
+                    text_content.append(cell_text)
+
+    return text_content
+
+
+def file_sha256(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def write_text_atomic(path: str, text: str) -> None:
+    """
+    Write to a temporary file and rename it, so readers never see a partial file. The file
+    gets the permissions of a plainly created one, not the 0600 of ``mkstemp``.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.chmod(tmp_path, 0o666 & ~UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def convert_one_docx(source_path: str, output_path: str, known_sha256: Optional[str] = None) -> dict:
+    """
+    Convert one .docx file to .txt, unless its content hash is ``known_sha256`` and the output exists.
+    Runs in a worker process.
+    :return: conversion result of the file
+    """
+    result = {"source_path": source_path, "status": "converted", "size": 0, "sha256": None, "error": None}
+    try:
+        result["size"] = os.path.getsize(source_path)
+        result["sha256"] = file_sha256(source_path)
+        if result["sha256"] == known_sha256 and os.path.exists(output_path):
+            # Content unchanged: bump the output mtime so the next run skips it without hashing
+            os.utime(output_path)
+            result["status"] = "unchanged"
+            return result
+
+        doc = Document(source_path)
+        text_content = extract_text_content(doc)
+
+        lines = [os.path.basename(source_path)]  # 写入文档标题
+        for text in text_content:
+            text = text.replace(" ", "").replace("\u00A0", "").replace("\n", "")
+            if text.endswith("附录") or text.startswith("相关表单"):
+                break
+            if text and text != "":
+                lines.append(text)
+
+        write_text_atomic(output_path, "\n".join(lines) + "\n")
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = repr(e)
+
+    return result
+
+
+def convert_docx_to_txt(
+        root_path: str = '../document',
+        output_root_path: str = '../intflex/document_txt',
+        max_workers: Optional[int] = None
+):
+    """
+    Convert every .docx in the department folders under ``root_path`` to .txt, in parallel.
+
+    A file is skipped when its output is newer than the source, or when its content hash
+    matches the one recorded by the previous run.
+    :param root_path: folder of department folders of .docx files
+    :param output_root_path: output folder, mirroring the department folders
+    :param max_workers: number of worker processes, defaults to the number of CPUs
+    """
+    hash_manifest_path = os.path.join(output_root_path, HASH_MANIFEST_NAME)
+    if os.path.exists(hash_manifest_path):
+        with open(hash_manifest_path, "r", encoding="utf-8") as f:
+            known_hashes = json.load(f)
+    else:
+        known_hashes = {}
+
+    tasks, num_skipped = [], 0
+    sub_paths = sorted(d for d in os.listdir(root_path) if os.path.isdir(os.path.join(root_path, d)))
+    for sub_path in sub_paths:
+        file_names = sorted(
+            file_name for file_name in os.listdir(f"{root_path}/{sub_path}") if file_name.endswith(".docx")
+        )
+        for file_name in file_names:
+            source_path = f"{root_path}/{sub_path}/{file_name}"
+            output_path = f"{output_root_path}/{sub_path}/{file_name.split('.')[0]}.txt"
+            if os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(source_path):
+                num_skipped += 1
+                continue
+            tasks.append((source_path, output_path, known_hashes.get(source_path)))
+
+    print(f"{len(tasks)} files to check, {num_skipped} up to date")
+
+    start_time = time.time()
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(convert_one_docx, *task) for task in tasks]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result["status"] == "failed":
+                print(f"failed {result['source_path']}: {result['error']}")
+            else:
+                known_hashes[result["source_path"]] = result["sha256"]
+                print(f"{result['status']} {result['source_path']}")
+    elapsed = time.time() - start_time
+
+    # A crash mid-write would otherwise leave a manifest that fails to load on the next run
+    write_text_atomic(hash_manifest_path, json.dumps(known_hashes, ensure_ascii=False, indent=4))
+
+    """Summary"""
+    num_converted = sum(result["status"] == "converted" for result in results)
+    num_unchanged = sum(result["status"] == "unchanged" for result in results)
+    failures = [result for result in results if result["status"] == "failed"]
+    total_mb = sum(result["size"] for result in results) / 1024 / 1024
+    print(
+        f"\nconverted: {num_converted}, unchanged: {num_unchanged}, up to date: {num_skipped}, "
+        f"failed: {len(failures)}\n"
+        f"elapsed: {elapsed:.2f}s, {len(results) / elapsed if elapsed else 0:.2f} files/s, "
+        f"{total_mb / elapsed if elapsed else 0:.2f} MB/s"
+    )
+    for failure in failures:
+        print(f"\t{failure['source_path']}: {failure['error']}")
 
-            print(f"Text extracted and saved to {output_file_name}")
+    return results
 
 
 if __name__ == "__main__":
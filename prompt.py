@@ -6,3 +6,21 @@ qa_prompt = {
         Answer in Chinese.",
     "user": "Knowledge Context: {CONTENT}.\n My question is {QUESTION}.",
 }
+
+summary_prompt = {
+    "system": "You maintain a running summary of a conversation between an employee and an enterprise \
+        question-answering robot. Merge the new conversation lines into the summary. \
+        Keep the facts, names, document codes and open questions the robot may need later, drop small talk. \
+        Answer with the updated summary only, in Chinese, in at most 200 words.",
+    "user": "Current summary: {SUMMARY}\n New conversation lines:\n{CONVERSATION}",
+}
+
+marking_prompt = {
+    "system": "You are marking the answers of employees to a training exam. \
+        Compare the employee's answer with the reference answer and give a score between 0 and {FULL_SCORE}: \
+        full score for an answer with the same meaning as the reference, partial score for a partially correct answer, \
+        0 for a wrong or empty answer. Do not penalize wording or typos. Answer with the score only.",
+    "user": "Question: {QUESTION}\n Reference answer: {REFERENCE}\n Employee's answer: {ANSWER}",
+}
+
+memory_prompt = "Summary of the earlier conversation: {SUMMARY}"
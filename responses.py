@@ -0,0 +1,16 @@
+from typing import Optional
+
+
+def formatted_response(success: bool, msg: str, data=None, code: Optional[int] = None) -> dict:
+    if success:
+        return {
+            "code": code or 200,
+            "msg": msg,
+            "data": data
+        }
+    else:
+        return {
+            "code": code or 404,
+            "msg": msg,
+            "data": None
+        }
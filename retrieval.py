@@ -0,0 +1,477 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import NamedTuple, Optional
+
+from db import AsyncVecDBClient, VecDBClient
+
+# Document codes such as ZC-S-H-002, also when glued to the title as in "ZC-S-H-002RBA管理手册"
+CODE_PATTERN = r"[a-z0-9]+(?:[-_][a-z0-9]+)+"
+TOKEN_PATTERN = re.compile(rf"{CODE_PATTERN}|[a-z0-9]+|[\u3400-\u9fff]+")
+CODE_PART_PATTERN = re.compile(r"[a-z]+|[0-9]+")
+CJK_PATTERN = re.compile(r"[\u3400-\u9fff]+")
+
+
+def is_code_term(term: str) -> bool:
+    return "-" in term
+
+
+def code_terms(code: str) -> list[str]:
+    """
+    Index terms of a document code: its hyphen-joined prefixes, with the parts split at
+    letter/digit boundaries, so that a code matches the codes it is a prefix of.
+    """
+    parts = CODE_PART_PATTERN.findall(code)
+    return ["-".join(parts[:idx]) for idx in range(2, len(parts) + 1)]
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Split text into index terms: ASCII words as whole tokens, document codes as their prefixes
+    (see ``code_terms``), runs of Chinese characters as overlapping character bigrams (a single
+    character stays a unigram).
+
+    >>> tokenize("ZC-S-H-002RBA管理手册（A1）.txt")
+    ['zc-s', 'zc-s-h', 'zc-s-h-002', 'zc-s-h-002-rba', '管理', '理手', '手册', 'a1', 'txt']
+    >>> tokenize("ZC-S-H-002")
+    ['zc-s', 'zc-s-h', 'zc-s-h-002']
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    terms = []
+    for token in TOKEN_PATTERN.findall(text):
+        if CJK_PATTERN.fullmatch(token):
+            if len(token) == 1:
+                terms.append(token)
+            else:
+                terms.extend(token[idx:idx + 2] for idx in range(len(token) - 1))
+        elif "-" in token or "_" in token:
+            terms.extend(code_terms(token))
+        else:
+            terms.append(token)
+    return terms
+
+
+def chunk_text(payload: dict) -> str:
+    """
+    Indexed text of a chunk: its content plus the name of its source file, which usually
+    carries the document code.
+    """
+    source = payload.get("metadata", {}).get("source", "")
+    return f"{os.path.basename(source)} {payload.get('page_content', '')}"
+
+
+class LexicalHit(NamedTuple):
+    vec_id: str
+    score: float  # BM25 score
+    coverage: float  # share of the query's idf mass found in the chunk
+    matched_terms: int  # number of query terms found in the chunk
+    matched_code: bool  # whether a document code of the query was found in the chunk
+    payload: dict
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index over the chunks of a collection, persisted as one JSON file next to
+    the local vector index and reloaded when the file is replaced.
+    """
+
+    def __init__(
+            self,
+            index_path: str,
+            collection_name: str,
+            k1: float = 1.2,
+            b: float = 0.75,
+            reload_interval: float = 10.0
+    ) -> None:
+        """
+        :param index_path: folder holding the index file
+        :param collection_name: collection the index was built from
+        :param k1: BM25 term frequency saturation
+        :param b: BM25 document length normalization
+        :param reload_interval: how often to check whether the index file was replaced, in seconds
+        """
+        self._index_path = index_path
+        self._collection_name = collection_name
+        self._k1 = k1
+        self._b = b
+        self._reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._load()
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self._index_path, f"{self._collection_name}.lexical.json")
+
+    @property
+    def num_chunks(self) -> int:
+        return len(self._index["ids"])
+
+    def _index_mtime(self) -> Optional[float]:
+        try:
+            return os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return None
+
+    def _reload_if_changed(self) -> None:
+        now = time.monotonic()
+        if now - self._last_check_time < self._reload_interval:
+            return
+        self._last_check_time = now
+        if self._index_mtime() != self._loaded_mtime:
+            with self._lock:
+                self._load()
+
+    def _load(self) -> None:
+        self._last_check_time = time.monotonic()
+        self._loaded_mtime = self._index_mtime()
+        if self._loaded_mtime is None:
+            index = {"ids": [], "payloads": [], "doc_lens": [], "postings": {}}
+        else:
+            with open(self.path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+
+        num_chunks = len(index["ids"])
+        avg_len = sum(index["doc_lens"]) / num_chunks if num_chunks else 0.0
+        index["idf"] = {
+            term: math.log(1 + (num_chunks - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in index["postings"].items()
+        }
+        index["avg_len"] = avg_len
+        # Swapped at once so concurrent searches see a consistent index
+        self._index = index
+
+    def build(self, chunks: list[tuple[str, dict]]) -> int:
+        """
+        Replace the index with the given chunks.
+        :param chunks: format: [(vec_id, payload), ...]
+        :return: the number of indexed chunks
+        """
+        postings: dict[str, list[list]] = {}
+        doc_lens = []
+        for doc_idx, (_, payload) in enumerate(chunks):
+            terms = tokenize(chunk_text(payload))
+            doc_lens.append(len(terms))
+            for term, tf in Counter(terms).items():
+                postings.setdefault(term, []).append([doc_idx, tf])
+
+        os.makedirs(self._index_path, exist_ok=True)
+        with open(f"{self.path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "ids": [str(vec_id) for vec_id, _ in chunks],
+                    "payloads": [payload for _, payload in chunks],
+                    "doc_lens": doc_lens,
+                    "postings": postings
+                },
+                f,
+                ensure_ascii=False
+            )
+        os.replace(f"{self.path}.tmp", self.path)
+
+        with self._lock:
+            self._load()
+        return len(chunks)
+
+    def sync_from_qdrant(self, vecdb_client: VecDBClient, batch_size: int = 256) -> int:
+        """
+        Rebuild the index from the payloads of the same collection in Qdrant.
+        :param vecdb_client: Qdrant client
+        :param batch_size: number of points fetched per scroll request
+        :return: the number of indexed chunks
+        """
+        chunks = []
+        offset = None
+        while True:
+            points, offset = vecdb_client.scroll(
+                collection_name=self._collection_name,
+                limit=batch_size,
+                offset=offset,
+                with_payload=True,
+                with_vectors=False
+            )
+            chunks.extend((str(point.id), point.payload) for point in points)
+            if offset is None:
+                break
+
+        return self.build(chunks)
+
+    def search(self, query: str, top_k: int = 5) -> list[LexicalHit]:
+        """
+        :param query: query text
+        :param top_k: number of chunks to return
+        :return: the ``top_k`` chunks with the highest BM25 score, best first
+        """
+        self._reload_if_changed()
+        index = self._index
+        idf = index["idf"]
+        query_terms = set(tokenize(query))
+        # Terms that never occur in the corpus match nothing, but still count in the coverage
+        # denominator, with the idf of a term found in no chunk
+        terms = [term for term in query_terms if term in idf]
+        if not terms:
+            return []
+
+        scores: dict[int, float] = {}
+        matched_idf: dict[int, float] = {}
+        matched_terms: dict[int, int] = {}
+        matched_code: dict[int, bool] = {}
+        doc_lens, avg_len = index["doc_lens"], index["avg_len"]
+        for term in terms:
+            term_idf = idf[term]
+            for doc_idx, tf in index["postings"][term]:
+                norm = self._k1 * (1 - self._b + self._b * doc_lens[doc_idx] / avg_len)
+                scores[doc_idx] = scores.get(doc_idx, 0.0) + term_idf * tf * (self._k1 + 1) / (tf + norm)
+                matched_idf[doc_idx] = matched_idf.get(doc_idx, 0.0) + term_idf
+                matched_terms[doc_idx] = matched_terms.get(doc_idx, 0) + 1
+                matched_code[doc_idx] = matched_code.get(doc_idx, False) or is_code_term(term)
+
+        num_chunks = len(index["ids"])
+        unknown_idf = math.log(1 + (num_chunks + 0.5) / 0.5)
+        total_idf = sum(idf.get(term, unknown_idf) for term in query_terms)
+        best = sorted(scores, key=scores.get, reverse=True)[:top_k]
+        return [
+            LexicalHit(
+                vec_id=index["ids"][doc_idx],
+                score=scores[doc_idx],
+                coverage=matched_idf[doc_idx] / total_idf if total_idf else 0.0,
+                matched_terms=matched_terms[doc_idx],
+                matched_code=matched_code[doc_idx],
+                payload=index["payloads"][doc_idx]
+            )
+            for doc_idx in best
+        ]
+
+
+class HybridRetriever:
+    """
+    Lexical fast path in front of the vector search.
+
+    When the question quotes a document code and the best BM25 hit matches it, covers nearly
+    all of the question's terms and clearly beats the runner-up, its chunks are returned
+    without embedding the question. Otherwise the vector results are fused with the lexical
+    candidates by reciprocal rank fusion; a lexical candidate missing from the vector results
+    must cover enough of the question, since it did not pass the vector score threshold.
+    """
+
+    def __init__(
+            self,
+            lexical_index: LexicalIndex,
+            fast_path_coverage: float = 0.9,
+            fast_path_margin: float = 1.2,
+            fast_path_min_terms: int = 3,
+            fusion_min_coverage: float = 0.4,
+            candidate_k: int = 20,
+            rrf_k: int = 60
+    ) -> None:
+        """
+        :param lexical_index: BM25 index of the document collection
+        :param fast_path_coverage: minimum share of the question's idf mass matched by the best hit
+        :param fast_path_margin: minimum ratio of the best to the second best BM25 score
+        :param fast_path_min_terms: minimum number of query terms matched by the best hit, which
+            must also match a document code of the question
+        :param fusion_min_coverage: minimum share of the question's idf mass matched by a lexical
+            candidate that the vector search did not return, for it to be fused
+        :param candidate_k: number of lexical and vector candidates fused on the slow path
+        :param rrf_k: reciprocal rank fusion constant
+        """
+        self._lexical_index = lexical_index
+        self._fast_path_coverage = fast_path_coverage
+        self._fast_path_margin = fast_path_margin
+        self._fast_path_min_terms = fast_path_min_terms
+        self._fusion_min_coverage = fusion_min_coverage
+        self._candidate_k = candidate_k
+        self._rrf_k = rrf_k
+
+        # Counters
+        self._lock = threading.Lock()
+        self._fast_path_hits = 0
+        self._lookups = 0
+        self._lexical_seconds = 0.0
+        self._dense_lookups = 0
+        self._dense_seconds = 0.0
+
+    @property
+    def candidate_k(self) -> int:
+        return self._candidate_k
+
+    def fast_path(self, question: str, top_k: int = 1) -> Optional[list[dict]]:
+        """
+        Answer the retrieval from the lexical index alone, if the match is strong enough.
+        :param question: user question
+        :param top_k: number of chunks to return
+        :return: payloads of the best chunks, or None when the vector search is needed
+        """
+        start_time = time.perf_counter()
+        hits = self._lexical_index.search(question, top_k=max(top_k, 2))
+        strong = (
+            bool(hits)
+            and hits[0].matched_code
+            and hits[0].matched_terms >= self._fast_path_min_terms
+            and hits[0].coverage >= self._fast_path_coverage
+            and (len(hits) == 1 or hits[0].score >= self._fast_path_margin * hits[1].score)
+        )
+
+        with self._lock:
+            self._lookups += 1
+            self._lexical_seconds += time.perf_counter() - start_time
+            if strong:
+                self._fast_path_hits += 1
+
+        return [hit.payload for hit in hits[:top_k]] if strong else None
+
+    def fuse(self, question: str, vector_payloads: list[dict], top_k: int = 1) -> list[dict]:
+        """
+        Reciprocal rank fusion of vector results and lexical candidates. Chunks are matched on
+        their text, since vector results only carry payloads.
+        :param question: user question
+        :param vector_payloads: payloads of the vector search, best first
+        :param top_k: number of chunks to return
+        :return: payloads of the best fused chunks
+        """
+        scores: dict[str, float] = {}
+        payloads: dict[str, dict] = {}
+        vector_keys = {payload.get("page_content", "") for payload in vector_payloads}
+        # A chunk sharing a common term or two with an off-topic question is not context
+        lexical_payloads = [
+            hit.payload for hit in self._lexical_index.search(question, top_k=self._candidate_k)
+            if hit.payload.get("page_content", "") in vector_keys or hit.coverage >= self._fusion_min_coverage
+        ]
+        for ranked in (vector_payloads, lexical_payloads):
+            for rank, payload in enumerate(ranked, start=1):
+                key = payload.get("page_content", "")
+                scores[key] = scores.get(key, 0.0) + 1 / (self._rrf_k + rank)
+                payloads.setdefault(key, payload)
+
+        return [payloads[key] for key in sorted(scores, key=scores.get, reverse=True)[:top_k]]
+
+    def search(
+            self,
+            question: str,
+            query_vec: list[float],
+            vecdb_client: VecDBClient,
+            top_k: int = 1,
+            score_threshold: float = 0.80,
+            timeout: Optional[float] = None
+    ) -> list[dict]:
+        """
+        Vector search of ``candidate_k`` chunks fused with the lexical candidates.
+        :param timeout: deadline of the vector search, see ``VecDBClient.retrieve_similar_vectors``
+        """
+        vector_payloads = vecdb_client.retrieve_similar_vectors(
+            query_vec,
+            top_k=max(top_k, self._candidate_k),
+            score_threshold=score_threshold,
+            timeout=timeout
+        )
+        return self.fuse(question, vector_payloads, top_k=top_k)
+
+    async def asearch(
+            self,
+            question: str,
+            query_vec: list[float],
+            vecdb_client: AsyncVecDBClient,
+            top_k: int = 1,
+            score_threshold: float = 0.80,
+            timeout: Optional[float] = None
+    ) -> list[dict]:
+        """
+        ``search`` on an asyncio client.
+        """
+        vector_payloads = await vecdb_client.retrieve_similar_vectors(
+            query_vec,
+            top_k=max(top_k, self._candidate_k),
+            score_threshold=score_threshold,
+            timeout=timeout
+        )
+        return self.fuse(question, vector_payloads, top_k=top_k)
+
+    def search_batch(
+            self,
+            questions: list[str],
+            query_vecs: list[list[float]],
+            vecdb_client: VecDBClient,
+            top_k: int = 1,
+            score_threshold: float = 0.80,
+            timeout: Optional[float] = None
+    ) -> list[list[dict]]:
+        """
+        ``search`` of several questions, with one vector search request for all of them.
+        """
+        vector_payloads = vecdb_client.retrieve_similar_vectors_batch(
+            query_vecs,
+            top_k=max(top_k, self._candidate_k),
+            score_threshold=score_threshold,
+            timeout=timeout
+        )
+        return [
+            self.fuse(question, payloads, top_k=top_k)
+            for question, payloads in zip(questions, vector_payloads)
+        ]
+
+    def lexical_search(self, question: str, top_k: int = 1) -> list[dict]:
+        """
+        Best BM25 chunks regardless of the fast path thresholds, for when the vector search is unavailable.
+        """
+        return [hit.payload for hit in self._lexical_index.search(question, top_k=top_k)]
+
+    def record_dense_time(self, seconds: float) -> None:
+        """
+        Record the latency of a retrieval that went through embedding and vector search.
+        """
+        with self._lock:
+            self._dense_lookups += 1
+            self._dense_seconds += seconds
+
+    def stats(self) -> dict:
+        """
+        Fast path counters of this process, plus an estimate of the latency saved (fast path
+        hits multiplied by the mean latency difference of the two paths).
+        """
+        with self._lock:
+            mean_lexical_seconds = self._lexical_seconds / self._lookups if self._lookups else 0.0
+            mean_dense_seconds = self._dense_seconds / self._dense_lookups if self._dense_lookups else 0.0
+            return {
+                "indexed_chunks": self._lexical_index.num_chunks,
+                "lookups": self._lookups,
+                "fast_path_hits": self._fast_path_hits,
+                "hit_ratio": self._fast_path_hits / self._lookups if self._lookups else 0.0,
+                "mean_lexical_seconds": mean_lexical_seconds,
+                "mean_dense_seconds": mean_dense_seconds,
+                "saved_seconds": self._fast_path_hits * max(mean_dense_seconds - mean_lexical_seconds, 0.0),
+            }
+
+
+class RecentResults:
+    """
+    Last retrieval results per question, served when the vector search misses its deadline.
+    """
+
+    def __init__(self, max_size: int = 1024) -> None:
+        self._max_size = max_size
+        self._results: OrderedDict[str, list[dict]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(question: str) -> str:
+        return " ".join(unicodedata.normalize("NFKC", question).lower().split())
+
+    def get(self, question: str) -> Optional[list[dict]]:
+        key = self.key(question)
+        with self._lock:
+            payloads = self._results.get(key)
+            if payloads is not None:
+                self._results.move_to_end(key)
+            return payloads
+
+    def put(self, question: str, payloads: list[dict]) -> None:
+        key = self.key(question)
+        with self._lock:
+            self._results[key] = payloads
+            self._results.move_to_end(key)
+            while len(self._results) > self._max_size:
+                self._results.popitem(last=False)
@@ -0,0 +1,145 @@
+"""
+Production entry point of the QA API: a pre-fork gunicorn server.
+
+The master imports the heavy dependencies once, before forking, so the workers share them
+and start fast. Each worker then builds its own app with ``api.create_app`` and warms it up
+(connection pools, Redis, tokenizer, embedding cache, answer cache collection) before it
+accepts its first request. On SIGTERM, the workers stop accepting, finish the requests and
+streams in flight within ``graceful_timeout``, then drain their background work (streams
+whose client left, chat summaries) and close their connections.
+
+Usage: python serve.py [--config config.yaml] [--bind 0.0.0.0:7001] [--workers 4] [--threads 16]
+
+Settings are read from the ``server`` section of config.yaml; the command line overrides them.
+The workers share one listening socket, so a /metrics scrape reaches any one of them: they
+write their metrics to ``metrics.multiprocess_dir`` (a temporary directory by default), emptied
+here on startup, and every worker reports the values of all of them.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import yaml
+from gunicorn.app.base import BaseApplication
+
+from metrics import registry, retire_snapshots
+
+DEFAULT_SERVER_CONFIG = {
+    "bind": "0.0.0.0:7001",
+    "workers": 4,
+    # Threads per worker: each open stream holds one
+    "threads": 16,
+    "timeout": 120,
+    # Time left to the requests and streams in flight on shutdown
+    "graceful_timeout": 60,
+    "keepalive": 5,
+}
+
+
+class QAServer(BaseApplication):
+
+    def __init__(self, config_path: str, options: dict, metrics_dir: str) -> None:
+        """
+        :param config_path: path of config.yaml, read again by every worker
+        :param options: gunicorn settings
+        :param metrics_dir: directory where the workers share their metrics
+        """
+        self._config_path = config_path
+        self._options = options
+        self._metrics_dir = metrics_dir
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self._options.items():
+            self.cfg.set(key, value)
+        self.cfg.set("worker_class", "gthread")
+        self.cfg.set("worker_exit", worker_exit)
+        self.cfg.set("child_exit", child_exit)
+
+    @property
+    def metrics_dir(self) -> str:
+        return self._metrics_dir
+
+    def load(self):
+        # Called in each worker, after the fork and before it accepts connections
+        from api import create_app
+        return create_app(self._config_path, warm_up=True, metrics_dir=self._metrics_dir)
+
+
+def preload_dependencies() -> float:
+    """
+    Import the modules of ``create_app`` in the master; the forked workers inherit them.
+    :return: import time, in seconds
+    """
+    start_time = time.perf_counter()
+    import api  # noqa: F401
+    import services  # noqa: F401
+    return time.perf_counter() - start_time
+
+
+def worker_exit(server, worker) -> None:
+    # The worker has stopped accepting and its requests are done; finish the background work
+    app = getattr(worker, "wsgi", None)
+    if app is None:
+        return
+    start_time = time.perf_counter()
+    app.extensions["qa"].close()
+    # Final values: the counters of an exited worker keep counting in the totals, its snapshot is deleted
+    registry.retire()
+    server.log.info("Worker %s drained in %.3fs", worker.pid, time.perf_counter() - start_time)
+
+
+def child_exit(server, worker) -> None:
+    # Called in the master for every reaped worker, before its pid can be reused: also retires
+    # the snapshots of a worker that was killed before its worker_exit ran
+    retired = retire_snapshots(server.app.metrics_dir, worker.pid)
+    if retired:
+        server.log.info("Retired %d metrics snapshots of worker %s", retired, worker.pid)
+
+
+def prepare_metrics_dir(config: dict) -> str:
+    """
+    :return: an empty directory for the metrics of the workers
+    """
+    metrics_dir = config.get('metrics', {}).get('multiprocess_dir')
+    if not metrics_dir:
+        return tempfile.mkdtemp(prefix="qa-metrics-")
+    # Values left by a previous run would be added to this one's
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+    return metrics_dir
+
+
+def server_options(config: dict, args: argparse.Namespace) -> dict:
+    server_config = config.get('server', {})
+    options = {**DEFAULT_SERVER_CONFIG, **server_config}
+    for key in DEFAULT_SERVER_CONFIG:
+        value = getattr(args, key, None)
+        if value is not None:
+            options[key] = value
+    return options
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.yaml", help="path of config.yaml")
+    parser.add_argument("--bind")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--threads", type=int, help="threads per worker")
+    parser.add_argument("--timeout", type=int, help="seconds before a silent worker is restarted")
+    parser.add_argument("--graceful-timeout", dest="graceful_timeout", type=int, help="shutdown drain time")
+    args = parser.parse_args()
+
+    config_path = os.path.abspath(args.config)
+    with open(config_path, "r") as f:
+        config = yaml.safe_load(f) or {}
+    options = server_options(config, args)
+    metrics_dir = prepare_metrics_dir(config)
+    print(f"Imported dependencies in {preload_dependencies():.3f}s")
+    QAServer(config_path, options, metrics_dir).run()
+
+
+if __name__ == "__main__":
+    main()
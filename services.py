@@ -0,0 +1,728 @@
+"""
+Long-lived state of a QA worker process: connection pools, caches, retrievers, chat memory and
+the admission controller, built from config.yaml.
+
+This module pulls in openai, qdrant_client and redis, so ``api`` only imports it from
+``create_app``; a pre-fork launcher imports it once in the master, before forking the workers.
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import AsyncGenerator, Awaitable, Generator, Iterator, Optional
+
+import openai
+import yaml
+from dotenv import load_dotenv
+
+from admission import AdmissionController, AdmissionTicket, AsyncAdmissionController, AsyncAdmissionTicket
+from cache import AsyncEmbeddingCache, AsyncSemanticAnswerCache, EmbeddingCache, SemanticAnswerCache
+from context_builder import ContextBuilder
+from db import (
+    AsyncChatBotRedisClient,
+    AsyncVecDBClient,
+    ConnectionPools,
+    HedgingPolicy,
+    PooledPostgresqlClient,
+    SearchTimeoutError,
+    StreamJournal
+)
+from embedder import BatchEmbedder
+from exam import ExamAssembler
+from marking import MarkResult, Question, QuestionBank
+from memory import AsyncChatMemory, ChatMemory
+from metrics import RETRIEVAL_FALLBACKS, Trace
+from retrieval import HybridRetriever, LexicalIndex, RecentResults
+from utils import (
+    aget_openai_response,
+    aget_text_embedding,
+    asummarize_conversation,
+    get_text_embedding,
+    get_text_embeddings,
+    get_text_embeddings_cached,
+    get_openai_response,
+    grade_answer,
+    summarize_conversation
+)
+
+CHAT_MEMORY_LEN = 6
+
+
+def load_config(config_path: str = "config.yaml") -> dict:
+    with open(config_path, "r") as f:
+        return yaml.safe_load(f)
+
+
+class QAServices:
+    """
+    Created once per worker process and shared by its requests; the pools re-initialize
+    themselves after a fork, but ``warm_up`` is only worth calling in the worker itself.
+    """
+
+    def __init__(self, config: dict) -> None:
+        self.config = config
+        self._init_models(config)
+        self._init_retrieval(config)
+
+        # ------------------------------------ Connection pools ------------------------------------
+        self.pools = ConnectionPools(config)
+
+        stream_journal_config = config.get('stream', {})
+        self.stream_journal = StreamJournal(
+            redis_client=self.pools.redis,
+            ttl=stream_journal_config.get('journal_ttl', 300),
+            block_ms=stream_journal_config.get('journal_block_ms', 15000),
+        )
+
+        # Finishes generations whose client disconnected mid-stream
+        self.background_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="stream-drain")
+
+        # Folds old chat turns into the running summaries
+        self.summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="chat-summary")
+
+        # ------------------------------------ Embedding cache ------------------------------------
+        embedding_cache_config = config.get('embedding_cache', {})
+        self.embedding_cache = EmbeddingCache(
+            redis_client=self.pools.redis,
+            max_local_size=embedding_cache_config.get('max_local_size', 4096),
+            ttl=embedding_cache_config.get('ttl', 7 * 24 * 3600),
+        )
+
+        # ------------------------------------ Embedding batcher ------------------------------------
+        embedding_batch_config = config.get('embedding_batch', {})
+        self.embedder = BatchEmbedder(
+            embed_batch=get_text_embeddings,
+            max_batch_size=embedding_batch_config.get('max_batch_size', 64),
+            max_wait_ms=embedding_batch_config.get('max_wait_ms', 5.0),
+        ) if embedding_batch_config.get('enabled', True) else None
+
+        # ------------------------------------ Answer cache ------------------------------------
+        answer_cache_config = config.get('answer_cache', {})
+        self.answer_cache = SemanticAnswerCache(
+            vecdb_pool=self.pools.answer_cache_qdrant,
+            score_threshold=answer_cache_config.get('score_threshold', 0.95),
+            ttl=answer_cache_config.get('ttl', 24 * 3600),
+        ) if answer_cache_config.get('enabled', True) else None
+
+        # ------------------------------------ Chat memory ------------------------------------
+        chat_memory_config = config.get('chat_memory', {})
+        self.chat_memory = ChatMemory(
+            redis_client=self.pools.redis,
+            count_tokens=self.context_builder.count_tokens,
+            token_budget=chat_memory_config.get('token_budget', 1000),
+            recent_turns=chat_memory_config.get('recent_turns', CHAT_MEMORY_LEN // 2),
+            summarize=(
+                lambda summary, messages: summarize_conversation(summary, messages, llm_model_name=self.chat_model_name)
+            ) if chat_memory_config.get('mode', 'summary') == 'summary' else None,
+            executor=self.summary_executor,
+            ttl=1800,  # 设置TTL为1800秒（30 分钟)
+        )
+
+        # ------------------------------------ Admission control ------------------------------------
+        # Caps the LLM calls in flight; the global cap is shared by all workers through Redis
+        admission_config = config.get('admission', {})
+        self.admission = AdmissionController(
+            redis_client=self.pools.redis,
+            max_in_flight=admission_config.get('max_in_flight', 8),
+            max_global_in_flight=admission_config.get('max_global_in_flight'),
+            max_queue=admission_config.get('max_queue', 32),
+            max_wait=admission_config.get('max_wait', 10.0),
+            slot_ttl=admission_config.get('slot_ttl', 300),
+        ) if admission_config.get('enabled', True) else None
+
+        # ------------------------------------ Batch QA ------------------------------------
+        batch_config = config.get('batch', {})
+        self.max_batch_size = batch_config.get('max_questions', 200)
+        # Shared by all the batches of this worker, so that bulk jobs cannot crowd out single questions
+        self.batch_executor = ThreadPoolExecutor(
+            max_workers=batch_config.get('max_concurrency', 4),
+            thread_name_prefix="qa-batch"
+        )
+
+        # ------------------------------------ Marking ------------------------------------
+        # Choice questions are marked from an in-memory copy of the questions table, free-text ones by the LLM
+        marking_config = config.get('marking', {})
+        pg_config = config.get('postgresql')
+        self.question_bank = QuestionBank(
+            pg_client=PooledPostgresqlClient(
+                host=pg_config['host'],
+                port=pg_config['port'],
+                database=pg_config['database'],
+                user=pg_config['user'],
+                password=pg_config['password'],
+                # Connections are opened on the first refresh, so a down database does not stop the worker
+                min_connections=0,
+                max_connections=marking_config.get('max_connections', 2)
+            ),
+            full_score=marking_config.get('full_score', 5.0),
+            refresh_interval=marking_config.get('refresh_interval', 60),
+        ) if pg_config is not None and marking_config.get('enabled', True) else None
+
+        # ------------------------------------ Exam papers ------------------------------------
+        exam_config = config.get('exam', {})
+        self.exam_assembler = ExamAssembler(
+            question_bank=self.question_bank,
+            redis_client=self.pools.redis,
+            departments=exam_config.get('departments', {}),  # 部门 -> 文件编号列表
+            question_counts=exam_config.get('question_counts', {0: 20}),  # 题型 -> 每份试卷的题目数
+            ttl=exam_config.get('cache_ttl', 24 * 3600),
+        ) if self.question_bank is not None else None
+
+    def _init_models(self, config: dict) -> None:
+        """
+        Model names, shared with ``AsyncQAServices``.
+        """
+        # ------------------------------------ OpenAI config ------------------------------------
+        load_dotenv()
+        openai.api_key = os.environ.get("OPENAI_API_KEY")
+
+        openai_config = config['openai']
+        self.chat_model_name = openai_config['chat_model']
+        self.embedding_model_name = openai_config['embedding_model']
+        # openai.proxy = "http://127.0.0.1:7890"
+
+    def _init_retrieval(self, config: dict) -> None:
+        """
+        Retriever, fallback results and context builder, shared with ``AsyncQAServices``:
+        they hold no connection.
+        """
+        # ------------------------------------ Lexical retrieval ------------------------------------
+        qdrant_config = config['qdrant']
+        lexical_config = config.get('lexical', {})
+        self.retriever = HybridRetriever(
+            lexical_index=LexicalIndex(
+                index_path=lexical_config.get('index_path', qdrant_config.get("local_index_path", "./vecdb_index")),
+                collection_name=qdrant_config["document_collection_name"],
+            ),
+            fast_path_coverage=lexical_config.get('fast_path_coverage', 0.9),
+            fast_path_margin=lexical_config.get('fast_path_margin', 1.2),
+            fast_path_min_terms=lexical_config.get('fast_path_min_terms', 3),
+            fusion_min_coverage=lexical_config.get('fusion_min_coverage', 0.4),
+            candidate_k=lexical_config.get('candidate_k', 20),
+        ) if lexical_config.get('enabled', True) else None
+
+        # Served when the vector search misses its deadline (qdrant.retrieval.timeout)
+        self.recent_results = RecentResults(
+            max_size=qdrant_config.get('retrieval', {}).get('recent_results_size', 1024)
+        )
+
+        # ------------------------------------ Context packing ------------------------------------
+        context_config = config.get('context', {})
+        self.context_builder = ContextBuilder(
+            token_budget=context_config.get('token_budget', 1500),
+            candidate_k=context_config.get('candidate_k', 8),
+            score_threshold=context_config.get('score_threshold', 0.80),
+            model_name=self.chat_model_name,
+        )
+
+    # ------------------------------------ Lifecycle ------------------------------------
+    def warm_up(self) -> dict[str, float]:
+        """
+        Open the connections and load the indexes and tables that the first requests would
+        otherwise pay for. A failing step is reported and skipped: the worker still starts, and
+        the request that needs it retries.
+        :return: duration of each step, in seconds
+        """
+        warm_up_config = self.config.get('warm_up', {})
+
+        def prime_qdrant() -> None:
+            # One client per expected concurrent request, health-checked on creation
+            clients = [self.pools.qdrant.acquire() for _ in range(warm_up_config.get('qdrant_clients', 2))]
+            try:
+                for client in clients:
+                    client.get_collections()
+            finally:
+                for client in clients:
+                    self.pools.qdrant.release(client)
+
+        def prime_embedding_cache() -> None:
+            # Only the Redis tier is read, no embedding API call is made
+            for question in warm_up_config.get('questions', []):
+                self.embedding_cache.get(question, self.embedding_model_name)
+
+        steps = [
+            ("redis", self.pools.redis.ping),
+            ("qdrant", prime_qdrant),
+            ("tokenizer", lambda: self.context_builder.count_tokens("")),
+            ("embedding_cache", prime_embedding_cache),
+        ]
+        if self.answer_cache is not None:
+            steps.append(("answer_cache", self.answer_cache.ensure_collection))
+        if self.question_bank is not None:
+            steps.append(("question_bank", self.question_bank.refresh))
+        if self.exam_assembler is not None:
+            steps.append(("exam_index", self.exam_assembler.index))
+
+        timings = {}
+        for name, step in steps:
+            start_time = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                print(f"预热失败: {name}. Exception: {e}")
+            timings[name] = time.perf_counter() - start_time
+        return timings
+
+    def close(self) -> None:
+        """
+        Finish the background work of the requests already served, then close the connections.
+        """
+        # Streams whose client left are drained into the journal, pending summaries are folded
+        self.background_executor.shutdown(wait=True)
+        self.summary_executor.shutdown(wait=True)
+        self.batch_executor.shutdown(wait=True)
+        self.pools.close()
+        if self.question_bank is not None:
+            self.question_bank.close()
+
+    # ------------------------------------ Request helpers ------------------------------------
+    def acquire_llm_slot(self, trace: Trace) -> Optional[AdmissionTicket]:
+        """
+        :raise AdmissionRejected: if the request is shed
+        """
+        if self.admission is None:
+            return None
+        with trace.span("admission"):
+            return self.admission.acquire()
+
+    @staticmethod
+    def release_llm_slot(ticket: Optional[AdmissionTicket]) -> None:
+        if ticket is not None:
+            ticket.release()
+
+    def answer(
+            self,
+            context_text: str,
+            user_question: str,
+            is_stream: bool = False,
+            chat_history: Optional[list] = None
+    ) -> str | Generator:
+        return get_openai_response(
+            context_text=context_text,
+            user_question=user_question,
+            llm_model_name=self.chat_model_name,
+            is_stream=is_stream,
+            chat_history=chat_history,
+        )
+
+    def degraded_context_points(self, user_question: str) -> list[dict]:
+        """
+        Chunks of a question whose vector search missed its deadline: the last result of the same
+        question, else the best lexical matches, else none (the LLM answers without context).
+        """
+        points = self.recent_results.get(user_question)
+        source = "recent"
+        if points is None:
+            points = self.retriever.lexical_search(
+                user_question, top_k=self.context_builder.candidate_k
+            ) if self.retriever is not None else []
+            source = "lexical" if points else "none"
+        RETRIEVAL_FALLBACKS.inc(source=source)
+        print(f"\t向量数据库检索超时，降级检索: {source}")
+        return points
+
+    def fast_path_points(self, user_question: str, trace: Trace) -> Optional[list[dict]]:
+        """
+        :return: chunks of the lexical fast path, or None if the question needs a vector search
+        """
+        if self.retriever is None:
+            return None
+        with trace.span("lexical_search"):
+            points = self.retriever.fast_path(user_question, top_k=self.context_builder.candidate_k)
+        if points is not None:
+            print("\t命中关键词检索")
+        return points
+
+    def caches_answer(self, embedded_query: Optional[list[float]], chat_history: Optional[list] = None) -> bool:
+        """
+        Whether the answer of a question is looked up in and stored to the answer cache: not without
+        an embedding (fast path answer not embedded, or degraded context), nor for a follow-up
+        question, which must not be served another conversation's answer.
+        """
+        return self.answer_cache is not None and embedded_query is not None and not chat_history
+
+    def searched_context(self, user_question: str, points: list[dict], start_time: float) -> str:
+        """
+        Context of a completed vector search; the chunks are kept for the degraded fallback.
+        :param start_time: ``time.time()`` before the question was embedded
+        """
+        if self.retriever is not None:
+            self.retriever.record_dense_time(time.time() - start_time)
+        self.recent_results.put(user_question, points)
+        return self.context_builder.build(points)
+
+    def retrieve_context(
+            self,
+            user_question: str,
+            trace: Trace,
+            use_answer_cache: bool = True
+    ) -> tuple[list[float] | None, str | None, str]:
+        """
+        Try the lexical fast path, otherwise embed the question, then either hit the answer cache
+        or search the document collection.
+        :param trace: trace of the request, receives the embed, answer_cache and vector_search stages
+        :param use_answer_cache: False when the answer depends on the chat history, e.g. a
+            follow-up question, which must not be served another conversation's answer
+        :return: question embedding (None if the fast path answered and it was not cached, or if the
+            context is degraded, so that the answer is not cached), cached answer (or None), context text
+        """
+        points = self.fast_path_points(user_question, trace)
+        if points is not None:
+            # No embedding call on the fast path, but a cached embedding still allows an answer cache lookup
+            embedded_query = self.embedding_cache.get(user_question, self.embedding_model_name)
+        else:
+            start_time = time.time()
+            with trace.span("embed"):
+                embedded_query = get_text_embedding(
+                    text=user_question,
+                    embedding_model_name=self.embedding_model_name,
+                    cache=self.embedding_cache,
+                    embedder=self.embedder
+                )
+
+        if use_answer_cache and self.caches_answer(embedded_query):
+            with trace.span("answer_cache"):
+                cached_answer = self.answer_cache.lookup(embedded_query)
+            if cached_answer is not None:
+                return embedded_query, cached_answer, ""
+
+        if points is not None:
+            return embedded_query, None, self.context_builder.build(points)
+
+        # Given back before the LLM call, which may wait for an admission slot
+        qdrant_client = self.pools.qdrant.acquire()
+        try:
+            with trace.span("vector_search"):
+                if self.retriever is not None:
+                    points = self.retriever.search(
+                        user_question,
+                        embedded_query,
+                        qdrant_client,
+                        top_k=self.context_builder.candidate_k,
+                        score_threshold=self.context_builder.score_threshold
+                    )
+                else:
+                    points = qdrant_client.retrieve_similar_vectors(
+                        embedded_query,
+                        top_k=self.context_builder.candidate_k,
+                        score_threshold=self.context_builder.score_threshold
+                    )
+        except SearchTimeoutError:
+            # 向量数据库检索超时处理
+            return None, None, self.context_builder.build(self.degraded_context_points(user_question))
+        finally:
+            self.pools.qdrant.release(qdrant_client)
+        return embedded_query, None, self.searched_context(user_question, points, start_time)
+
+    def answer_batch(self, questions: list[str], trace: Trace) -> Iterator[tuple[int, str | None, Exception | None]]:
+        """
+        Answer several questions: one embedding call for the questions missing from the embedding
+        cache and one vector search request are made right away, the LLM calls are then run on the
+        batch executor as the results are consumed. Batch answers are not added to the chat history.
+        :param questions: user questions
+        :param trace: trace of the request, receives the embed, answer_cache, vector_search and llm_total stages
+        :return: (index of the question, answer, error) in completion order, answers from the cache first
+        :raise Exception: if the embedding or the vector search failed
+        """
+        with trace.span("embed"):
+            embeddings = get_text_embeddings_cached(questions, self.embedding_model_name, cache=self.embedding_cache)
+
+        cached_answers: list[str | None] = [None] * len(questions)
+        if self.answer_cache is not None:
+            with trace.span("answer_cache"):
+                cached_answers = [self.answer_cache.lookup(embedding) for embedding in embeddings]
+
+        pending = [idx for idx, answer in enumerate(cached_answers) if answer is None]
+        pending_questions = [questions[idx] for idx in pending]
+        degraded = False
+        points = []
+        if pending:
+            qdrant_client = self.pools.qdrant.acquire()
+            try:
+                with trace.span("vector_search"):
+                    if self.retriever is not None:
+                        points = self.retriever.search_batch(
+                            pending_questions,
+                            [embeddings[idx] for idx in pending],
+                            qdrant_client,
+                            top_k=self.context_builder.candidate_k,
+                            score_threshold=self.context_builder.score_threshold
+                        )
+                    else:
+                        points = qdrant_client.retrieve_similar_vectors_batch(
+                            [embeddings[idx] for idx in pending],
+                            top_k=self.context_builder.candidate_k,
+                            score_threshold=self.context_builder.score_threshold
+                        )
+            except SearchTimeoutError:
+                # 向量数据库检索超时处理
+                points = [self.degraded_context_points(question) for question in pending_questions]
+                degraded = True
+            finally:
+                self.pools.qdrant.release(qdrant_client)
+
+        contexts = {}
+        for idx, question_points in zip(pending, points):
+            contexts[idx] = self.context_builder.build(question_points)
+            if not degraded:
+                self.recent_results.put(questions[idx], question_points)
+
+        def answer_question(idx: int) -> str:
+            ticket = self.acquire_llm_slot(trace)
+            try:
+                with trace.span("llm_total"):
+                    answer = self.answer(context_text=contexts[idx], user_question=questions[idx])
+            finally:
+                self.release_llm_slot(ticket)
+            # Answers from a degraded context are not cached
+            if self.answer_cache is not None and not degraded:
+                self.answer_cache.store(questions[idx], embeddings[idx], answer)
+            return answer
+
+        def results() -> Iterator[tuple[int, str | None, Exception | None]]:
+            for idx, answer in enumerate(cached_answers):
+                if answer is not None:
+                    yield idx, answer, None
+
+            futures = {self.batch_executor.submit(answer_question, idx): idx for idx in pending}
+            try:
+                for future in as_completed(futures):
+                    try:
+                        yield futures[future], future.result(), None
+                    except Exception as e:
+                        yield futures[future], None, e
+            finally:
+                # The client went away: the calls not started yet are dropped
+                for future in futures:
+                    future.cancel()
+
+        return results()
+
+    def mark(self, question: Question, user_answer: str, trace: Trace) -> MarkResult:
+        """
+        Mark one answer: locally for a choice question, by the LLM for a free-text one.
+        :raise AdmissionRejected: if the LLM call of a free-text answer is shed
+        """
+        if question.is_choice:
+            with trace.span("mark"):
+                return self.question_bank.mark_choice(question, user_answer)
+
+        ticket = self.acquire_llm_slot(trace)
+        try:
+            with trace.span("llm_total"):
+                score = grade_answer(
+                    question=question.text,
+                    reference=question.reference,
+                    answer=user_answer,
+                    llm_model_name=self.chat_model_name,
+                    full_score=self.question_bank.full_score
+                )
+        finally:
+            self.release_llm_slot(ticket)
+        return MarkResult(question.question_id, score, None, question.reference)
+
+    def mark_sheet(
+            self,
+            answers: list[tuple[Question, str]],
+            trace: Trace
+    ) -> list[tuple[MarkResult | None, Exception | None]]:
+        """
+        Mark a whole answer sheet: the choice questions right away, the free-text ones concurrently
+        on the batch executor. A failed or shed LLM call only fails its own answer.
+        :param answers: (question, user answer) pairs
+        :param trace: trace of the request
+        :return: (result, error) pairs, in the order of ``answers``
+        """
+        results: list[tuple[MarkResult | None, Exception | None]] = [(None, None)] * len(answers)
+        futures = {}
+        for idx, (question, user_answer) in enumerate(answers):
+            if question.is_choice:
+                results[idx] = (self.question_bank.mark_choice(question, user_answer), None)
+            else:
+                futures[self.batch_executor.submit(self.mark, question, user_answer, trace)] = idx
+        try:
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = (future.result(), None)
+                except Exception as e:
+                    results[futures[future]] = (None, e)
+        finally:
+            for future in futures:
+                future.cancel()
+        return results
+
+    # ------------------------------------ Stats ------------------------------------
+    def cache_hit_ratios(self) -> dict[tuple[str, ...], float]:
+        stats = {"embedding": self.embedding_cache.stats()}
+        if self.answer_cache is not None:
+            stats["answer"] = self.answer_cache.stats()
+        if self.retriever is not None:
+            stats["lexical_fast_path"] = self.retriever.stats()
+        return {(name,): values["hit_ratio"] for name, values in stats.items()}
+
+
+class AsyncQAServices(QAServices):
+    """
+    ``QAServices`` of the asyncio serving path: the same retrieval and answer cache decisions on
+    asyncio Redis and Qdrant clients. Only the QA endpoints are served there, so no batch,
+    marking or exam component is built. The clients are bound to the event loop, so they are
+    created by ``open`` once it is running.
+    """
+
+    def __init__(self, config: dict) -> None:
+        self.config = config
+        self._init_models(config)
+        self._init_retrieval(config)
+
+    async def open(self) -> None:
+        qdrant_config = self.config['qdrant']
+        redis_config = self.config['redis']
+
+        # ------------------------------------ Clients ------------------------------------
+        self.qdrant_client = AsyncVecDBClient(
+            url=qdrant_config["url"],
+            collection_name=qdrant_config["document_collection_name"],
+            embedding_dim=qdrant_config["embedding_dim"],
+            quantization=qdrant_config.get("quantization"),
+            hedging=HedgingPolicy.from_config(qdrant_config.get("retrieval"))
+        )
+        self.redis_client = AsyncChatBotRedisClient(
+            host=redis_config["host"],
+            port=redis_config["port"],
+            password=redis_config["password"],
+            db=0,
+        )
+
+        # ------------------------------------ Caches ------------------------------------
+        embedding_cache_config = self.config.get('embedding_cache', {})
+        self.embedding_cache = AsyncEmbeddingCache(
+            redis_client=self.redis_client,
+            max_local_size=embedding_cache_config.get('max_local_size', 4096),
+            ttl=embedding_cache_config.get('ttl', 7 * 24 * 3600),
+        )
+
+        answer_cache_config = self.config.get('answer_cache', {})
+        self.answer_cache_client = AsyncVecDBClient(
+            url=qdrant_config["url"],
+            collection_name=qdrant_config.get("answer_cache_collection_name", "answer_cache"),
+            embedding_dim=qdrant_config["embedding_dim"]
+        ) if answer_cache_config.get('enabled', True) else None
+        self.answer_cache = AsyncSemanticAnswerCache(
+            vecdb_client=self.answer_cache_client,
+            score_threshold=answer_cache_config.get('score_threshold', 0.95),
+            ttl=answer_cache_config.get('ttl', 24 * 3600),
+        ) if self.answer_cache_client is not None else None
+
+        # ------------------------------------ Chat memory ------------------------------------
+        chat_memory_config = self.config.get('chat_memory', {})
+        self.chat_memory = AsyncChatMemory(
+            redis_client=self.redis_client,
+            count_tokens=self.context_builder.count_tokens,
+            token_budget=chat_memory_config.get('token_budget', 1000),
+            recent_turns=chat_memory_config.get('recent_turns', CHAT_MEMORY_LEN // 2),
+            summarize=(
+                lambda summary, messages: asummarize_conversation(summary, messages, llm_model_name=self.chat_model_name)
+            ) if chat_memory_config.get('mode', 'summary') == 'summary' else None,
+            ttl=1800,
+        )
+
+        # ------------------------------------ Admission control ------------------------------------
+        admission_config = self.config.get('admission', {})
+        self.admission = AsyncAdmissionController(
+            redis_client=self.redis_client,
+            max_in_flight=admission_config.get('max_in_flight', 8),
+            max_global_in_flight=admission_config.get('max_global_in_flight'),
+            max_queue=admission_config.get('max_queue', 32),
+            max_wait=admission_config.get('max_wait', 10.0),
+            slot_ttl=admission_config.get('slot_ttl', 300),
+        ) if admission_config.get('enabled', True) else None
+
+        if self.answer_cache is not None:
+            await self.answer_cache.ensure_collection()
+
+    async def close(self) -> None:
+        await self.qdrant_client.close()
+        if self.answer_cache_client is not None:
+            await self.answer_cache_client.close()
+        await self.redis_client.close()
+
+    # ------------------------------------ Request helpers ------------------------------------
+    async def acquire_llm_slot(self, trace: Trace) -> Optional[AsyncAdmissionTicket]:
+        """
+        :raise AdmissionRejected: if the request is shed
+        """
+        if self.admission is None:
+            return None
+        with trace.span("admission"):
+            return await self.admission.acquire()
+
+    @staticmethod
+    async def release_llm_slot(ticket: Optional[AsyncAdmissionTicket]) -> None:
+        if ticket is not None:
+            await ticket.release()
+
+    async def answer(
+            self,
+            context_text: str,
+            user_question: str,
+            is_stream: bool = False,
+            chat_history: Optional[list] = None
+    ) -> str | AsyncGenerator:
+        return await aget_openai_response(
+            context_text=context_text,
+            user_question=user_question,
+            llm_model_name=self.chat_model_name,
+            is_stream=is_stream,
+            chat_history=chat_history,
+        )
+
+    async def retrieve_context(
+            self,
+            user_question: str,
+            trace: Trace,
+            chat_history: Optional[Awaitable[list[dict]]] = None
+    ) -> tuple[list[float] | None, str | None, str]:
+        """
+        ``QAServices.retrieve_context`` on the asyncio clients.
+        :param chat_history: pending history fetch of the conversation, awaited only before the answer
+            cache lookup, so that it runs concurrently with the embedding
+        """
+        points = self.fast_path_points(user_question, trace)
+        if points is not None:
+            embedded_query = await self.embedding_cache.get(user_question, self.embedding_model_name)
+        else:
+            start_time = time.time()
+            with trace.span("embed"):
+                embedded_query = await aget_text_embedding(
+                    text=user_question,
+                    embedding_model_name=self.embedding_model_name,
+                    cache=self.embedding_cache
+                )
+
+        if self.caches_answer(embedded_query) and not (chat_history is not None and await chat_history):
+            with trace.span("answer_cache"):
+                cached_answer = await self.answer_cache.lookup(embedded_query)
+            if cached_answer is not None:
+                return embedded_query, cached_answer, ""
+
+        if points is not None:
+            return embedded_query, None, self.context_builder.build(points)
+
+        try:
+            with trace.span("vector_search"):
+                if self.retriever is not None:
+                    points = await self.retriever.asearch(
+                        user_question,
+                        embedded_query,
+                        self.qdrant_client,
+                        top_k=self.context_builder.candidate_k,
+                        score_threshold=self.context_builder.score_threshold
+                    )
+                else:
+                    points = await self.qdrant_client.retrieve_similar_vectors(
+                        embedded_query,
+                        top_k=self.context_builder.candidate_k,
+                        score_threshold=self.context_builder.score_threshold
+                    )
+        except SearchTimeoutError:
+            return None, None, self.context_builder.build(self.degraded_context_points(user_question))
+        return embedded_query, None, self.searched_context(user_question, points, start_time)
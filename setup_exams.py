@@ -1,15 +1,22 @@
 import configparser
-from typing import Tuple, List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, List, Dict, Any, Callable, Iterable, Optional
 import openai
 import json
 import os
+import random
+import threading
 from dotenv import load_dotenv
 from tqdm import tqdm
 import time
 import yaml
 
+from context_builder import count_tokens
 from db import PostgresqlClient
 
+GENERATION_MODEL_NAME = "gpt-3.5-turbo-instruct"
+COMPLETION_MAX_TOKENS = 2048
+
 
 def parse_raw_questions_to_json(raw_questions: str) -> list[dict]:
     """
@@ -76,10 +83,10 @@ def generate_knowledge(article: str, num_knowledge_point: int) -> str:
 
     start_time = time.time()
     response_gpt = openai.Completion.create(
-        model="gpt-3.5-turbo-instruct",
+        model=GENERATION_MODEL_NAME,
         prompt=prompt_1,
         temperature=0.7,
-        max_tokens=2048,
+        max_tokens=COMPLETION_MAX_TOKENS,
         n=1,
         top_p=1,
     )
@@ -114,10 +121,10 @@ def generate_question(knowledge: str, num_question: int):
 
     start_time = time.time()
     response_gpt = openai.Completion.create(
-        model="gpt-3.5-turbo-instruct",
+        model=GENERATION_MODEL_NAME,
         prompt=prompt_2,
         temperature=0.9,
-        max_tokens=2048,
+        max_tokens=COMPLETION_MAX_TOKENS,
         n=1,
     )
     raw_questions = response_gpt.choices[0].text
@@ -126,6 +133,154 @@ def generate_question(knowledge: str, num_question: int):
     return parse_raw_questions_to_json(raw_questions)
 
 
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+)
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter on requests per minute and tokens per minute, shared by worker threads
+    """
+
+    def __init__(self, requests_per_minute: float = 3000, tokens_per_minute: float = 250000):
+        self._capacities = (requests_per_minute, tokens_per_minute)
+        self._levels = [requests_per_minute, tokens_per_minute]
+        self._last_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, num_tokens: int) -> None:
+        """
+        Block until one request of ``num_tokens`` tokens fits in both budgets
+        """
+        num_tokens = min(num_tokens, self._capacities[1])
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                for idx, capacity in enumerate(self._capacities):
+                    self._levels[idx] = min(capacity, self._levels[idx] + (now - self._last_time) * capacity / 60)
+                self._last_time = now
+
+                if self._levels[0] >= 1 and self._levels[1] >= num_tokens:
+                    self._levels[0] -= 1
+                    self._levels[1] -= num_tokens
+                    return
+
+                wait_time = max(
+                    (1 - self._levels[0]) * 60 / self._capacities[0],
+                    (num_tokens - self._levels[1]) * 60 / self._capacities[1],
+                )
+            time.sleep(wait_time)
+
+
+def call_with_retries(func: Callable, *args, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0):
+    """
+    Call ``func``, retrying transient OpenAI errors with exponential backoff and full jitter
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return func(*args)
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            print(f"\n{func.__name__} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def estimate_generation_tokens(args: tuple) -> int:
+    """
+    Tokens charged to the limiter for a call on the text ``args[0]``: its prompt tokens plus the
+    completion budget. Characters are no measure, a Chinese character is often a token or more.
+    """
+    return count_tokens(args[0], GENERATION_MODEL_NAME) + COMPLETION_MAX_TOKENS
+
+
+def run_generation(
+        func: Callable,
+        items: Iterable[tuple],
+        max_workers: int = 8,
+        rate_limiter: Optional[RateLimiter] = None,
+        estimate_tokens: Callable[[tuple], int] = lambda args: 4096,
+        max_retries: int = 5,
+        desc: str = "Generating"
+) -> list[tuple[Any, Optional[Exception]]]:
+    """
+    Run ``func(*args)`` for every args tuple in ``items`` with bounded concurrency, rate limiting
+    and retries. A call that still fails does not stop the others; the failures are reported
+    at the end.
+    :param func: generation function
+    :param items: argument tuples
+    :param max_workers: maximum number of concurrent calls
+    :param rate_limiter: optional limiter shared by all calls
+    :param estimate_tokens: estimated tokens (prompt + completion) of a call, charged to the limiter
+    :param max_retries: maximum number of retries of a call
+    :param desc: progress bar description
+    :return: (result, None) or (None, exception) per item, in the order of ``items``
+    """
+    items = list(items)
+
+    def run_one(args: tuple) -> tuple[Any, Optional[Exception]]:
+        try:
+            if rate_limiter is not None:
+                rate_limiter.acquire(estimate_tokens(args))
+            return call_with_retries(func, *args, max_retries=max_retries), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        outcomes = list(tqdm(executor.map(run_one, items), total=len(items), desc=desc))
+
+    failures = [(idx, error) for idx, (_, error) in enumerate(outcomes) if error is not None]
+    if failures:
+        print(f"\n{func.__name__}: {len(failures)} of {len(items)} calls failed")
+        for idx, error in failures:
+            print(f"\t#{idx} {str(items[idx][0])[:30]!r}: {error!r}")
+    return outcomes
+
+
+def generate_knowledge_points(
+        article: str,
+        split_length: int = 600,
+        num_knowledge_point: int = 2,
+        **runner_kwargs
+) -> str:
+    """
+    Generate knowledge points for every chunk of an article, concurrently
+    """
+    text_list = split_article(article=article, split_length=split_length)
+    outcomes = run_generation(
+        generate_knowledge,
+        [(text, num_knowledge_point) for text in text_list],
+        estimate_tokens=estimate_generation_tokens,
+        desc="Processing Texts",
+        **runner_kwargs
+    )
+    # Failed chunks are reported by run_generation, the knowledge of the others is kept
+    knowledge_text = "".join(knowledge for knowledge, error in outcomes if error is None)
+
+    return knowledge_text.replace("--", "\n").replace("\n\n", "\n").replace("\n\n", "\n").strip()
+
+
+def generate_questions(knowledge_list: list[str], num_question: int = 1, **runner_kwargs) -> list[dict]:
+    """
+    Generate questions for every knowledge point, concurrently
+    """
+    outcomes = run_generation(
+        generate_question,
+        [(knowledge, num_question) for knowledge in knowledge_list],
+        estimate_tokens=estimate_generation_tokens,
+        desc="Processing Knowledge Points",
+        **runner_kwargs
+    )
+
+    return [question for question_list, error in outcomes if error is None for question in question_list]
+
+
 def import_database():
     """
     Import generated knowledge and questions into database
@@ -148,7 +303,7 @@ def import_database():
     SQL_CONFIG.read('sql.ini')
 
     """写入knowledge"""
-    sql_template = SQL_CONFIG.get('insert', 'insert_knowledge', raw=True)
+    copy_target = SQL_CONFIG.get('copy', 'copy_knowledge', raw=True)
     knowledge_tuple_list = []
     with open('ZC-S-H-002知识点.txt', 'r', encoding='utf-8') as f:
         doc_code, knowledge_id = "ZC-S-H-002", 1
@@ -157,10 +312,10 @@ def import_database():
                 knowledge_tuple_list.append((doc_code, knowledge_id, line.strip()))
                 knowledge_id += 1
 
-    # pg_client.execute_insert_many(sql_template, knowledge_data)
+    # pg_client.copy_insert(copy_target, knowledge_tuple_list)
 
     """写入question"""
-    sql_template = SQL_CONFIG.get('insert', 'insert_question', raw=True)
+    copy_target = SQL_CONFIG.get('copy', 'copy_question', raw=True)
     with open('ZC-S-H-002题目.json', 'r', encoding='utf-8') as f:
         question_data = json.load(f)
 
@@ -168,7 +323,7 @@ def import_database():
     for question_id, item in enumerate(question_data):
         question_tuple_list.append((doc_code, question_id + 1, item['question'], 0, json.dumps(item['options']), [item['answer']]))
 
-    # pg_client.execute_insert_many(sql_template, question_tuple_list)
+    # pg_client.copy_insert(copy_target, question_tuple_list)
     pg_client.close()
 
 
@@ -186,15 +341,13 @@ if __name__ == "__main__":
     """
     Generate knowledge points
     """
+    # rate_limiter = RateLimiter(requests_per_minute=3000, tokens_per_minute=250000)
+    #
     # with open("../document_txt/人力资源部/ZC-S-H-002RBA管理手册（A1）.txt", "r") as f:
     #     txt = f.read()
     #
-    # text_list = split_article(article=txt, split_length=600)
-    # knowledge_text = ""
-    # for text in tqdm(text_list, desc="Processing Texts"):
-    #     knowledge_text += generate_knowledge(article=text, num_knowledge_point=2)
-    #
-    # knowledge_text = knowledge_text.replace("--", "\n").replace("\n\n", "\n").replace("\n\n", "\n").strip()
+    # knowledge_text = generate_knowledge_points(txt, split_length=600, num_knowledge_point=2,
+    #                                            max_workers=8, rate_limiter=rate_limiter)
     #
     # with open('ZC-S-H-002知识点.txt', 'w', encoding='utf-8') as txt_f:
     #     txt_f.write(knowledge_text)
@@ -206,11 +359,8 @@ if __name__ == "__main__":
     #     knowledge_text = txt_f.read()
     #
     # knowledge_list = knowledge_text.split("\n")
-    # json_question_list = []
-    # for text in tqdm(knowledge_list, desc="Processing Knowledge Points"):
-    #     question_json = generate_question(knowledge=text, num_question=1)
-    #     print(question_json)
-    #     json_question_list += question_json
+    # json_question_list = generate_questions(knowledge_list, num_question=1,
+    #                                         max_workers=8, rate_limiter=rate_limiter)
     #
     # with open('ZC-S-H-002题目.json', 'w', encoding='utf-8') as json_f:
     #     json.dump(json_question_list, json_f, ensure_ascii=False, indent=4)
@@ -1,30 +1,43 @@
 from dotenv import load_dotenv
+import hashlib
+import json
 import os
+from pathlib import Path
 import yaml
-from langchain.document_loaders import DirectoryLoader, TextLoader
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import Qdrant
 import openai
 import uuid
 from qdrant_client import QdrantClient
 from qdrant_client.http import models
 from qdrant_client.models import PointStruct
 
-from utils import get_text_embedding
+from cache import SemanticAnswerCache
+from db import LocalVecDBClient, VecDBClient, create_vecdb_pool
+from retrieval import LexicalIndex
+from schema.document import Document
+from text_splitter import RecursiveTextSplitter
+from utils import get_text_embedding, get_text_embeddings
 
 load_dotenv()
 openai.api_key = os.environ.get("OPENAI_API_KEY")
 
-qdrant_config = yaml.safe_load(open("config.yaml", "r"))['qdrant']
+config = yaml.safe_load(open("config.yaml", "r"))
+qdrant_config = config['qdrant']
 QDRANT_URL = qdrant_config["url"]
 EMBEDDING_DIM = qdrant_config["embedding_dim"]
+EMBEDDING_MODEL_NAME = config['openai']['embedding_model']
+MANIFEST_PATH = qdrant_config.get("document_manifest_path", "./doc/document_manifest.json")
 
 
 def langchain_setup_docs_vecdb():
     """
     Using Langchain framework to split document, embedding text and store in Vector DB
     """
+    # Legacy path, the only one still needing langchain
+    from langchain.document_loaders import DirectoryLoader
+    from langchain.embeddings.openai import OpenAIEmbeddings
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from langchain.vectorstores import Qdrant
+
     loader = DirectoryLoader('./doc/document_txt/', glob="**/*.txt", show_progress=True)
     raw_documents = loader.load()
     text_splitter = RecursiveCharacterTextSplitter(
@@ -41,6 +54,198 @@ def langchain_setup_docs_vecdb():
         collection_name=collection_name,
         force_recreate=True,
     )
+    # Point ids no longer match the manifest, the next incremental run rebuilds from scratch
+    if os.path.exists(MANIFEST_PATH):
+        os.remove(MANIFEST_PATH)
+    refresh_derived_indexes()
+
+
+def load_manifest(manifest_path: str = MANIFEST_PATH) -> dict[str, dict]:
+    """
+    Load the ingestion manifest: one entry per ingested file, keyed by absolute file path
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict[str, dict], manifest_path: str = MANIFEST_PATH) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, manifest_path)
+
+
+def file_sha256(filepath: os.PathLike) -> str:
+    with open(filepath, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def ingest_document(
+        vecdb_client: VecDBClient,
+        document: Document,
+        old_chunk_ids: list[str],
+        batch_size: int = 64
+) -> list[str]:
+    """
+    Split, embed and upsert one document, then delete its chunks that no longer exist
+    :return: point ids of the document's chunks
+    """
+    text_splitter = RecursiveTextSplitter(
+        chunk_size=300,
+        chunk_overlap=50,
+        separators=["\n"]
+    )
+    with open(document.filepath, "r", encoding="utf-8") as f:
+        chunks = text_splitter.split_text(f.read())
+
+    # Deterministic ids: re-ingesting a file overwrites its points in place
+    chunk_ids = [str(uuid.uuid5(document.vec_id, str(idx))) for idx in range(len(chunks))]
+
+    for start in range(0, len(chunks), batch_size):
+        batch_chunks = chunks[start:start + batch_size]
+        batch_embeddings = get_text_embeddings(batch_chunks, embedding_model_name=EMBEDDING_MODEL_NAME)
+        to_vecdb_data = [
+            (vec_id, vector, {"page_content": chunk, "metadata": {"source": str(document.filepath)}})
+            for vec_id, vector, chunk in zip(chunk_ids[start:start + batch_size], batch_embeddings, batch_chunks)
+        ]
+        if vecdb_client.insert_vectors(to_vecdb_data) != len(to_vecdb_data):
+            raise RuntimeError(f"Failed to upsert chunks of {document.filepath}")
+
+    new_chunk_ids = set(chunk_ids)
+    vecdb_client.delete_vectors([vec_id for vec_id in old_chunk_ids if vec_id not in new_chunk_ids])
+    return chunk_ids
+
+
+def incremental_setup_docs_vecdb(root_path: str = './doc/document_txt/', batch_size: int = 64) -> None:
+    """
+    Bring the document collection up to date with the .txt files under ``root_path``.
+
+    Files are diffed against the manifest of the previous run: only chunks of new or changed
+    files are embedded and upserted into the live collection, and points of removed files are
+    deleted. Without a manifest the collection is rebuilt from scratch once.
+    """
+    vecdb_client = VecDBClient(
+        url=QDRANT_URL,
+        collection_name=qdrant_config['document_collection_name'],
+        embedding_dim=EMBEDDING_DIM,
+        quantization=qdrant_config.get("quantization")
+    )
+    manifest = load_manifest()
+    if not manifest:
+        print("No ingestion manifest found, rebuilding the document collection")
+        vecdb_client.drop_collection()
+    else:
+        vecdb_client.create_collection_if_not_exists()
+
+    filepaths = sorted(str(path.absolute()) for path in Path(root_path).glob("**/*.txt"))
+    num_changed, num_removed = 0, 0
+
+    try:
+        for filepath in filepaths:
+            document = Document(filepath)
+            entry = manifest.get(filepath)
+            if entry is not None and entry["modification_time"] == document.modification_time:
+                continue
+
+            sha256 = file_sha256(filepath)
+            if entry is not None and entry["sha256"] == sha256:
+                entry["modification_time"] = document.modification_time
+                continue
+
+            print(f"Ingesting {filepath}")
+            document.vec_id = uuid.uuid5(uuid.NAMESPACE_URL, filepath)
+            chunk_ids = ingest_document(
+                vecdb_client,
+                document,
+                old_chunk_ids=entry["chunk_ids"] if entry is not None else [],
+                batch_size=batch_size
+            )
+            manifest[filepath] = {**document.to_document(), "sha256": sha256, "chunk_ids": chunk_ids}
+            num_changed += 1
+
+        for filepath in set(manifest) - set(filepaths):
+            print(f"Removing {filepath}")
+            vecdb_client.delete_vectors(manifest[filepath]["chunk_ids"])
+            del manifest[filepath]
+            num_removed += 1
+    finally:
+        save_manifest(manifest)
+        print(f"Ingested {num_changed} new or changed files, removed {num_removed} files")
+        # Also after a failed run: the files ingested so far are in the manifest, so the next
+        # run would see no diff and never refresh the indexes derived from the collection
+        if num_changed or num_removed:
+            refresh_derived_indexes()
+
+    if not num_changed and not num_removed and not os.path.exists(lexical_index().path):
+        build_lexical_index()
+
+
+def refresh_derived_indexes() -> None:
+    """
+    Rebuild what is derived from the document collection: answer cache, BM25 index and local index
+    """
+    invalidate_answer_cache()
+    build_lexical_index()
+    if qdrant_config.get("backend", "remote") == "local":
+        sync_local_index()
+
+
+def sync_local_index() -> None:
+    """
+    Copy the document collection from Qdrant into the local exact-search index
+    """
+    local_client = LocalVecDBClient(
+        index_path=qdrant_config.get("local_index_path", "./vecdb_index"),
+        collection_name=qdrant_config['document_collection_name'],
+        embedding_dim=EMBEDDING_DIM
+    )
+    num_vectors = local_client.sync_from_qdrant(
+        VecDBClient(
+            url=QDRANT_URL,
+            collection_name=qdrant_config['document_collection_name'],
+            embedding_dim=EMBEDDING_DIM
+        )
+    )
+    print(f"Synced {num_vectors} vectors into the local index")
+
+
+def lexical_index() -> LexicalIndex:
+    return LexicalIndex(
+        index_path=config.get('lexical', {}).get('index_path', qdrant_config.get("local_index_path", "./vecdb_index")),
+        collection_name=qdrant_config['document_collection_name']
+    )
+
+
+def build_lexical_index() -> None:
+    """
+    Rebuild the BM25 index of the lexical fast path from the document collection
+    """
+    num_chunks = lexical_index().sync_from_qdrant(
+        VecDBClient(
+            url=QDRANT_URL,
+            collection_name=qdrant_config['document_collection_name'],
+            embedding_dim=EMBEDDING_DIM
+        )
+    )
+    print(f"Indexed {num_chunks} chunks for lexical retrieval")
+
+
+def invalidate_answer_cache() -> None:
+    """
+    Drop cached answers, which may quote documents that have just changed
+    """
+    answer_cache = SemanticAnswerCache(
+        vecdb_pool=create_vecdb_pool(
+            url=QDRANT_URL,
+            collection_name=qdrant_config.get("answer_cache_collection_name", "answer_cache"),
+            embedding_dim=EMBEDDING_DIM,
+            size=1
+        )
+    )
+    answer_cache.invalidate()
 
 
 def setup_charts_vecdb() -> None:
@@ -85,5 +290,6 @@ def setup_charts_vecdb() -> None:
 
 
 if __name__ == "__main__":
-    langchain_setup_docs_vecdb()
+    incremental_setup_docs_vecdb()
+    # langchain_setup_docs_vecdb()
     # setup_charts_vecdb()
@@ -0,0 +1,202 @@
+import asyncio
+import queue
+import threading
+import time
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, Optional
+
+# Marks the end of the token stream in the queue of SSEEncoder.chunks
+_END = object()
+
+
+def format_event(data: str, event_id: Optional[str] = None, event: Optional[str] = None) -> str:
+    """
+    Frame data as one Server-Sent Event. Multi-line data becomes several ``data:`` lines,
+    which the client joins back with newlines.
+    :param data: event data
+    :param event_id: optional event id, sent as the ``id:`` field
+    :param event: optional event type, sent as the ``event:`` field
+    :return: framed event
+    """
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}\n")
+    if event is not None:
+        lines.append(f"event: {event}\n")
+    lines.extend(f"data: {line}\n" for line in data.split("\n"))
+    lines.append("\n")
+    return "".join(lines)
+
+
+def iter_openai_tokens(stream_response_generator: Iterable) -> Iterator[str]:
+    for chunk in stream_response_generator:
+        yield chunk['choices'][0].get('delta', {}).get('content', '')
+
+
+async def aiter_openai_tokens(stream_response_generator: AsyncIterable) -> AsyncIterator[str]:
+    async for chunk in stream_response_generator:
+        yield chunk['choices'][0].get('delta', {}).get('content', '')
+
+
+class SSEEncoder:
+    """
+    Groups streamed LLM tokens into SSE events.
+
+    The first non-empty token is flushed immediately; after that a chunk is flushed as soon as
+    it holds ``max_chunk_size`` characters or ``max_delay`` seconds have passed since the last
+    flush, whichever comes first. The delay is enforced by a timer, so tokens are not held back
+    while the model pauses: ``chunks`` reads the tokens on a producer thread, ``achunks`` waits
+    for the next token with a timeout. The time from ``start_time`` to the first flush is kept
+    in ``ttfb``.
+    """
+
+    def __init__(self, max_chunk_size: int = 100, max_delay: float = 0.05, start_time: Optional[float] = None) -> None:
+        """
+        :param max_chunk_size: maximum number of characters held back
+        :param max_delay: maximum time a token is held back, in seconds
+        :param start_time: ``time.time()`` at which the request started, defaults to now
+        """
+        self._max_chunk_size = max_chunk_size
+        self._max_delay = max_delay
+        self._start_time = time.time() if start_time is None else start_time
+
+        self._parts: list[str] = []
+        self._buffer: list[str] = []
+        self._buffer_len = 0
+        self._last_flush_time = 0.0
+        self.ttfb: Optional[float] = None
+
+    @property
+    def text(self) -> str:
+        """
+        Everything received so far.
+        """
+        return "".join(self._parts)
+
+    def _push(self, token: str) -> Optional[str]:
+        if not token:
+            return None
+
+        self._parts.append(token)
+        self._buffer.append(token)
+        self._buffer_len += len(token)
+
+        now = time.time()
+        if (
+                self.ttfb is None
+                or self._buffer_len >= self._max_chunk_size
+                or now - self._last_flush_time >= self._max_delay
+        ):
+            if self.ttfb is None:
+                self.ttfb = now - self._start_time
+            self._last_flush_time = now
+            return self._flush()
+        return None
+
+    def _flush(self) -> Optional[str]:
+        if not self._buffer:
+            return None
+        chunk = "".join(self._buffer)
+        self._buffer, self._buffer_len = [], 0
+        return chunk
+
+    def _flush_timeout(self) -> Optional[float]:
+        """
+        :return: seconds until the buffered tokens are due, or None if nothing is buffered
+        """
+        if not self._buffer:
+            return None
+        return max(self._max_delay - (time.time() - self._last_flush_time), 0.0)
+
+    def _flush_due(self) -> Optional[str]:
+        self._last_flush_time = time.time()
+        return self._flush()
+
+    def chunks(self, tokens: Iterable[str]) -> Iterator[str]:
+        """
+        :param tokens: streamed tokens, read on a producer thread
+        :return: chunks of text to send as separate events
+        """
+        token_queue = queue.Queue()
+        stopped = threading.Event()
+
+        def produce() -> None:
+            iterator = iter(tokens)
+            try:
+                for token in iterator:
+                    token_queue.put(token)
+                    if stopped.is_set():
+                        break
+            except Exception as e:
+                token_queue.put(e)
+            finally:
+                token_queue.put(_END)
+                if stopped.is_set() and hasattr(iterator, "close"):
+                    iterator.close()
+
+        threading.Thread(target=produce, name="sse-tokens", daemon=True).start()
+        try:
+            while True:
+                try:
+                    token = token_queue.get(timeout=self._flush_timeout())
+                except queue.Empty:
+                    chunk = self._flush_due()
+                    if chunk is not None:
+                        yield chunk
+                    continue
+                if token is _END:
+                    break
+                if isinstance(token, Exception):
+                    raise token
+                chunk = self._push(token)
+                if chunk is not None:
+                    yield chunk
+        finally:
+            # Stops the producer at its next token if the consumer goes away early
+            stopped.set()
+
+        chunk = self._flush()
+        if chunk is not None:
+            yield chunk
+
+    async def achunks(self, tokens: AsyncIterable[str]) -> AsyncIterator[str]:
+        iterator = aiter(tokens)
+        next_token = None
+        try:
+            while True:
+                if next_token is None:
+                    next_token = asyncio.ensure_future(anext(iterator))
+                # Waiting does not cancel the pending token, unlike asyncio.wait_for
+                done, _ = await asyncio.wait({next_token}, timeout=self._flush_timeout())
+                if not done:
+                    chunk = self._flush_due()
+                    if chunk is not None:
+                        yield chunk
+                    continue
+                try:
+                    token = next_token.result()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    next_token = None
+                chunk = self._push(token)
+                if chunk is not None:
+                    yield chunk
+        finally:
+            if next_token is not None:
+                next_token.cancel()
+
+        chunk = self._flush()
+        if chunk is not None:
+            yield chunk
+
+    def encode(self, tokens: Iterable[str]) -> Iterator[str]:
+        """
+        :param tokens: streamed tokens
+        :return: framed SSE events
+        """
+        for chunk in self.chunks(tokens):
+            yield format_event(chunk)
+
+    async def aencode(self, tokens: AsyncIterable[str]) -> AsyncIterator[str]:
+        async for chunk in self.achunks(tokens):
+            yield format_event(chunk)
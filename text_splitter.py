@@ -0,0 +1,97 @@
+import re
+from typing import Optional
+
+
+class RecursiveTextSplitter:
+    """
+    Split text on the first separator found in it, recursing with the next separators into the
+    pieces that are still too long, then merge the pieces back into overlapping chunks.
+
+    Produces the same chunks as langchain's ``RecursiveCharacterTextSplitter`` (separators kept
+    at the start of the following piece, whitespace stripped), so the chunk ids of documents
+    ingested with it do not change.
+    """
+
+    def __init__(
+            self,
+            chunk_size: int = 300,
+            chunk_overlap: int = 50,
+            separators: Optional[list[str]] = None
+    ) -> None:
+        """
+        :param chunk_size: maximum chunk length, in characters; a piece longer than it is kept whole
+            when no separator is left to split it
+        :param chunk_overlap: maximum overlap between consecutive chunks, in characters
+        :param separators: separators tried in order; "" splits into characters
+        """
+        if chunk_overlap > chunk_size:
+            raise ValueError(f"Chunk overlap ({chunk_overlap}) is larger than chunk size ({chunk_size})")
+        self._chunk_size = chunk_size
+        self._chunk_overlap = chunk_overlap
+        self._separators = separators if separators is not None else ["\n\n", "\n", " ", ""]
+
+    @staticmethod
+    def _split_keeping_separator(text: str, separator: str) -> list[str]:
+        if not separator:
+            return list(text)
+        pieces = re.split(f"({re.escape(separator)})", text)
+        # Separator + following text, so that the separator starts the next piece
+        splits = [pieces[0]] + [pieces[idx] + pieces[idx + 1] for idx in range(1, len(pieces) - 1, 2)]
+        return [split for split in splits if split != ""]
+
+    @staticmethod
+    def _join(pieces: list[str]) -> Optional[str]:
+        text = "".join(pieces).strip()
+        return text or None
+
+    def _merge(self, splits: list[str]) -> list[str]:
+        chunks = []
+        current: list[str] = []
+        total = 0
+        for split in splits:
+            if total + len(split) > self._chunk_size and current:
+                chunk = self._join(current)
+                if chunk is not None:
+                    chunks.append(chunk)
+                # Keep the tail of the chunk as the overlap of the next one
+                while total > self._chunk_overlap or (total + len(split) > self._chunk_size and total > 0):
+                    total -= len(current.pop(0))
+            current.append(split)
+            total += len(split)
+
+        chunk = self._join(current)
+        if chunk is not None:
+            chunks.append(chunk)
+        return chunks
+
+    def _split(self, text: str, separators: list[str]) -> list[str]:
+        separator = separators[-1]
+        next_separators = []
+        for idx, candidate in enumerate(separators):
+            if candidate == "":
+                separator = candidate
+                break
+            if candidate in text:
+                separator = candidate
+                next_separators = separators[idx + 1:]
+                break
+
+        chunks = []
+        short_splits = []
+        for split in self._split_keeping_separator(text, separator):
+            if len(split) < self._chunk_size:
+                short_splits.append(split)
+                continue
+            if short_splits:
+                chunks.extend(self._merge(short_splits))
+                short_splits = []
+            if next_separators:
+                chunks.extend(self._split(split, next_separators))
+            else:
+                chunks.append(split)
+        if short_splits:
+            chunks.extend(self._merge(short_splits))
+        return chunks
+
+    def split_text(self, text: str) -> list[str]:
+        return self._split(text, self._separators)
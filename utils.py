@@ -1,36 +1,124 @@
-from typing import Generator
+import re
+from typing import AsyncGenerator, Generator, Optional
 
 import openai
-from prompt import qa_prompt
+from prompt import marking_prompt, qa_prompt, summary_prompt
+from cache import EmbeddingCache
+from embedder import BatchEmbedder
+from metrics import record_usage
 
 
-def get_text_embedding(text: str, embedding_model_name: str) -> list[float]:
+def get_text_embeddings(texts: list[str], embedding_model_name: str) -> list[list[float]]:
+    """
+    Embed several texts with one OpenAI embedding API call.
+
+    :param texts: input texts
+    :param embedding_model_name: embedding model name
+
+    :return: embedding vectors, in the order of ``texts``
+    """
     response = openai.Embedding.create(
         model=embedding_model_name,
-        input=text
+        input=texts
     )
-    embedding = response["data"][0]["embedding"]
+    embeddings = sorted(response["data"], key=lambda item: item["index"])
 
-    return embedding
+    return [item["embedding"] for item in embeddings]
 
 
-def get_openai_response(
-        context_text: str,
-        user_question: str,
-        llm_model_name: str,
-        is_stream: bool = False,
-        chat_history: list = None
-) -> str | Generator:
+def get_text_embedding(
+        text: str,
+        embedding_model_name: str,
+        cache: Optional[EmbeddingCache] = None,
+        embedder: Optional[BatchEmbedder] = None
+) -> list[float]:
     """
-    Generate response based on input question and content text(from vector database).
+    Embed text with the OpenAI embedding API.
+
+    :param text: input text
+    :param embedding_model_name: embedding model name
+    :param cache: optional embedding cache consulted before calling the API
+    :param embedder: optional batching embedder that coalesces concurrent calls
+
+    :return: embedding vector
+    """
+    def create_embedding(input_text: str) -> list[float]:
+        if embedder is not None:
+            return embedder.embed(input_text, embedding_model_name)
+
+        response = openai.Embedding.create(
+            model=embedding_model_name,
+            input=input_text
+        )
+        return response["data"][0]["embedding"]
+
+    if cache is None:
+        return create_embedding(text)
+
+    return cache.get_or_compute(text, embedding_model_name, create_embedding)
+
+
+def get_text_embeddings_cached(
+        texts: list[str],
+        embedding_model_name: str,
+        cache: Optional[EmbeddingCache] = None
+) -> list[list[float]]:
+    """
+    Embed several texts, with one OpenAI embedding API call for the texts missing from the cache.
+
+    :param texts: input texts
+    :param embedding_model_name: embedding model name
+    :param cache: optional embedding cache consulted before calling the API
+
+    :return: embedding vectors, in the order of ``texts``
+    """
+    embeddings = {text: cache.get(text, embedding_model_name) for text in texts} if cache is not None else {}
+    missing = [text for text in dict.fromkeys(texts) if embeddings.get(text) is None]
+    if missing:
+        for text, embedding in zip(missing, get_text_embeddings(missing, embedding_model_name)):
+            embeddings[text] = embedding
+            if cache is not None:
+                cache.set(text, embedding_model_name, embedding)
+
+    return [embeddings[text] for text in texts]
+
+
+async def aget_text_embedding(
+        text: str,
+        embedding_model_name: str,
+        cache: Optional[EmbeddingCache] = None
+) -> list[float]:
+    """
+    Async version of ``get_text_embedding``.
+
+    :param text: input text
+    :param embedding_model_name: embedding model name
+    :param cache: optional embedding cache consulted before calling the API
+
+    :return: embedding vector
+    """
+    async def create_embedding(input_text: str) -> list[float]:
+        response = await openai.Embedding.acreate(
+            model=embedding_model_name,
+            input=input_text
+        )
+        return response["data"][0]["embedding"]
+
+    if cache is None:
+        return await create_embedding(text)
+
+    return await cache.aget_or_compute(text, embedding_model_name, create_embedding)
+
+
+def build_messages(context_text: str, user_question: str, chat_history: list = None) -> list[dict]:
+    """
+    Build the chat completion messages from the QA prompt.
 
     :param context_text: context text from vector database
     :param user_question: input question
-    :param llm_model_name: LLM model name
-    :param is_stream: whether to use stream response
     :param chat_history: chat history
 
-    :return: LLM response
+    :return: OpenAI chat messages
     """
     if chat_history is None:
         messages = [
@@ -44,6 +132,29 @@ def get_openai_response(
             {"role": "user", "content": qa_prompt["user"].format(CONTENT=context_text, QUESTION=user_question)}
         ]
 
+    return messages
+
+
+def get_openai_response(
+        context_text: str,
+        user_question: str,
+        llm_model_name: str,
+        is_stream: bool = False,
+        chat_history: list = None
+) -> str | Generator:
+    """
+    Generate response based on input question and content text(from vector database).
+
+    :param context_text: context text from vector database
+    :param user_question: input question
+    :param llm_model_name: LLM model name
+    :param is_stream: whether to use stream response
+    :param chat_history: chat history
+
+    :return: LLM response
+    """
+    messages = build_messages(context_text, user_question, chat_history)
+
     response_gpt = openai.ChatCompletion.create(
         model=llm_model_name,
         messages=messages,
@@ -54,23 +165,114 @@ def get_openai_response(
     )
 
     if not is_stream:
-        total_tokens = response_gpt['usage']['total_tokens']  # 获取消耗的token数量
-        print(f"\ttoken数量: {total_tokens}")
+        record_usage("answer", response_gpt.get('usage'))
         return response_gpt.choices[0].message["content"]
     else:
         return response_gpt
 
 
-def formatted_response(success: bool, msg: str, data=None) -> dict:
-    if success:
-        return {
-            "code": 200,
-            "msg": msg,
-            "data": data
-        }
+async def aget_openai_response(
+        context_text: str,
+        user_question: str,
+        llm_model_name: str,
+        is_stream: bool = False,
+        chat_history: list = None
+) -> str | AsyncGenerator:
+    """
+    Async version of ``get_openai_response``.
+
+    :param context_text: context text from vector database
+    :param user_question: input question
+    :param llm_model_name: LLM model name
+    :param is_stream: whether to use stream response
+    :param chat_history: chat history
+
+    :return: LLM response, or an async generator of chunks in stream mode
+    """
+    messages = build_messages(context_text, user_question, chat_history)
+
+    response_gpt = await openai.ChatCompletion.acreate(
+        model=llm_model_name,
+        messages=messages,
+        temperature=0.9,
+        max_tokens=512,
+        top_p=1,
+        stream=is_stream,
+    )
+
+    if not is_stream:
+        record_usage("answer", response_gpt.get('usage'))
+        return response_gpt.choices[0].message["content"]
     else:
-        return {
-            "code": 404,
-            "msg": msg,
-            "data": None
-        }
+        return response_gpt
+
+
+def build_summary_messages(summary: str, messages: list[dict]) -> list[dict]:
+    conversation = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    return [
+        {"role": "system", "content": summary_prompt["system"]},
+        {"role": "user", "content": summary_prompt["user"].format(SUMMARY=summary or "(empty)", CONVERSATION=conversation)}
+    ]
+
+
+def summarize_conversation(summary: str, messages: list[dict], llm_model_name: str) -> str:
+    """
+    Fold chat messages into the running summary of a conversation.
+
+    :param summary: current summary, may be empty
+    :param messages: OpenAI messages to fold in, oldest first
+    :param llm_model_name: LLM model name
+
+    :return: updated summary
+    """
+    response_gpt = openai.ChatCompletion.create(
+        model=llm_model_name,
+        messages=build_summary_messages(summary, messages),
+        temperature=0,
+        max_tokens=384,
+    )
+    record_usage("summary", response_gpt.get('usage'))
+    return response_gpt.choices[0].message["content"]
+
+
+def grade_answer(question: str, reference: str, answer: str, llm_model_name: str, full_score: float = 5.0) -> float:
+    """
+    Score a free-text answer against the reference answer.
+
+    :param question: question text
+    :param reference: reference answer
+    :param answer: user answer
+    :param llm_model_name: LLM model name
+    :param full_score: score of a fully correct answer
+
+    :return: score between 0 and ``full_score``
+    """
+    response_gpt = openai.ChatCompletion.create(
+        model=llm_model_name,
+        messages=[
+            {"role": "system", "content": marking_prompt["system"].format(FULL_SCORE=full_score)},
+            {"role": "user", "content": marking_prompt["user"].format(QUESTION=question, REFERENCE=reference, ANSWER=answer)}
+        ],
+        temperature=0,
+        max_tokens=8,
+    )
+    record_usage("marking", response_gpt.get('usage'))
+    match = re.search(r"\d+(\.\d+)?", response_gpt.choices[0].message["content"])
+    if match is None:
+        raise ValueError(f"No score in the marking response: {response_gpt.choices[0].message['content']}")
+    return min(max(float(match.group()), 0.0), full_score)
+
+
+async def asummarize_conversation(summary: str, messages: list[dict], llm_model_name: str) -> str:
+    """
+    Async version of ``summarize_conversation``.
+    """
+    response_gpt = await openai.ChatCompletion.acreate(
+        model=llm_model_name,
+        messages=build_summary_messages(summary, messages),
+        temperature=0,
+        max_tokens=384,
+    )
+    record_usage("summary", response_gpt.get('usage'))
+    return response_gpt.choices[0].message["content"]
+